@@ -0,0 +1,23 @@
+"""per-document linearized (fast web view) output
+
+Revision ID: 0002_document_linearize
+Revises: 0001_initial
+Create Date: 2026-10-18 00:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0002_document_linearize'
+down_revision = '0001_initial'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # NULL 表示沿用全局设置 SECUREHUB_LINEARIZE
+    op.add_column('documents', sa.Column('linearize', sa.Boolean, nullable=True))
+
+
+def downgrade():
+    op.drop_column('documents', 'linearize')
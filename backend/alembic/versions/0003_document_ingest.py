@@ -0,0 +1,30 @@
+"""ingest-time document metadata
+
+Revision ID: 0003_document_ingest
+Revises: 0002_document_linearize
+Create Date: 2026-10-18 00:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0003_document_ingest'
+down_revision = '0002_document_linearize'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 已有文档视为 ready：没有几何表时渲染时逐页读取
+    op.add_column('documents', sa.Column('status', sa.String(16), nullable=True, server_default='ready'))
+    op.add_column('documents', sa.Column('page_count', sa.Integer, nullable=True))
+    op.add_column('documents', sa.Column('file_size', sa.BigInteger, nullable=True))
+    op.add_column('documents', sa.Column('sha256', sa.String(64), nullable=True))
+    op.add_column('documents', sa.Column('geometry', sa.Text, nullable=True))
+    op.add_column('documents', sa.Column('ingest_error', sa.Text, nullable=True))
+    op.add_column('documents', sa.Column('ingested_at', sa.DateTime, nullable=True))
+
+
+def downgrade():
+    for column in ('ingested_at', 'ingest_error', 'geometry', 'sha256', 'file_size', 'page_count', 'status'):
+        op.drop_column('documents', column)
@@ -0,0 +1,37 @@
+"""content-addressed document blobs
+
+Revision ID: 0004_blob_store
+Revises: 0003_document_ingest
+Create Date: 2026-10-18 00:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0004_blob_store'
+down_revision = '0003_document_ingest'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'blobs',
+        sa.Column('sha256', sa.String(64), primary_key=True),
+        sa.Column('size', sa.BigInteger, nullable=False),
+        sa.Column('ref_count', sa.Integer, nullable=False, server_default='0'),
+        sa.Column('created_at', sa.DateTime),
+    )
+    # 已有文档保留原来的文件路径（blob_sha256 为空），重新入库时迁入 blob 存储
+    with op.batch_alter_table('documents') as batch_op:
+        batch_op.add_column(sa.Column('blob_sha256', sa.String(64), nullable=True))
+        batch_op.create_index('ix_documents_blob_sha256', ['blob_sha256'])
+        batch_op.create_foreign_key('fk_documents_blob_sha256', 'blobs', ['blob_sha256'], ['sha256'])
+
+
+def downgrade():
+    with op.batch_alter_table('documents') as batch_op:
+        batch_op.drop_constraint('fk_documents_blob_sha256', type_='foreignkey')
+        batch_op.drop_index('ix_documents_blob_sha256')
+        batch_op.drop_column('blob_sha256')
+    op.drop_table('blobs')
@@ -0,0 +1,23 @@
+"""per-user access token version
+
+Revision ID: 0005_user_token_version
+Revises: 0004_blob_store
+Create Date: 2026-10-18 00:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0005_user_token_version'
+down_revision = '0004_blob_store'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 访问令牌中的 ver 声明须与之相等；没有 ver 的旧令牌在过期前仍按用户名校验
+    op.add_column('users', sa.Column('token_version', sa.Integer, nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('users', 'token_version')
@@ -0,0 +1,24 @@
+"""refresh token sweeping and bulk revocation indexes
+
+Revision ID: 0006_refresh_token_lifecycle
+Revises: 0005_user_token_version
+Create Date: 2026-10-18 00:00:00.000000
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '0006_refresh_token_lifecycle'
+down_revision = '0005_user_token_version'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 清理任务按 expires_at 分批删除；注销所有会话按 user_id 批量吊销
+    op.create_index('ix_refresh_tokens_expires_at', 'refresh_tokens', ['expires_at'])
+    op.create_index('ix_refresh_tokens_user_id_revoked', 'refresh_tokens', ['user_id', 'revoked'])
+
+
+def downgrade():
+    op.drop_index('ix_refresh_tokens_user_id_revoked', table_name='refresh_tokens')
+    op.drop_index('ix_refresh_tokens_expires_at', table_name='refresh_tokens')
@@ -0,0 +1,84 @@
+"""query indexes for download/audit logs; bring migrations in sync with the models
+
+Revision ID: 0007_query_indexes
+Revises: 0006_refresh_token_lifecycle
+Create Date: 2026-10-18 00:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0007_query_indexes'
+down_revision = '0006_refresh_token_lifecycle'
+branch_labels = None
+depends_on = None
+
+# (索引名, 表, 列)：与 app.models 中的定义一致
+INDEXES = [
+    ('ix_download_logs_timestamp', 'download_logs', ['timestamp']),
+    ('ix_download_logs_user_id_timestamp', 'download_logs', ['user_id', 'timestamp']),
+    ('ix_download_logs_document_id_timestamp', 'download_logs', ['document_id', 'timestamp']),
+    ('ix_document_access_document_id', 'document_access', ['document_id']),
+]
+# 主键上多余的索引：早期模型以 index=True 声明，create_all 建库时会创建
+REDUNDANT_INDEXES = [('ix_users_id', 'users'), ('ix_documents_id', 'documents'), ('ix_download_logs_id', 'download_logs')]
+
+
+def _index_names(inspector, table):
+    return {ix['name'] for ix in inspector.get_indexes(table)}
+
+
+def upgrade():
+    # 用 create_all 建库后 stamp 的数据库已有部分表、列与索引，逐项检查
+    inspector = sa.inspect(op.get_bind())
+
+    if 'audit_logs' in inspector.get_table_names():
+        audit_indexes = _index_names(inspector, 'audit_logs')
+    else:
+        op.create_table(
+            'audit_logs',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('actor_id', sa.Integer, sa.ForeignKey('users.id'), nullable=True),
+            sa.Column('action', sa.String(128), nullable=False),
+            sa.Column('object_type', sa.String(64), nullable=True),
+            sa.Column('object_id', sa.String(64), nullable=True),
+            sa.Column('detail', sa.Text, nullable=True),
+            sa.Column('timestamp', sa.DateTime, nullable=True),
+        )
+        audit_indexes = set()
+    if 'ix_audit_logs_timestamp' not in audit_indexes:
+        op.create_index('ix_audit_logs_timestamp', 'audit_logs', ['timestamp'])
+
+    for table in ('users', 'documents'):
+        columns = {col['name'] for col in inspector.get_columns(table)}
+        for name in ('created_at', 'updated_at'):
+            if name not in columns:
+                op.add_column(table, sa.Column(name, sa.DateTime, nullable=True))
+
+    for name, table, columns in INDEXES:
+        if name not in _index_names(inspector, table):
+            op.create_index(name, table, columns)
+    if 'ix_refresh_tokens_jti' not in _index_names(inspector, 'refresh_tokens'):
+        op.create_index('ix_refresh_tokens_jti', 'refresh_tokens', ['jti'], unique=True)
+    for name, table in REDUNDANT_INDEXES:
+        if name in _index_names(inspector, table):
+            op.drop_index(name, table_name=table)
+
+    if 'uix_user_document' not in {uc['name'] for uc in inspector.get_unique_constraints('document_access')}:
+        # 先删除重复的授权（保留最早的一条），否则无法加唯一约束
+        op.execute(
+            'DELETE FROM document_access WHERE id NOT IN '
+            '(SELECT keep_id FROM (SELECT MIN(id) AS keep_id FROM document_access GROUP BY user_id, document_id) AS keep)'
+        )
+        with op.batch_alter_table('document_access') as batch_op:
+            batch_op.create_unique_constraint('uix_user_document', ['user_id', 'document_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('document_access') as batch_op:
+        batch_op.drop_constraint('uix_user_document', type_='unique')
+    op.drop_index('ix_refresh_tokens_jti', table_name='refresh_tokens')
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+    op.drop_index('ix_audit_logs_timestamp', table_name='audit_logs')
+    # audit_logs 表与 created_at/updated_at 列保留：用 create_all 建库的数据库原本就有
@@ -9,6 +9,7 @@ from sqlalchemy.orm import Session
 
 from . import models
 from .database import get_db
+from .utils import principal_cache
 
 SECRET_KEY = os.getenv('SECUREHUB_SECRET', 'dev-secret-change-me')
 ALGORITHM = 'HS256'
@@ -43,7 +44,22 @@ def create_refresh_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt, jti, expire
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def create_user_access_token(user: models.User, expires_delta: Optional[timedelta] = None):
+    """签发携带 uid、管理员标志（adm）与 token_version（ver）的访问令牌，鉴权时不必查询用户。"""
+    return create_access_token({'sub': user.username, 'uid': user.id, 'adm': bool(user.is_admin), 'ver': user.token_version or 0}, expires_delta)
+
+
+def revoke_user_tokens(user: models.User):
+    """递增 token_version，使该用户已签发的访问令牌失效（提交后须调用 ``principal_cache.invalidate``）。"""
+    user.token_version = (user.token_version or 0) + 1
+
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> principal_cache.Principal:
+    """校验访问令牌，返回 ``Principal``（不是绑定会话的 ``models.User``）。
+
+    新令牌按 uid 查版本表（``principal_cache``，命中时不访问数据库）：版本号与令牌中的
+    ver 不一致即视为已吊销，权限取自令牌声明。没有 uid 声明的旧令牌按用户名查找。
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail='Could not validate credentials',
@@ -57,7 +73,22 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     except JWTError:
         raise credentials_exception
 
-    user = db.query(models.User).filter(models.User.username == username).first()
+    uid = payload.get('uid')
+    if uid is not None:
+        def load():
+            user = db.query(models.User).filter(models.User.id == uid).first()
+            return principal_cache.Principal.from_user(user) if user is not None else None
+
+        current = principal_cache.get_cache().get(('uid', uid), load)
+        if current is None or current.token_version != payload.get('ver'):
+            raise credentials_exception
+        user = principal_cache.Principal(uid, username, current.is_active, bool(payload.get('adm')), current.token_version)
+    else:
+        def load():
+            user = db.query(models.User).filter(models.User.username == username).first()
+            return principal_cache.Principal.from_user(user) if user is not None else None
+
+        user = principal_cache.get_cache().get(('sub', username), load)
     if user is None:
         raise credentials_exception
     if not user.is_active:
@@ -65,13 +96,21 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     return user
 
 
-def get_current_active_user(current_user: models.User = Depends(get_current_user)):
+def get_current_user_record(current_user: principal_cache.Principal = Depends(get_current_user), db: Session = Depends(get_db)):
+    """需要完整用户记录（例如修改 2FA 设置）的接口使用：按 ID 加载 ``models.User``。"""
+    user = db.query(models.User).filter(models.User.id == current_user.id).first()
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate credentials', headers={'WWW-Authenticate': 'Bearer'})
+    return user
+
+
+def get_current_active_user(current_user: principal_cache.Principal = Depends(get_current_user)):
     if not current_user.is_active:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Inactive user')
     return current_user
 
 
-def get_current_admin_user(current_user: models.User = Depends(get_current_active_user)):
+def get_current_admin_user(current_user: principal_cache.Principal = Depends(get_current_active_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Requires admin privileges')
     return current_user
@@ -3,9 +3,14 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from app.routes import download, auth as auth_router, users as users_router, documents as docs_router, logs as logs_router
 from app.routes import audit as audit_router
+from app.routes import metrics as metrics_router
+from app.routes import uploads as uploads_router
 import asyncio
 import logging
 from app.utils.cleanup import cleanup_expired_files
+from app.utils import chunked_upload, refresh_tokens
+from app.security import get_hasher
+from app.routes.download import _resolve_deploy_module, _resolve_watermark_pool
 
 app = FastAPI(title="SecureHub API")
 
@@ -32,11 +37,13 @@ app.include_router(users_router.router, prefix="/api")
 app.include_router(docs_router.router, prefix="/api")
 app.include_router(logs_router.router, prefix="/api")
 app.include_router(audit_router.router, prefix="/api")
+app.include_router(metrics_router.router, prefix="/api")
+app.include_router(uploads_router.router, prefix="/api")
 
 
 @app.on_event("startup")
 async def start_cleanup_task():
-    """Start a background task that periodically removes old temp PDF files."""
+    """Start a background task that periodically removes leaked spool PDF files."""
     loop = asyncio.get_event_loop()
     stop_event = asyncio.Event()
 
@@ -44,9 +51,17 @@ async def start_cleanup_task():
         logging.getLogger("uvicorn").info("Starting temp-file cleaner task")
         while not stop_event.is_set():
             try:
-                removed = cleanup_expired_files(older_than_seconds=300)
+                spool_dir = _resolve_deploy_module('watermark_wrapper').ensure_spool_dir()
+                removed = await loop.run_in_executor(None, lambda: cleanup_expired_files(temp_dir=spool_dir, older_than_seconds=300))
                 if removed:
                     logging.getLogger("uvicorn").info(f"Removed {len(removed)} expired temp files")
+                expired = await loop.run_in_executor(None, chunked_upload.cleanup_expired)
+                if expired:
+                    logging.getLogger("uvicorn").info(f"Removed {len(expired)} abandoned chunked uploads")
+                # 过期刷新令牌分批删除
+                swept = await loop.run_in_executor(None, refresh_tokens.maintain)
+                if swept:
+                    logging.getLogger("uvicorn").info(f"Removed {swept} expired refresh tokens")
             except Exception as e:
                 logging.getLogger("uvicorn").error(f"Temp-file cleaner error: {e}")
             await asyncio.sleep(300)
@@ -55,6 +70,25 @@ async def start_cleanup_task():
     loop.create_task(_cleaner())
 
 
+@app.on_event("startup")
+async def start_watermark_pool():
+    """Start the pre-warmed watermark worker processes (SECUREHUB_WATERMARK_WORKERS=0 disables)."""
+    pool = _resolve_watermark_pool().start_pool()
+    if pool is not None:
+        logging.getLogger("uvicorn").info(f"Started watermark pool with {pool.size} workers")
+
+
 @app.on_event("shutdown")
 async def stop_cleanup_task():
     logging.getLogger("uvicorn").info("Shutting down temp-file cleaner task")
+
+
+@app.on_event("shutdown")
+async def stop_watermark_pool():
+    logging.getLogger("uvicorn").info("Stopping watermark pool")
+    await asyncio.get_event_loop().run_in_executor(None, _resolve_watermark_pool().stop_pool)
+
+
+@app.on_event("shutdown")
+async def stop_password_hasher():
+    get_hasher().shutdown()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Text, UniqueConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, ForeignKey, DateTime, Text, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .database import Base
@@ -6,13 +6,15 @@ from .database import Base
 
 class User(Base):
     __tablename__ = 'users'
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     username = Column(String(128), unique=True, index=True, nullable=False)
     hashed_password = Column(String(256), nullable=False)
     is_active = Column(Boolean, default=True)
     is_admin = Column(Boolean, default=False)
     two_factor_enabled = Column(Boolean, default=False)
     otp_secret = Column(String(64), nullable=True)
+    # 访问令牌中的 ver 须与之相等；停用、权限变化或重置密码时递增，使已签发的令牌立即失效
+    token_version = Column(Integer, nullable=False, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     # relationship shortcuts
@@ -32,24 +34,51 @@ user_groups = Table(
 
 class Document(Base):
     __tablename__ = 'documents'
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     filename = Column(String(512), nullable=False)
     file_path = Column(String(1024), nullable=False)
     watermark_enabled = Column(Boolean, default=True)
     watermark_text = Column(Text, nullable=True)
     font_size = Column(Integer, default=40)
     opacity = Column(String(8), default='0.3')
+    # 原文件与水印输出是否线性化（快速 Web 查看）；None 表示沿用全局设置 SECUREHUB_LINEARIZE
+    linearize = Column(Boolean, nullable=True)
+    # 入库处理（app/utils/ingest.py）：上传后为 pending，校验分析成功后为 ready，失败为 failed；
+    # 直接写入数据库的文档视为 ready（没有几何表时渲染时逐页读取）
+    status = Column(String(16), default='ready')
+    page_count = Column(Integer, nullable=True)
+    file_size = Column(BigInteger, nullable=True)
+    sha256 = Column(String(64), nullable=True)
+    # 页面几何表 JSON（见 modules/add.py 中的 collect_geometry），对应 sha256 所指的文件内容
+    geometry = Column(Text, nullable=True)
+    ingest_error = Column(Text, nullable=True)
+    ingested_at = Column(DateTime, nullable=True)
+    # 内容寻址存储中的 blob（app/utils/blob_store.py）；为 None 时 file_path 是独占的旧文件
+    blob_sha256 = Column(String(64), ForeignKey('blobs.sha256'), nullable=True, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     accesses = relationship('DocumentAccess', back_populates='document', cascade='all, delete-orphan')
 
 
+class Blob(Base):
+    """按 SHA-256 存储的原文件，多个文档可共用同一份内容；引用计数归零时删除文件。"""
+    __tablename__ = 'blobs'
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
 class DocumentAccess(Base):
     __tablename__ = 'document_access'
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     document_id = Column(Integer, ForeignKey('documents.id'), nullable=False)
-    __table_args__ = (UniqueConstraint('user_id', 'document_id', name='uix_user_document'),)
+    # 唯一约束同时用于按用户 + 文档的权限校验；删除文档时按 document_id 删除授权
+    __table_args__ = (
+        UniqueConstraint('user_id', 'document_id', name='uix_user_document'),
+        Index('ix_document_access_document_id', 'document_id'),
+    )
     user = relationship('User', backref='document_accesses')
     document = relationship('Document', back_populates='accesses')
 
@@ -64,11 +93,17 @@ class Group(Base):
 
 class DownloadLog(Base):
     __tablename__ = 'download_logs'
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     document_id = Column(Integer, ForeignKey('documents.id'))
     timestamp = Column(DateTime, default=datetime.utcnow)
     client_ip = Column(String(64), nullable=True)
+    # /logs 按用户或文档筛选、按时间范围过滤并按时间倒序分页；续传查找按用户 + 文档 + 时间
+    __table_args__ = (
+        Index('ix_download_logs_timestamp', 'timestamp'),
+        Index('ix_download_logs_user_id_timestamp', 'user_id', 'timestamp'),
+        Index('ix_download_logs_document_id_timestamp', 'document_id', 'timestamp'),
+    )
     user = relationship('User', backref='download_logs')
     document = relationship('Document', backref='download_logs')
 
@@ -81,7 +116,7 @@ class AuditLog(Base):
     object_type = Column(String(64), nullable=True)
     object_id = Column(String(64), nullable=True)
     detail = Column(Text, nullable=True)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
     actor = relationship('User', backref='audit_logs')
 
 
@@ -91,5 +126,8 @@ class RefreshToken(Base):
     jti = Column(String(64), unique=True, index=True, nullable=False)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     issued_at = Column(DateTime, default=datetime.utcnow)
-    expires_at = Column(DateTime, nullable=True)
+    # 过期记录由后台任务分批删除（app.utils.refresh_tokens.sweep_expired）
+    expires_at = Column(DateTime, nullable=True, index=True)
     revoked = Column(Boolean, default=False)
+    # 注销用户的所有会话时按 user_id 批量吊销
+    __table_args__ = (Index('ix_refresh_tokens_user_id_revoked', 'user_id', 'revoked'),)
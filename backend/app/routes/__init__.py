@@ -1,4 +1,4 @@
-from . import download, auth, users, documents, logs, audit
+from . import download, auth, users, documents, logs, audit, metrics
 
 router = download.router
 # expose audit router via import side-effect (app.main imports routes)
@@ -7,16 +7,17 @@ from io import StringIO
 from app.database import get_db
 from app import models
 from app.auth import get_current_user, get_current_admin_user
+from app.utils import principal_cache
 
 router = APIRouter()
 
 
-def admin_required(user: models.User = Depends(get_current_admin_user)):
+def admin_required(user: principal_cache.Principal = Depends(get_current_admin_user)):
     return user
 
 
 @router.get('/audit')
-def list_audit(page: int = 1, size: int = 100, db: Session = Depends(get_db), _: models.User = Depends(admin_required)):
+def list_audit(page: int = 1, size: int = 100, db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
     query = db.query(models.AuditLog).order_by(models.AuditLog.timestamp.desc())
     total = query.count()
     items = query.offset((page - 1) * size).limit(size).all()
@@ -36,7 +37,7 @@ def list_audit(page: int = 1, size: int = 100, db: Session = Depends(get_db), _:
 
 
 @router.get('/audit/export')
-def export_audit(db: Session = Depends(get_db), _: models.User = Depends(admin_required)):
+def export_audit(db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
     query = db.query(models.AuditLog).order_by(models.AuditLog.timestamp.desc())
     items = query.all()
     si = StringIO()
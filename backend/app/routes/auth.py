@@ -1,56 +1,86 @@
 import os
 from fastapi import APIRouter, Depends, HTTPException, status, Response, Request
 from fastapi.security import OAuth2PasswordRequestForm
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 import pyotp
 
 from app.database import get_db
 from app import models
-from app.auth import create_access_token, create_refresh_token, REFRESH_TOKEN_EXPIRE_DAYS
+from app.auth import create_user_access_token, REFRESH_TOKEN_EXPIRE_DAYS
 from jose import JWTError, jwt
 from app.auth import SECRET_KEY, ALGORITHM
-from app.security import verify_password, hash_password
+from app.security import HasherBusy, get_hasher
+from app.utils import login_throttle, principal_cache, refresh_tokens
+from app.utils.client_ip import client_ip
 
 router = APIRouter()
 
 
+def _find_user(db: Session, username: str, client_ip):
+    # 令牌桶的 flock 与查询都可能阻塞，在线程池中执行
+    login_throttle.check(username, client_ip)
+    return db.query(models.User).filter(models.User.username == username).first()
+
+
 @router.post('/token')
-def login_for_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db), response: Response = None):
-    user = db.query(models.User).filter(models.User.username == form_data.username).first()
+async def login_for_token(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db), response: Response = None):
+    """登录。密码校验在专用的有界执行器中进行（``app.security.PasswordHasher``），
+    不占用处理其他请求的线程池；按用户名与客户端 IP 限制尝试频率。"""
+    try:
+        user = await run_in_threadpool(_find_user, db, form_data.username, client_ip(request))
+    except login_throttle.LoginThrottled as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e), headers={'Retry-After': str(e.retry_after)})
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Incorrect username or password')
 
     raw_password = form_data.password
+    otp = None
     # If 2FA enabled, expect format 'password:otp' from client
     if user.two_factor_enabled:
         if ':' not in raw_password:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='2FA required')
-        pwd, otp = raw_password.split(':', 1)
-        if not verify_password(pwd, user.hashed_password):
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Incorrect username or password')
+        raw_password, otp = raw_password.split(':', 1)
+    try:
+        verified, new_hash = await get_hasher().verify_and_update(raw_password, user.hashed_password)
+    except HasherBusy as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={'Retry-After': str(e.retry_after)})
+    if not verified:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Incorrect username or password')
+    if otp is not None:
         totp = pyotp.TOTP(user.otp_secret)
         if not totp.verify(otp):
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid 2FA code')
-    else:
-        if not verify_password(raw_password, user.hashed_password):
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Incorrect username or password')
+    return await run_in_threadpool(_issue_tokens, db, user, new_hash, response)
 
-    access_token = create_access_token({'sub': user.username})
-    refresh_token, jti, expiry = create_refresh_token({'sub': user.username})
 
+def _issue_tokens(db: Session, user: models.User, new_hash, response: Response):
+    login_throttle.succeeded(user.username)
+    if new_hash is not None:
+        # 迭代次数低于当前配置的旧哈希：随本次登录一并更新
+        user.hashed_password = new_hash
+        db.add(user)
+
+    access_token = create_user_access_token(user)
+    refresh_token = None
     # persist refresh token record
     try:
-        rt = models.RefreshToken(jti=jti, user_id=user.id, expires_at=expiry)
-        db.add(rt)
+        refresh_token, _ = refresh_tokens.issue(db, user)
         db.commit()
     except Exception:
         db.rollback()
 
+    if refresh_token is not None:
+        _set_refresh_cookie(response, refresh_token)
+    return {'access_token': access_token, 'token_type': 'bearer'}
+
+
+def _set_refresh_cookie(response: Response, token: str):
     # Set refresh token as HttpOnly cookie
     secure_cookie = bool(int(os.getenv('SECUREHUB_SECURE_COOKIE', '0')))
     response.set_cookie(
         key='refresh_token',
-        value=refresh_token,
+        value=token,
         httponly=True,
         secure=secure_cookie,
         samesite='lax',
@@ -58,8 +88,6 @@ def login_for_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Sessio
         max_age=REFRESH_TOKEN_EXPIRE_DAYS * 24 * 3600,
     )
 
-    return {'access_token': access_token, 'token_type': 'bearer'}
-
 
 @router.post('/2fa/setup')
 def setup_2fa(db: Session = Depends(get_db), current_user: models.User = Depends(lambda: None)):
@@ -69,7 +97,8 @@ def setup_2fa(db: Session = Depends(get_db), current_user: models.User = Depends
 
 
 @router.post('/token/refresh')
-def refresh_token(request: Request, db: Session = Depends(get_db)):
+def refresh_token(request: Request, response: Response, db: Session = Depends(get_db)):
+    """用刷新令牌换取新的访问令牌，同时轮换刷新令牌（旧 jti 吊销，Cookie 换成新令牌）。"""
     token = request.cookies.get('refresh_token')
     if not token:
         raise HTTPException(status_code=400, detail='refresh_token cookie required')
@@ -86,19 +115,24 @@ def refresh_token(request: Request, db: Session = Depends(get_db)):
     except JWTError:
         raise HTTPException(status_code=401, detail='Invalid refresh token')
 
-    user = db.query(models.User).filter(models.User.username == username).first()
+    uid = payload.get('uid')
+    if uid is not None:
+        def load():
+            user = db.query(models.User).filter(models.User.id == uid).first()
+            return principal_cache.Principal.from_user(user) if user is not None else None
+
+        user = principal_cache.get_cache().get(('uid', uid), load)
+    else:
+        user = db.query(models.User).filter(models.User.username == username).first()
     if not user or not user.is_active:
         raise HTTPException(status_code=401, detail='Invalid user')
 
-    # verify refresh token record exists and not revoked
-    rt = db.query(models.RefreshToken).filter(models.RefreshToken.jti == jti, models.RefreshToken.user_id == user.id).first()
-    if not rt or rt.revoked:
+    # 过期由 JWT 的 exp 校验；是否已吊销由轮换时带条件的 UPDATE 判定
+    rotated = refresh_tokens.rotate(db, jti, user)
+    if rotated is None:
         raise HTTPException(status_code=401, detail='Refresh token revoked')
-    # optional: check expiry
-    if rt.expires_at and rt.expires_at < datetime.utcnow():
-        raise HTTPException(status_code=401, detail='Refresh token expired')
-
-    new_access = create_access_token({'sub': user.username})
+    _set_refresh_cookie(response, rotated[0])
+    new_access = create_user_access_token(user)
     return {'access_token': new_access, 'token_type': 'bearer'}
 
 
@@ -111,11 +145,7 @@ def logout(request: Request, response: Response, db: Session = Depends(get_db)):
             payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
             jti = payload.get('jti')
             if jti:
-                rt = db.query(models.RefreshToken).filter(models.RefreshToken.jti == jti).first()
-                if rt:
-                    rt.revoked = True
-                    db.add(rt)
-                    db.commit()
+                refresh_tokens.revoke(db, jti)
         except Exception:
             db.rollback()
     # clear cookie
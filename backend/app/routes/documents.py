@@ -1,30 +1,56 @@
 from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, BackgroundTasks
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from typing import Optional, List
+import asyncio
+import logging
 import os
-import uuid
-import shutil
 
 from app.database import get_db
 from app import models
 from app.auth import get_current_user
+from app.routes.download import _resolve_deploy_module, _run_render_job
 from app.utils.audit import record_audit
+from app.utils import blob_store, bulk_upload, ingest, principal_cache
 
 router = APIRouter()
 
-DOC_DIR = os.getenv('SECUREHUB_DOC_DIR', os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'documents')))
+DOC_DIR = blob_store.DOC_DIR
 
 
 def ensure_doc_dir():
     os.makedirs(DOC_DIR, exist_ok=True)
 
 
-def is_admin(user: models.User):
+def is_admin(user: principal_cache.Principal):
     return getattr(user, 'is_admin', False)
 
 
+def create_document(db: Session, background_tasks: BackgroundTasks, current_user: principal_cache.Principal, filename: str, tmp_path: str, sha256: str, size: int,
+                    watermark_enabled=True, watermark_text=None, font_size=40, opacity=0.3, linearize=None, resave=None):
+    """把已接收完整、已计算 SHA-256 的文件 ``tmp_path`` 登记为新文档并安排后台入库。
+
+    ``tmp_path`` 会被移入 blob 存储（内容已存在时删除）。普通上传与分块上传共用。
+    """
+    # 入库处理完成（status 变为 ready）之前不可下载
+    doc = models.Document(filename=filename, watermark_enabled=bool(watermark_enabled), watermark_text=watermark_text, font_size=font_size or 40, opacity=str(opacity or 0.3), linearize=linearize, status='pending')
+    try:
+        blob_store.adopt(db, doc, tmp_path, sha256, size)
+    except Exception:
+        blob_store.discard(tmp_path)
+        raise
+    db.refresh(doc)
+    background_tasks.add_task(ingest.ingest_document, doc.id, resave)
+    try:
+        record_audit(db, current_user.id if current_user else None, 'upload_document', object_type='document', object_id=doc.id, detail=doc.filename)
+    except Exception:
+        pass
+    return {'id': doc.id, 'filename': doc.filename, 'status': doc.status}
+
+
 @router.post('/documents/upload')
-def upload_document(file: UploadFile = File(...), watermark_enabled: Optional[bool] = True, watermark_text: Optional[str] = None, font_size: Optional[int] = 40, opacity: Optional[float] = 0.3, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def upload_document(background_tasks: BackgroundTasks, file: UploadFile = File(...), watermark_enabled: Optional[bool] = True, watermark_text: Optional[str] = None, font_size: Optional[int] = 40, opacity: Optional[float] = 0.3, linearize: Optional[bool] = None, resave: Optional[bool] = None, db: Session = Depends(get_db), current_user: principal_cache.Principal = Depends(get_current_user)):
+    """单次 multipart 上传；大文件请使用可续传的分块上传（``/api/uploads``）。"""
     if not is_admin(current_user):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Admin required')
 
@@ -32,37 +58,102 @@ def upload_document(file: UploadFile = File(...), watermark_enabled: Optional[bo
         raise HTTPException(status_code=400, detail='Only PDF uploads allowed')
 
     ensure_doc_dir()
-    # generate safe filename
-    ext = os.path.splitext(file.filename)[1] or '.pdf'
-    stored_name = f"{uuid.uuid4().hex}{ext}"
-    dest_path = os.path.join(DOC_DIR, stored_name)
-
-    # save upload to destination
-    with open(dest_path, 'wb') as out_f:
-        shutil.copyfileobj(file.file, out_f)
-
-    # create DB record
-    doc = models.Document(filename=file.filename, file_path=dest_path, watermark_enabled=bool(watermark_enabled), watermark_text=watermark_text, font_size=font_size or 40, opacity=str(opacity or 0.3))
-    db.add(doc)
-    db.commit()
-    db.refresh(doc)
+    # 边接收边计算 SHA-256，按内容存储：重复上传的相同文件只保存一份
+    sha256, size, tmp_path = blob_store.write_stream(file.file)
+    return create_document(db, background_tasks, current_user, file.filename, tmp_path, sha256, size, watermark_enabled=watermark_enabled, watermark_text=watermark_text,
+                           font_size=font_size, opacity=opacity, linearize=linearize, resave=resave)
+
+
+def _insert_bulk_documents(db: Session, current_user: principal_cache.Principal, staged, settings: dict):
+    """在一个事务中插入批量上传的文档行（已完成入库分析）与审计记录，提交后放入 blob 文件。"""
+    docs = []
     try:
-        record_audit(db, current_user.id if current_user else None, 'upload_document', object_type='document', object_id=doc.id, detail=doc.filename)
+        for entry, tmp_path, info in staged:
+            sha256, size = info['sha256'] or entry['sha256'], info['size'] or entry['size']
+            blob_store.acquire(db, sha256, size)
+            doc = models.Document(filename=entry['filename'], file_path=blob_store.blob_path(sha256), blob_sha256=sha256, **settings)
+            ingest.record_info(doc, info, sha256, size)
+            db.add(doc)
+            docs.append(doc)
+        db.flush()
+        ids = [doc.id for doc in docs]
+        for doc in docs:
+            record_audit(db, current_user.id, 'upload_document', object_type='document', object_id=doc.id, detail=f'{doc.filename} (bulk)', commit=False)
+        db.commit()
     except Exception:
-        pass
-    return {'id': doc.id, 'filename': doc.filename}
+        db.rollback()
+        for _, tmp_path, _ in staged:
+            blob_store.discard(tmp_path)
+        raise
+    for (entry, tmp_path, info), doc_id in zip(staged, ids):
+        blob_store.place(tmp_path, info['sha256'] or entry['sha256'])
+        entry.update(status='created', id=doc_id, page_count=info['page_count'])
+
+
+@router.post('/documents/bulk')
+async def bulk_upload_documents(file: UploadFile = File(...), watermark_enabled: Optional[bool] = True, watermark_text: Optional[str] = None, font_size: Optional[int] = 40, opacity: Optional[float] = 0.3, linearize: Optional[bool] = None, resave: Optional[bool] = None, db: Session = Depends(get_db), current_user: principal_cache.Principal = Depends(get_current_user)):
+    """批量上传 ZIP / tar 归档中的 PDF，所有文件使用相同的水印设置，返回逐个文件的结果。
+
+    成员边读取边写入暂存区，写完一个即交给水印进程池校验（并按设置改写），最多
+    SECUREHUB_BULK_CONCURRENCY 个同时进行；全部完成后在一个事务中插入文档与审计记录。
+    文档创建时已完成入库分析，直接为 ready。
+    """
+    if not is_admin(current_user):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Admin required')
+    ensure_doc_dir()
+    wrapper = _resolve_deploy_module('watermark_wrapper')
+    prepare_options = {'linearize': wrapper.linearize_enabled(linearize), 'resave': ingest.RESAVE if resave is None else bool(resave)}
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max(1, bulk_upload.CONCURRENCY))
+    jobs = []
+
+    async def prepare(tmp_path):
+        async with semaphore:
+            return await _run_render_job(wrapper.prepare_source, tmp_path, **prepare_options)
+
+    def on_staged(entry, tmp_path):
+        # 在读取归档的线程中调用：校验任务交给事件循环调度
+        jobs.append((entry, tmp_path, asyncio.run_coroutine_threadsafe(prepare(tmp_path), loop)))
+
+    try:
+        report = await run_in_threadpool(bulk_upload.stage_archive, file.file, on_staged)
+    except bulk_upload.ArchiveError as e:
+        await asyncio.gather(*(asyncio.wrap_future(future) for _, _, future in jobs), return_exceptions=True)
+        for _, tmp_path, _ in jobs:
+            blob_store.discard(tmp_path)
+        raise HTTPException(status_code=400, detail=str(e))
+
+    staged = []
+    for entry, tmp_path, future in jobs:
+        try:
+            info = await asyncio.wrap_future(future)
+        except Exception as e:
+            entry.update(status='failed', error=str(e) or type(e).__name__)
+            blob_store.discard(tmp_path)
+            continue
+        staged.append((entry, tmp_path, info))
+    if staged:
+        settings = {'watermark_enabled': bool(watermark_enabled), 'watermark_text': watermark_text, 'font_size': font_size or 40, 'opacity': str(opacity or 0.3), 'linearize': linearize}
+        try:
+            await run_in_threadpool(_insert_bulk_documents, db, current_user, staged, settings)
+        except Exception as e:
+            # 整个事务已回滚：没有任何文档被创建
+            logging.getLogger(__name__).exception('Bulk upload insert failed')
+            raise HTTPException(status_code=500, detail=f'Bulk upload failed, no documents were created: {type(e).__name__}')
+    counts = {key: sum(1 for entry in report if entry['status'] == key) for key in ('created', 'failed', 'skipped')}
+    return dict(total=len(report), **counts, files=report)
 
 
 @router.get('/documents')
-def list_documents(page: int = 1, size: int = 50, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def list_documents(page: int = 1, size: int = 50, db: Session = Depends(get_db), current_user: principal_cache.Principal = Depends(get_current_user)):
     query = db.query(models.Document)
     total = query.count()
     items = query.offset((page - 1) * size).limit(size).all()
-    return {'total': total, 'page': page, 'size': size, 'items': [{'id': d.id, 'filename': d.filename, 'watermark_enabled': d.watermark_enabled} for d in items]}
+    return {'total': total, 'page': page, 'size': size, 'items': [{'id': d.id, 'filename': d.filename, 'watermark_enabled': d.watermark_enabled, 'status': d.status} for d in items]}
 
 
 @router.get('/documents/{doc_id}')
-def get_document(doc_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def get_document(doc_id: int, db: Session = Depends(get_db), current_user: principal_cache.Principal = Depends(get_current_user)):
     d = db.query(models.Document).filter(models.Document.id == doc_id).first()
     if not d:
         raise HTTPException(status_code=404, detail='Document not found')
@@ -73,26 +164,31 @@ def get_document(doc_id: int, db: Session = Depends(get_db), current_user: model
         if not access:
             raise HTTPException(status_code=403, detail='Access denied')
 
-    return {'id': d.id, 'filename': d.filename, 'watermark_enabled': d.watermark_enabled, 'watermark_text': d.watermark_text, 'font_size': d.font_size, 'opacity': d.opacity}
+    return {'id': d.id, 'filename': d.filename, 'watermark_enabled': d.watermark_enabled, 'watermark_text': d.watermark_text, 'font_size': d.font_size, 'opacity': d.opacity, 'linearize': d.linearize,
+            'status': d.status, 'page_count': d.page_count, 'file_size': d.file_size, 'sha256': d.sha256, 'ingest_error': d.ingest_error}
 
 
 @router.delete('/documents/{doc_id}')
-def delete_document(doc_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def delete_document(doc_id: int, db: Session = Depends(get_db), current_user: principal_cache.Principal = Depends(get_current_user)):
     if not is_admin(current_user):
         raise HTTPException(status_code=403, detail='Admin required')
     d = db.query(models.Document).filter(models.Document.id == doc_id).first()
     if not d:
         raise HTTPException(status_code=404, detail='Document not found')
-    # remove file
-    try:
-        if os.path.exists(d.file_path):
-            os.remove(d.file_path)
-    except Exception:
-        pass
+    blob_sha256 = d.blob_sha256
+    if blob_sha256 is None:
+        # 独占的旧文件直接删除
+        try:
+            if os.path.exists(d.file_path):
+                os.remove(d.file_path)
+        except Exception:
+            pass
     # remove DB records
     db.query(models.DocumentAccess).filter(models.DocumentAccess.document_id == doc_id).delete()
     db.delete(d)
     db.commit()
+    # 共用的 blob 只在没有其他文档引用时删除
+    blob_store.release(db, blob_sha256)
     try:
         record_audit(db, current_user.id if current_user else None, 'delete_document', object_type='document', object_id=doc_id, detail=d.filename)
     except Exception:
@@ -101,7 +197,7 @@ def delete_document(doc_id: int, db: Session = Depends(get_db), current_user: mo
 
 
 @router.put('/documents/{doc_id}/metadata')
-def set_metadata(doc_id: int, payload: dict, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def set_metadata(doc_id: int, payload: dict, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: principal_cache.Principal = Depends(get_current_user)):
     if not is_admin(current_user):
         raise HTTPException(status_code=403, detail='Admin required')
     d = db.query(models.Document).filter(models.Document.id == doc_id).first()
@@ -115,8 +211,14 @@ def set_metadata(doc_id: int, payload: dict, db: Session = Depends(get_db), curr
         d.font_size = int(payload.get('font_size'))
     if 'opacity' in payload:
         d.opacity = str(payload.get('opacity'))
+    if 'linearize' in payload:
+        # null 恢复为全局设置
+        d.linearize = None if payload.get('linearize') is None else bool(payload.get('linearize'))
     db.add(d)
     db.commit()
+    if 'linearize' in payload:
+        # 重新入库：按新设置改写原文件并更新大小与哈希
+        background_tasks.add_task(ingest.ingest_document, d.id)
     try:
         record_audit(db, current_user.id if current_user else None, 'set_document_metadata', object_type='document', object_id=d.id, detail=str(payload))
     except Exception:
@@ -124,8 +226,24 @@ def set_metadata(doc_id: int, payload: dict, db: Session = Depends(get_db), curr
     return {'ok': True}
 
 
+@router.post('/documents/{doc_id}/ingest')
+def reingest_document(doc_id: int, background_tasks: BackgroundTasks, resave: Optional[bool] = None, db: Session = Depends(get_db), current_user: principal_cache.Principal = Depends(get_current_user)):
+    """重新执行入库处理，例如为入库流程上线之前的文档补充页面几何表，或修复失败的文档。"""
+    if not is_admin(current_user):
+        raise HTTPException(status_code=403, detail='Admin required')
+    d = db.query(models.Document).filter(models.Document.id == doc_id).first()
+    if not d:
+        raise HTTPException(status_code=404, detail='Document not found')
+    background_tasks.add_task(ingest.ingest_document, d.id, resave)
+    try:
+        record_audit(db, current_user.id if current_user else None, 'ingest_document', object_type='document', object_id=d.id, detail=d.filename)
+    except Exception:
+        pass
+    return {'ok': True}
+
+
 @router.post('/documents/{doc_id}/grant')
-def grant_access(doc_id: int, payload: dict, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def grant_access(doc_id: int, payload: dict, db: Session = Depends(get_db), current_user: principal_cache.Principal = Depends(get_current_user)):
     if not is_admin(current_user):
         raise HTTPException(status_code=403, detail='Admin required')
     d = db.query(models.Document).filter(models.Document.id == doc_id).first()
@@ -167,7 +285,7 @@ def grant_access(doc_id: int, payload: dict, db: Session = Depends(get_db), curr
 
 
 @router.post('/documents/{doc_id}/revoke')
-def revoke_access(doc_id: int, payload: dict, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def revoke_access(doc_id: int, payload: dict, db: Session = Depends(get_db), current_user: principal_cache.Principal = Depends(get_current_user)):
     if not is_admin(current_user):
         raise HTTPException(status_code=403, detail='Admin required')
     user_id = payload.get('user_id')
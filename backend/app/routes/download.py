@@ -1,32 +1,198 @@
 from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks, Request
-from fastapi.responses import FileResponse
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
+import collections
+import hashlib
+import json
+import logging
 import os
+import re
 import shutil
+import time
 
 from app.database import get_db
 from app import models
 from app.auth import get_current_user
+from app.utils import admission, ingest, principal_cache, render_cache, single_flight, watermark_template
+from app.utils.client_ip import client_ip as get_client_ip
+from app.utils.streaming import RangeNotSatisfiable, content_disposition, iter_rendered_output, parse_range
 
 
-def _resolve_run_add_watermark():
+def _resolve_deploy_module(name):
     # dynamic import with fallbacks to support different PYTHONPATH/test contexts
-    try:
-        from deploy.watermark_wrapper import run_add_watermark as _fn
-        return _fn
-    except Exception:
-        pass
-    try:
-        from backend.deploy.watermark_wrapper import run_add_watermark as _fn
-        return _fn
-    except Exception:
-        pass
+    import importlib
+    for candidate in (f'deploy.{name}', f'backend.deploy.{name}'):
+        try:
+            return importlib.import_module(candidate)
+        except Exception:
+            pass
     try:
         # last resort: relative import when package context allows
-        from ..deploy.watermark_wrapper import run_add_watermark as _fn
-        return _fn
+        return importlib.import_module(f'..deploy.{name}', package=__package__)
     except Exception:
-        raise ImportError('Could not import watermark wrapper')
+        raise ImportError(f'Could not import deploy.{name}')
+
+
+# 渲染（含排队与缓存查找）超过该毫秒数时记录一条带计量数据的慢渲染日志
+SLOW_RENDER_MS = float(os.getenv('SECUREHUB_WATERMARK_SLOW_MS', '2000'))
+_slow_renders = collections.deque(maxlen=50)
+
+
+def _with_cache_path(output, cache_path, stats=None):
+    # 在渲染计量中记下本次走的缓存路径
+    output.stats = dict(stats if stats is not None else (output.stats or {}), cache=cache_path)
+    return output
+
+
+def _record_render(doc_id, output, elapsed):
+    if elapsed * 1000 < SLOW_RENDER_MS:
+        return
+    entry = {'document_id': doc_id, 'elapsed_ms': round(elapsed * 1000, 1), 'stats': output.stats}
+    _slow_renders.append(entry)
+    logging.getLogger("uvicorn").warning(f"Slow watermark render: {entry}")
+
+
+def slow_renders():
+    """最近的慢渲染记录（新的在后），供 /api/metrics 使用。"""
+    return list(_slow_renders)
+
+
+# 按下载生成的小输出（模板水印的动态层）在内存中保留的份数，PDF 阅读器分段请求时不必重复渲染
+_download_outputs = collections.OrderedDict()
+DOWNLOAD_OUTPUT_CACHE_SIZE = 64
+_DOWNLOAD_OUTPUT_MAX_BYTES = 1024 * 1024
+_ETAG_DOWNLOAD_ID = re.compile(r'^(?:W/)?"[0-9a-f]+-(\d+)"$')
+
+
+def _strong_etag(*parts, download_id=None):
+    """由渲染输入计算强校验 ETag：输入相同则输出字节相同。按下载渲染的输出附带下载日志 ID。"""
+    digest = hashlib.sha256('\x00'.join(str(p) for p in parts).encode('utf-8')).hexdigest()[:32]
+    return f'"{digest}-{download_id}"' if download_id is not None else f'"{digest}"'
+
+
+def _etag_download_id(etag):
+    match = _ETAG_DOWNLOAD_ID.match(etag.strip()) if etag else None
+    return int(match.group(1)) if match else None
+
+
+def _remember_output(output):
+    # 只保留内存中的小输出；前缀文件（源文件或缓存的静态层）仍需存在才可复用
+    if output.path is not None or output.data is None or len(output.data) > _DOWNLOAD_OUTPUT_MAX_BYTES:
+        return
+    _download_outputs[output.etag] = output
+    while len(_download_outputs) > DOWNLOAD_OUTPUT_CACHE_SIZE:
+        _download_outputs.popitem(last=False)
+
+
+def _recall_output(etag):
+    output = _download_outputs.get(etag)
+    if output is None or (output.prefix_path is not None and not os.path.exists(output.prefix_path)):
+        return None
+    _download_outputs.move_to_end(etag)
+    return output
+
+
+def _resolve_render_watermark_output():
+    return _resolve_deploy_module('watermark_wrapper').render_watermark_output
+
+
+def _resolve_watermark_pool():
+    return _resolve_deploy_module('watermark_pool')
+
+
+async def _run_render_job(fn, *args, **kwargs):
+    """在预热进程池中执行渲染任务并等待结果，不占用事件循环与请求线程池。
+
+    进程池未启用（SECUREHUB_WATERMARK_WORKERS=0）时退化为线程池内同步调用。
+    """
+    pool = _resolve_watermark_pool().get_pool()
+    if pool is not None:
+        return await pool.run(fn, *args, **kwargs)
+    return await run_in_threadpool(fn, *args, **kwargs)
+
+
+async def render_watermark(original_path, watermark_text, font_size, opacity, doc_id=None, download_id=None, output_mode=None, geometry=None):
+    """渲染水印，返回可流式读取的 ``RenderedOutput``。"""
+    output = await _run_render_job(_resolve_render_watermark_output(), original_path, watermark_text, font_size, opacity, output_mode=output_mode, geometry=geometry)
+    if doc_id is not None:
+        wrapper = _resolve_deploy_module('watermark_wrapper')
+        source_sha = await run_in_threadpool(render_cache.source_hash, original_path)
+        key = render_cache.render_key(doc_id, source_sha, watermark_text, font_size, opacity, wrapper.engine_version(output_mode=output_mode))
+        output.etag = _strong_etag(key, download_id=download_id)
+    return _with_cache_path(output, 'bypass')
+
+
+async def render_watermark_cached(doc_id, original_path, watermark_text, font_size, opacity, layout_text=None, output_mode=None, geometry=None):
+    """固定水印文本的渲染结果对所有用户相同：命中缓存时不做任何 PDF 处理。
+
+    未命中时同一渲染键只渲染一次：本进程内的并发请求等待同一个任务（'coalesced'），
+    其他 uvicorn 进程通过锁文件等待后直接使用其结果（'peer'）。
+    """
+    wrapper = _resolve_deploy_module('watermark_wrapper')
+    source_sha = await run_in_threadpool(render_cache.source_hash, original_path)
+    key = render_cache.render_key(doc_id, source_sha, watermark_text, font_size, opacity, wrapper.engine_version(output_mode=output_mode), layout_text)
+    # 命中时立即打开：之后的淘汰或失效删除不影响本次响应
+    fd = await run_in_threadpool(render_cache.open_entry, doc_id, key)
+    stats, cache_path = {}, 'hit'
+    if fd is None:
+        async def render():
+            # 持锁后再检查：其他进程可能刚刚渲染完成
+            done = render_cache.entry_path(doc_id, key)
+            if os.path.exists(done):
+                return done, {}, 'peer'
+            job_stats = await _run_render_job(wrapper.render_watermark_to_file, original_path, render_cache.reserve(doc_id, key), watermark_text, font_size, opacity,
+                                              output_mode=output_mode, layout_text=layout_text, geometry=geometry)
+            return await run_in_threadpool(render_cache.stored, doc_id, key), job_stats, 'miss'
+
+        (path, stats, cache_path), follower = await single_flight.run(f'{doc_id}/{key}', render, lock_path=render_cache.lock_path(doc_id, key))
+        if follower:
+            stats, cache_path = {}, 'coalesced'
+        fd = await run_in_threadpool(render_cache.open_file, path)
+        if fd is None:
+            # 刚写入就被淘汰（缓存预算过小）：直接使用一份不缓存的渲染结果
+            output = await _run_render_job(_resolve_render_watermark_output(), original_path, watermark_text, font_size, opacity,
+                                           output_mode=output_mode, layout_text=layout_text, geometry=geometry)
+            output.etag = _strong_etag(key)
+            return _with_cache_path(output, 'evicted', output.stats)
+    output = wrapper.RenderedOutput(path=render_cache.entry_path(doc_id, key), fd=fd, size=os.fstat(fd).st_size, temporary=False)
+    output.etag = _strong_etag(key)
+    return _with_cache_path(output, cache_path, stats)
+
+
+async def render_watermark_template(doc_id, original_path, template, values, font_size, opacity, geometry=None):
+    """含模板变量的水印：静态层按文档缓存，每次下载只在其上叠加动态文本层。
+
+    动态层与静态层（或没有静态行时的源文件）合并后整份重写：不能以增量更新追加，
+    否则截断到第一个 ``%%EOF`` 即可去掉按用户的追溯水印，源文件也不会作为响应的字节
+    前缀流出。渲染缓存关闭时整份渲染替换后的文本。同一次下载的续传请求（相同变量值）
+    直接复用内存中的输出。
+    """
+    static_text, dynamic_template = watermark_template.split_layers(template)
+    if watermark_template.is_blank(static_text):
+        base_path, cache_path = original_path, 'layered-source'
+        base_id = await run_in_threadpool(render_cache.source_hash, original_path)
+    elif render_cache.enabled():
+        base = await render_watermark_cached(doc_id, original_path, static_text, font_size, opacity, layout_text=template, geometry=geometry)
+        base.discard()  # 静态层只作为渲染输入，不直接发送
+        base_path, cache_path, base_id = base.path, f"layered-{base.stats['cache']}", base.etag
+    else:
+        # 按用户的水印不使用增量输出（SECUREHUB_WATERMARK_OUTPUT_MODE=incremental 时同样整份重写）
+        return await render_watermark(original_path, watermark_template.fill(template, values), font_size, opacity,
+                                      doc_id=doc_id, download_id=values['download_id'], output_mode='full', geometry=geometry)
+    wrapper = _resolve_deploy_module('watermark_wrapper')
+    text = watermark_template.fill(dynamic_template, values)
+    etag = _strong_etag(base_id, text, template, float(font_size), float(opacity), wrapper.engine_version(output_mode='full'),
+                        download_id=values['download_id'])
+    output = _recall_output(etag)
+    if output is not None:
+        return _with_cache_path(output, 'download-hit')
+    output = await _run_render_job(wrapper.render_watermark_output, base_path, text, font_size, opacity,
+                                   output_mode='full', layout_text=template, geometry=geometry)
+    output.etag = etag
+    _remember_output(output)
+    return _with_cache_path(output, cache_path)
+
 
 router = APIRouter()
 
@@ -39,8 +205,27 @@ def remove_file(path: str):
         pass
 
 
-@router.get('/documents/{doc_id}/download')
-def download_document(doc_id: int, background_tasks: BackgroundTasks, request: Request, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def _find_resumed_log(db: Session, doc_id: int, current_user: principal_cache.Principal, byte_range, if_range):
+    """判断带 Range 的请求是否为已有下载的续传，返回该次下载的日志（否则返回 None）。
+
+    只有 If-Range 中的 ETag 带有本用户对该文档的下载日志 ID 时才归入那次下载；渲染后
+    ETag 与 If-Range 不一致时调用方按新的下载处理。没有 If-Range 的 Range 请求一律是
+    新的下载（单独记录日志，水印变量取新值）。
+    """
+    if byte_range is None:
+        return None
+    download_id = _etag_download_id(if_range)
+    if download_id is None:
+        return None
+    return db.query(models.DownloadLog).filter(models.DownloadLog.id == download_id, models.DownloadLog.document_id == doc_id,
+                                               models.DownloadLog.user_id == current_user.id).first()
+
+
+def _prepare_download(db: Session, doc_id: int, current_user: principal_cache.Principal, client_ip, byte_range=None, if_range=None):
+    """权限校验并写下载日志，返回渲染所需的纯数据（不再依赖会话中的 ORM 对象）。
+
+    续传请求（见 ``_find_resumed_log``）不再写新日志，沿用原下载的日志与水印变量值。
+    """
     # 查找文档
     doc = db.query(models.Document).filter(models.Document.id == doc_id).first()
     if not doc:
@@ -51,26 +236,143 @@ def download_document(doc_id: int, background_tasks: BackgroundTasks, request: R
     if not access:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Access denied')
 
+    # 入库处理（见 app.utils.ingest）完成前不可下载；入库流程上线之前的文档 status 为 ready
+    if doc.status == 'pending':
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Document is still being processed', headers={'Retry-After': '5'})
+    if doc.status == 'failed':
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'Document failed processing: {doc.ingest_error}')
+
     original_path = doc.file_path
     if not os.path.exists(original_path):
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='Source file missing')
 
-    # 记录下载日志（先写入，成功/失败都记录）
-    log = models.DownloadLog(user_id=current_user.id, document_id=doc.id, client_ip=request.client.host if request.client else None)
-    db.add(log)
-    db.commit()
+    info = {
+        'filename': doc.filename,
+        'original_path': original_path,
+        'watermark_enabled': doc.watermark_enabled,
+        'watermark_text': doc.watermark_text or watermark_template.DEFAULT_TEMPLATE,
+        'font_size': doc.font_size or 40,
+        'opacity': float(doc.opacity or 0.3),
+        'linearize': _resolve_deploy_module('watermark_wrapper').linearize_enabled(doc.linearize),
+        'geometry': json.loads(doc.geometry) if doc.geometry else None,
+        'sha256': doc.sha256,
+    }
 
-    # 如果需要水印，调用 wrapper 生成临时文件
-    if doc.watermark_enabled:
-        watermark_text = doc.watermark_text or f"{current_user.username}"  # 简单示例
-        try:
-            run_fn = _resolve_run_add_watermark()
-            tmp_path = run_fn(original_path, watermark_text, doc.font_size or 40, float(doc.opacity or 0.3))
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f'Watermark failed: {str(e)}')
+    log = _find_resumed_log(db, doc_id, current_user, byte_range, if_range)
+    info['resumed'] = log is not None
+    if log is None:
+        # 记录下载日志（先写入，成功/失败都记录）
+        log = models.DownloadLog(user_id=current_user.id, document_id=doc.id, client_ip=client_ip)
+        db.add(log)
+        db.commit()
+    info['watermark_values'] = {
+        'username': current_user.username,
+        'user_id': current_user.id,
+        'client_ip': log.client_ip or '',
+        'timestamp': log.timestamp.strftime('%Y-%m-%d %H:%M:%S UTC'),
+        'download_id': log.id,
+    }
+    return info
 
-        background_tasks.add_task(remove_file, tmp_path)
-        return FileResponse(path=tmp_path, filename=doc.filename, media_type='application/pdf')
-    else:
+
+async def _render_download(doc_id, info):
+    """返回本次下载的 ``RenderedOutput``（已设置 ETag）。"""
+    wrapper = _resolve_deploy_module('watermark_wrapper')
+    if not info['watermark_enabled']:
         # 直接返回原始文件，但注意该路径应对 nginx 隐藏，不可被外部直接访问
-        return FileResponse(path=original_path, filename=doc.filename, media_type='application/pdf')
+        if info['linearize']:
+            # 开启全局设置之前上传的文件：本次按原样返回，由调用方排队重新入库线性化
+            # （下载是只读路径，不改写存储的文件；入库会同时更新哈希、大小与页面几何表）
+            try:
+                info['reingest'] = not await run_in_threadpool(wrapper.source_is_linearized, info['original_path'])
+            except Exception as e:
+                logging.getLogger("uvicorn").warning(f"Checking linearization of document {doc_id} failed: {e}")
+        source_sha = await run_in_threadpool(render_cache.source_hash, info['original_path'])
+        output = wrapper.RenderedOutput(data=b'', prefix_path=info['original_path'], size=os.path.getsize(info['original_path']), temporary=False)
+        output.etag = _strong_etag('original', source_sha)
+        return output
+
+    # 如果需要水印，交给水印进程池渲染（或命中渲染缓存），结果直接流式返回（不落系统临时目录）
+    began = time.perf_counter()
+    output_mode = wrapper.output_mode_for(info['linearize'])
+    geometry = info['geometry']
+    try:
+        # 入库后源文件被替换时不再使用记录的页面几何表（哈希按文件 size/mtime 记忆，不会重复读取）
+        if geometry is not None and await run_in_threadpool(render_cache.source_hash, info['original_path']) != info['sha256']:
+            geometry = None
+        if watermark_template.has_placeholders(info['watermark_text']) and info['linearize']:
+            # 分层渲染的动态层以增量更新追加，会使线性化失效，因此每次下载整份渲染
+            output = await render_watermark(info['original_path'], watermark_template.fill(info['watermark_text'], info['watermark_values']), info['font_size'], info['opacity'],
+                                            doc_id=doc_id, download_id=info['watermark_values']['download_id'], output_mode=output_mode, geometry=geometry)
+        elif watermark_template.has_placeholders(info['watermark_text']):
+            output = await render_watermark_template(doc_id, info['original_path'], info['watermark_text'], info['watermark_values'], info['font_size'], info['opacity'],
+                                                     geometry=geometry)
+        elif render_cache.enabled():
+            # 固定水印文本的输出对所有用户相同，可以缓存
+            output = await render_watermark_cached(doc_id, info['original_path'], info['watermark_text'], info['font_size'], info['opacity'], output_mode=output_mode,
+                                                   geometry=geometry)
+        else:
+            output = await render_watermark(info['original_path'], info['watermark_text'], info['font_size'], info['opacity'], doc_id=doc_id, output_mode=output_mode,
+                                            geometry=geometry)
+    except MemoryError as e:
+        # 超出 SECUREHUB_WATERMARK_MAX_JOB_MB：渲染任务被中止，工作进程仍然可用；与准入控制一样按过载处理
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f'Watermark failed: {str(e)}',
+                            headers={'Retry-After': str(admission.get_scheduler().retry_after())})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'Watermark failed: {str(e)}')
+    _record_render(doc_id, output, time.perf_counter() - began)
+    return output
+
+
+@router.get('/documents/{doc_id}/download')
+async def download_document(doc_id: int, background_tasks: BackgroundTasks, request: Request, db: Session = Depends(get_db), current_user: principal_cache.Principal = Depends(get_current_user)):
+    """下载文档，支持单段 Range / If-Range（206 部分内容）与强校验 ETag。
+
+    续传请求沿用原下载的日志与水印变量，输出字节与原响应一致；If-Range 不匹配时
+    按新的完整下载处理（记录新日志并返回 200）。
+
+    权限校验、写日志与渲染受准入控制（``app.utils.admission``）限制并发，超出等待
+    队列或排队超时返回 503 + Retry-After；流式发送响应时不占用名额。
+    """
+    client_ip = get_client_ip(request)
+    byte_range = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    try:
+        async with admission.get_scheduler().slot():
+            info = await run_in_threadpool(_prepare_download, db, doc_id, current_user, client_ip, byte_range, if_range)
+            # 渲染期间不占用数据库连接（会话之后仍可再次使用）
+            db.close()
+            output = await _render_download(doc_id, info)
+
+            if byte_range is not None and if_range is not None and if_range.strip() != output.etag:
+                # 表示已变化（或为 HTTP 日期形式，无法强校验）：忽略 Range，发送完整内容
+                byte_range = None
+                if info['resumed']:
+                    output.discard()
+                    info = await run_in_threadpool(_prepare_download, db, doc_id, current_user, client_ip)
+                    db.close()
+                    output = await _render_download(doc_id, info)
+    except admission.AdmissionRejected as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={'Retry-After': str(e.retry_after)})
+    if info.get('reingest'):
+        ingest.queue_reingest(background_tasks, doc_id)
+
+    headers = {
+        'Content-Disposition': content_disposition(info['filename']),
+        'Accept-Ranges': 'bytes',
+        'ETag': output.etag,
+    }
+    try:
+        span = parse_range(byte_range, output.size)
+    except RangeNotSatisfiable:
+        output.discard()
+        headers['Content-Range'] = f'bytes */{output.size}'
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+    if span is None:
+        headers['Content-Length'] = str(output.size)
+        return StreamingResponse(iter_rendered_output(output), media_type='application/pdf', headers=headers)
+    start, end = span
+    headers['Content-Range'] = f'bytes {start}-{end}/{output.size}'
+    headers['Content-Length'] = str(end - start + 1)
+    return StreamingResponse(iter_rendered_output(output, start=start, end=end), status_code=status.HTTP_206_PARTIAL_CONTENT,
+                             media_type='application/pdf', headers=headers)
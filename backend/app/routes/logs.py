@@ -5,11 +5,12 @@ from typing import Optional
 from app.database import get_db
 from app import models
 from app.auth import get_current_user
+from app.utils import principal_cache
 
 router = APIRouter()
 
 
-def admin_required(user: models.User = Depends(get_current_user)):
+def admin_required(user: principal_cache.Principal = Depends(get_current_user)):
     if not getattr(user, 'is_admin', False):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Admin required')
     return user
@@ -25,7 +26,7 @@ def list_logs(
     page: int = 1,
     size: int = 50,
     db: Session = Depends(get_db),
-    _: models.User = Depends(admin_required),
+    _: principal_cache.Principal = Depends(admin_required),
 ):
     # join to get username and filename
     query = db.query(models.DownloadLog, models.User.username, models.Document.filename).join(models.User, models.DownloadLog.user_id == models.User.id).join(models.Document, models.DownloadLog.document_id == models.Document.id)
@@ -76,7 +77,7 @@ def export_logs(
     start_ts: Optional[str] = Query(None),
     end_ts: Optional[str] = Query(None),
     db: Session = Depends(get_db),
-    _: models.User = Depends(admin_required),
+    _: principal_cache.Principal = Depends(admin_required),
 ):
     # prepare query (reuse filters from list_logs)
     query = db.query(models.DownloadLog, models.User.username, models.Document.filename).join(models.User, models.DownloadLog.user_id == models.User.id).join(models.Document, models.DownloadLog.document_id == models.Document.id)
@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Depends
+
+from app.auth import get_current_admin_user
+from app.security import get_hasher
+from app.routes.download import _resolve_watermark_pool, slow_renders
+from app.utils import admission, principal_cache, render_cache, single_flight
+
+router = APIRouter()
+
+
+@router.get('/metrics')
+def get_metrics(_: principal_cache.Principal = Depends(get_current_admin_user)):
+    """Per-process counters for capacity planning (each uvicorn worker reports its own)."""
+    pool = _resolve_watermark_pool().get_pool()
+    return {
+        'render_cache': render_cache.stats(),
+        'watermark_pool': pool.stats() if pool is not None else None,
+        'slow_renders': slow_renders(),
+        'download_admission': admission.stats(),
+        'single_flight': single_flight.stats(),
+        'principal_cache': principal_cache.stats(),
+        'password_hasher': get_hasher().stats(),
+    }
@@ -0,0 +1,110 @@
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Request
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from app.database import get_db
+from app import models
+from app.auth import get_current_admin_user
+from app.routes.documents import create_document, ensure_doc_dir
+from app.utils import chunked_upload, principal_cache
+from app.utils.chunked_upload import UploadError
+
+router = APIRouter()
+
+# 随上传登记、完成时传给 create_document 的文档设置
+_OPTIONS = ('watermark_enabled', 'watermark_text', 'font_size', 'opacity', 'linearize', 'resave')
+
+
+def _validate_options(payload: dict) -> dict:
+    """取出并校验文档设置（与普通上传的参数类型一致），无效时返回 400。"""
+    options = {key: payload[key] for key in _OPTIONS if key in payload}
+    for key in ('watermark_enabled', 'linearize', 'resave'):
+        if options.get(key) is not None and not isinstance(options[key], bool):
+            raise HTTPException(status_code=400, detail=f'{key} must be a boolean or null')
+    if options.get('watermark_text') is not None and not isinstance(options['watermark_text'], str):
+        raise HTTPException(status_code=400, detail='watermark_text must be a string or null')
+    font_size = options.get('font_size')
+    if font_size is not None and (isinstance(font_size, bool) or not isinstance(font_size, int) or font_size <= 0):
+        raise HTTPException(status_code=400, detail='font_size must be a positive integer')
+    opacity = options.get('opacity')
+    if opacity is not None and (isinstance(opacity, bool) or not isinstance(opacity, (int, float)) or not 0 <= opacity <= 1):
+        raise HTTPException(status_code=400, detail='opacity must be a number between 0 and 1')
+    return options
+
+
+def _load(upload_id: str, user: principal_cache.Principal):
+    try:
+        return chunked_upload.load(upload_id, user.id)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+
+@router.post('/uploads')
+def initiate_upload(payload: dict, current_user: principal_cache.Principal = Depends(get_current_admin_user)):
+    """开始一次可续传的分块上传：``{"filename", "size", "sha256"?, 文档设置...}``。
+
+    之后按返回的 ``chunk_size`` 切块，``PUT /uploads/{id}?offset=N`` 逐块上传（请求头
+    ``X-Chunk-SHA256`` 为该块的 SHA-256），中断后 ``GET /uploads/{id}`` 查看已收到的块，
+    只重传缺少的块，最后 ``POST /uploads/{id}/complete`` 创建文档。
+    """
+    filename = payload.get('filename') or ''
+    if not filename.lower().endswith('.pdf'):
+        raise HTTPException(status_code=400, detail='Only PDF uploads allowed')
+    options = _validate_options(payload)
+    ensure_doc_dir()
+    try:
+        meta = chunked_upload.create(current_user.id, filename, payload.get('size'), sha256=payload.get('sha256'), options=options)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    return chunked_upload.status(meta)
+
+
+@router.get('/uploads/{upload_id}')
+def get_upload(upload_id: str, current_user: principal_cache.Principal = Depends(get_current_admin_user)):
+    return chunked_upload.status(_load(upload_id, current_user))
+
+
+@router.put('/uploads/{upload_id}')
+async def put_chunk(upload_id: str, offset: int, request: Request, db: Session = Depends(get_db), current_user: principal_cache.Principal = Depends(get_current_admin_user)):
+    """上传一块：请求体为原始字节，逐段在线程池中写入暂存文件并计算校验和，不阻塞事件循环。"""
+    meta = await run_in_threadpool(_load, upload_id, current_user)
+    # 接收请求体期间不占用数据库连接
+    db.close()
+    try:
+        index = await chunked_upload.write_chunk(meta, offset, request.stream(), request.headers.get('x-chunk-sha256'))
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    return {'index': index, 'offset': offset, 'received_bytes': (await run_in_threadpool(chunked_upload.status, meta))['received_bytes']}
+
+
+@router.post('/uploads/{upload_id}/complete')
+async def complete_upload(upload_id: str, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: principal_cache.Principal = Depends(get_current_admin_user)):
+    """确认所有块都已收到，把拼好的文件交给普通上传的建档流程（内容寻址存储 + 后台入库）。
+
+    同一上传只有一个 complete 请求能进入建档，并发的其他请求返回 409；失败时释放，可以重试。
+    """
+    meta = await run_in_threadpool(_load, upload_id, current_user)
+    # 早期登记的上传没有校验过设置
+    options = _validate_options(meta['options'])
+    try:
+        await run_in_threadpool(chunked_upload.claim, meta)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    try:
+        sha256, size, data_path = await run_in_threadpool(chunked_upload.assemble, meta)
+        result = await run_in_threadpool(create_document, db, background_tasks, current_user, meta['filename'], data_path, sha256, size, **options)
+    except UploadError as e:
+        await run_in_threadpool(chunked_upload.release, meta)
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except Exception:
+        await run_in_threadpool(chunked_upload.release, meta)
+        raise
+    await run_in_threadpool(chunked_upload.remove, upload_id)
+    return result
+
+
+@router.delete('/uploads/{upload_id}')
+def abort_upload(upload_id: str, current_user: principal_cache.Principal = Depends(get_current_admin_user)):
+    _load(upload_id, current_user)
+    chunked_upload.remove(upload_id)
+    return {'ok': True}
@@ -1,14 +1,16 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from typing import Optional, List
 import pyotp
 
 from app.database import get_db
 from app import models
-from app.auth import get_current_user, get_current_admin_user
+from app.auth import get_current_user, get_current_admin_user, get_current_user_record, revoke_user_tokens
 from app.utils.audit import record_audit
-from app.security import hash_password, verify_password
+from app.utils import principal_cache, refresh_tokens
+from app.security import HasherBusy, get_hasher
 
 router = APIRouter()
 
@@ -23,15 +25,34 @@ class OTPIn(BaseModel):
     code: str
 
 
-def admin_required(user: models.User = Depends(get_current_admin_user)):
+def admin_required(user: principal_cache.Principal = Depends(get_current_admin_user)):
     return user
 
 
+async def _hash_password(password: str) -> str:
+    # 与登录校验共用专用的密码哈希执行器，不占用请求线程池
+    try:
+        return await get_hasher().hash(password)
+    except HasherBusy as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={'Retry-After': str(e.retry_after)})
+
+
 @router.post('/users', status_code=201)
-def create_user(payload: CreateUserIn, db: Session = Depends(get_db), _: models.User = Depends(admin_required)):
-    if db.query(models.User).filter(models.User.username == payload.username).first():
+async def create_user(payload: CreateUserIn, db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
+    if await run_in_threadpool(_find_username, db, payload.username):
+        raise HTTPException(status_code=400, detail='User exists')
+    hashed = await _hash_password(payload.password)
+    return await run_in_threadpool(_create_user, db, payload, hashed, _)
+
+
+def _find_username(db: Session, username: str):
+    return db.query(models.User.id).filter(models.User.username == username).first()
+
+
+def _create_user(db: Session, payload: CreateUserIn, hashed: str, _: principal_cache.Principal):
+    if _find_username(db, payload.username):
         raise HTTPException(status_code=400, detail='User exists')
-    u = models.User(username=payload.username, hashed_password=hash_password(payload.password), is_active=True, is_admin=payload.is_admin)
+    u = models.User(username=payload.username, hashed_password=hashed, is_active=True, is_admin=payload.is_admin)
     db.add(u)
     db.commit()
     db.refresh(u)
@@ -44,7 +65,7 @@ def create_user(payload: CreateUserIn, db: Session = Depends(get_db), _: models.
 
 
 @router.get('/users')
-def list_users(q: Optional[str] = Query(None), page: int = 1, size: int = 50, db: Session = Depends(get_db), _: models.User = Depends(admin_required)):
+def list_users(q: Optional[str] = Query(None), page: int = 1, size: int = 50, db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
     query = db.query(models.User)
     if q:
         query = query.filter(models.User.username.ilike(f"%{q}%"))
@@ -54,7 +75,7 @@ def list_users(q: Optional[str] = Query(None), page: int = 1, size: int = 50, db
 
 
 @router.get('/users/{user_id}')
-def get_user(user_id: int, db: Session = Depends(get_db), _: models.User = Depends(admin_required)):
+def get_user(user_id: int, db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
     u = db.query(models.User).filter(models.User.id == user_id).first()
     if not u:
         raise HTTPException(status_code=404, detail='User not found')
@@ -62,16 +83,21 @@ def get_user(user_id: int, db: Session = Depends(get_db), _: models.User = Depen
 
 
 @router.put('/users/{user_id}/active')
-def set_active(user_id: int, body: dict, db: Session = Depends(get_db), _: models.User = Depends(admin_required)):
+def set_active(user_id: int, body: dict, db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
     u = db.query(models.User).filter(models.User.id == user_id).first()
     if not u:
         raise HTTPException(status_code=404, detail='User not found')
     val = body.get('active')
     if val is None:
         raise HTTPException(status_code=400, detail='active required')
+    if u.is_active and not val:
+        # 停用即注销全部会话：重新启用后旧的刷新令牌也不能再换取访问令牌
+        revoke_user_tokens(u)
+        refresh_tokens.revoke_all(db, u.id)
     u.is_active = bool(val)
     db.add(u)
     db.commit()
+    principal_cache.invalidate(u.id)
     try:
         record_audit(db, _.id if _ else None, 'set_active', object_type='user', object_id=u.id, detail=str(u.is_active))
     except Exception:
@@ -80,16 +106,20 @@ def set_active(user_id: int, body: dict, db: Session = Depends(get_db), _: model
 
 
 @router.put('/users/{user_id}/admin')
-def set_admin(user_id: int, body: dict, db: Session = Depends(get_db), _: models.User = Depends(admin_required)):
+def set_admin(user_id: int, body: dict, db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
     u = db.query(models.User).filter(models.User.id == user_id).first()
     if not u:
         raise HTTPException(status_code=404, detail='User not found')
     val = body.get('is_admin')
     if val is None:
         raise HTTPException(status_code=400, detail='is_admin required')
+    if bool(u.is_admin) != bool(val):
+        # 令牌中的管理员声明已过时
+        revoke_user_tokens(u)
     u.is_admin = bool(val)
     db.add(u)
     db.commit()
+    principal_cache.invalidate(u.id)
     try:
         record_audit(db, _.id if _ else None, 'set_admin', object_type='user', object_id=u.id, detail=str(u.is_admin))
     except Exception:
@@ -97,13 +127,59 @@ def set_admin(user_id: int, body: dict, db: Session = Depends(get_db), _: models
     return {'ok': True}
 
 
+@router.put('/users/{user_id}/password')
+async def reset_password(user_id: int, body: dict, db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
+    password = body.get('password')
+    if not password:
+        raise HTTPException(status_code=400, detail='password required')
+    hashed = await _hash_password(password)
+    return await run_in_threadpool(_reset_password, db, user_id, hashed, _)
+
+
+def _reset_password(db: Session, user_id: int, hashed: str, _: principal_cache.Principal):
+    u = db.query(models.User).filter(models.User.id == user_id).first()
+    if not u:
+        raise HTTPException(status_code=404, detail='User not found')
+    u.hashed_password = hashed
+    # 已签发的访问令牌与刷新令牌随之失效
+    revoke_user_tokens(u)
+    refresh_tokens.revoke_all(db, u.id)
+    db.add(u)
+    db.commit()
+    principal_cache.invalidate(u.id)
+    try:
+        record_audit(db, _.id if _ else None, 'reset_password', object_type='user', object_id=u.id, detail=u.username)
+    except Exception:
+        pass
+    return {'ok': True}
+
+
+@router.delete('/users/{user_id}/sessions')
+def revoke_sessions(user_id: int, db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
+    """注销用户的所有会话：一条语句吊销全部刷新令牌，并使已签发的访问令牌失效。"""
+    u = db.query(models.User).filter(models.User.id == user_id).first()
+    if not u:
+        raise HTTPException(status_code=404, detail='User not found')
+    revoked = refresh_tokens.revoke_all(db, u.id)
+    revoke_user_tokens(u)
+    db.add(u)
+    db.commit()
+    principal_cache.invalidate(u.id)
+    try:
+        record_audit(db, _.id if _ else None, 'revoke_sessions', object_type='user', object_id=u.id, detail=f'{u.username}: {revoked} refresh tokens')
+    except Exception:
+        pass
+    return {'revoked': revoked}
+
+
 @router.delete('/users/{user_id}', status_code=204)
-def delete_user(user_id: int, db: Session = Depends(get_db), _: models.User = Depends(admin_required)):
+def delete_user(user_id: int, db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
     u = db.query(models.User).filter(models.User.id == user_id).first()
     if not u:
         raise HTTPException(status_code=404, detail='User not found')
     db.delete(u)
     db.commit()
+    principal_cache.invalidate(user_id)
     try:
         record_audit(db, _.id if _ else None, 'delete_user', object_type='user', object_id=u.id, detail=u.username)
     except Exception:
@@ -112,12 +188,12 @@ def delete_user(user_id: int, db: Session = Depends(get_db), _: models.User = De
 
 
 @router.get('/users/me')
-def me(current_user: models.User = Depends(get_current_user)):
+def me(current_user: models.User = Depends(get_current_user_record)):
     return {'id': current_user.id, 'username': current_user.username, 'is_active': current_user.is_active, 'two_factor_enabled': current_user.two_factor_enabled}
 
 
 @router.post('/users/me/2fa/start')
-def start_2fa(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def start_2fa(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user_record)):
     # generate secret and store it temporarily
     secret = pyotp.random_base32()
     current_user.otp_secret = secret
@@ -129,7 +205,7 @@ def start_2fa(db: Session = Depends(get_db), current_user: models.User = Depends
 
 
 @router.post('/users/me/2fa/verify')
-def verify_2fa(body: OTPIn, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def verify_2fa(body: OTPIn, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user_record)):
     if not current_user.otp_secret:
         raise HTTPException(status_code=400, detail='2FA not initiated')
     totp = pyotp.TOTP(current_user.otp_secret)
@@ -138,11 +214,12 @@ def verify_2fa(body: OTPIn, db: Session = Depends(get_db), current_user: models.
     current_user.two_factor_enabled = True
     db.add(current_user)
     db.commit()
+    principal_cache.invalidate(current_user.id)
     return {'ok': True}
 
 
 @router.post('/users/me/2fa/disable')
-def disable_2fa(body: OTPIn, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def disable_2fa(body: OTPIn, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user_record)):
     if not current_user.two_factor_enabled or not current_user.otp_secret:
         raise HTTPException(status_code=400, detail='2FA not enabled')
     totp = pyotp.TOTP(current_user.otp_secret)
@@ -152,11 +229,12 @@ def disable_2fa(body: OTPIn, db: Session = Depends(get_db), current_user: models
     current_user.otp_secret = None
     db.add(current_user)
     db.commit()
+    principal_cache.invalidate(current_user.id)
     return {'ok': True}
 
 
 @router.post('/groups', status_code=201)
-def create_group(payload: dict, db: Session = Depends(get_db), _: models.User = Depends(admin_required)):
+def create_group(payload: dict, db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
     name = payload.get('name')
     if not name:
         raise HTTPException(status_code=400, detail='name required')
@@ -170,7 +248,7 @@ def create_group(payload: dict, db: Session = Depends(get_db), _: models.User =
 
 
 @router.get('/groups')
-def list_groups(db: Session = Depends(get_db), _: models.User = Depends(admin_required)):
+def list_groups(db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
     groups = db.query(models.Group).all()
     items = []
     for g in groups:
@@ -179,7 +257,7 @@ def list_groups(db: Session = Depends(get_db), _: models.User = Depends(admin_re
 
 
 @router.post('/groups/{group_id}/add_user')
-def add_user_to_group(group_id: int, payload: dict, db: Session = Depends(get_db), _: models.User = Depends(admin_required)):
+def add_user_to_group(group_id: int, payload: dict, db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
     user_id = payload.get('user_id')
     if not user_id:
         raise HTTPException(status_code=400, detail='user_id required')
@@ -200,7 +278,7 @@ def add_user_to_group(group_id: int, payload: dict, db: Session = Depends(get_db
 
 
 @router.post('/groups/{group_id}/remove_user')
-def remove_user_from_group(group_id: int, payload: dict, db: Session = Depends(get_db), _: models.User = Depends(admin_required)):
+def remove_user_from_group(group_id: int, payload: dict, db: Session = Depends(get_db), _: principal_cache.Principal = Depends(admin_required)):
     user_id = payload.get('user_id')
     if not user_id:
         raise HTTPException(status_code=400, detail='user_id required')
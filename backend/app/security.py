@@ -1,7 +1,23 @@
+import asyncio
+import concurrent.futures
+import math
+import os
+import threading
+import time
+
 from passlib.context import CryptContext
+from starlette.concurrency import run_in_threadpool
+
+# pbkdf2_sha256 的迭代次数（passlib 1.7 默认 29000）；低于该值的哈希在下次登录成功时透明重算
+ROUNDS = int(os.getenv('SECUREHUB_PBKDF2_ROUNDS', '29000'))
+# 专用于密码哈希/校验的线程数（pbkdf2 计算时释放 GIL），默认为一半 CPU；0 表示沿用请求的线程池
+WORKERS = int(os.getenv('SECUREHUB_PASSWORD_WORKERS', str(max(1, (os.cpu_count() or 1) // 2))))
+# 等待哈希线程的任务数上限，超出时登录返回 503 + Retry-After
+MAX_QUEUE = int(os.getenv('SECUREHUB_PASSWORD_QUEUE', '64'))
 
 # Use pbkdf2_sha256 to avoid bcrypt binary/backend issues on some platforms
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto",
+                           pbkdf2_sha256__default_rounds=ROUNDS, pbkdf2_sha256__min_rounds=ROUNDS)
 
 
 def hash_password(password: str) -> str:
@@ -10,3 +26,92 @@ def hash_password(password: str) -> str:
 
 def verify_password(plain: str, hashed: str) -> bool:
     return pwd_context.verify(plain, hashed)
+
+
+class HasherBusy(Exception):
+    """哈希队列已满：``retry_after`` 为建议客户端等待的秒数。"""
+
+    def __init__(self, retry_after):
+        super().__init__('Too many concurrent logins')
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    """有界的专用密码哈希执行器，登录高峰时不占用处理下载与列表的线程池。"""
+
+    def __init__(self, workers=WORKERS, queue_limit=MAX_QUEUE):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        # 单次计算耗时（秒）的指数滑动平均，用于估算 Retry-After
+        self._cost = None
+        self._counters = {'verified': 0, 'hashed': 0, 'rehashed': 0, 'rejected': 0}
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='securehub-password')
+            return self._executor
+
+    def retry_after(self):
+        cost = self._cost if self._cost is not None else 0.05
+        return max(1, math.ceil(cost * (self._pending + 1) / max(self.workers, 1)))
+
+    async def _run(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.workers + self.queue_limit:
+                self._counters['rejected'] += 1
+                raise HasherBusy(self.retry_after())
+            self._pending += 1
+        began = time.perf_counter()
+        try:
+            if self.workers > 0:
+                return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+            return await run_in_threadpool(fn, *args)
+        finally:
+            elapsed = time.perf_counter() - began
+            with self._lock:
+                self._pending -= 1
+                self._cost = elapsed if self._cost is None else 0.8 * self._cost + 0.2 * elapsed
+
+    async def verify_and_update(self, plain, hashed):
+        """校验密码；成功且哈希低于当前配置时返回新哈希：``(是否通过, 新哈希或 None)``。"""
+        ok, new_hash = await self._run(pwd_context.verify_and_update, plain, hashed)
+        with self._lock:
+            self._counters['verified'] += 1
+            if new_hash is not None:
+                self._counters['rehashed'] += 1
+        return ok, new_hash
+
+    async def hash(self, plain):
+        result = await self._run(pwd_context.hash, plain)
+        with self._lock:
+            self._counters['hashed'] += 1
+        return result
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._counters)
+            data.update({
+                'workers': self.workers,
+                'queue_limit': self.queue_limit,
+                'pending': self._pending,
+                'rounds': ROUNDS,
+                'cost_ms_avg': self._cost * 1000 if self._cost is not None else None,
+            })
+        return data
+
+
+_hasher = PasswordHasher()
+
+
+def get_hasher():
+    return _hasher
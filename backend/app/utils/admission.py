@@ -0,0 +1,130 @@
+import asyncio
+import collections
+import contextlib
+import math
+import os
+import time
+
+# 同时处理（权限校验 + 写日志 + 渲染）的下载数；0 表示不限制
+MAX_CONCURRENT = int(os.getenv('SECUREHUB_DOWNLOAD_CONCURRENCY', '8'))
+# 等待队列长度，队列满时直接拒绝（503 + Retry-After）
+MAX_QUEUE = int(os.getenv('SECUREHUB_DOWNLOAD_QUEUE', '32'))
+# 在队列中最多等待的秒数，超时同样拒绝
+QUEUE_TIMEOUT = float(os.getenv('SECUREHUB_DOWNLOAD_QUEUE_TIMEOUT', '30'))
+
+_WAIT_SAMPLES = 1000
+
+
+class AdmissionRejected(Exception):
+    """下载未被接纳：``retry_after`` 为建议客户端等待的秒数。"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class DownloadScheduler:
+    """下载准入控制：有界并发 + 有界 FIFO 等待队列。
+
+    只在事件循环中使用，不占用线程池；排队的请求不持有数据库会话。释放名额时直接
+    交给队首的等待者，后来的请求不会插队。
+    """
+
+    def __init__(self, limit=MAX_CONCURRENT, queue_limit=MAX_QUEUE, queue_timeout=QUEUE_TIMEOUT):
+        self.limit = limit
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters = collections.deque()
+        # 最近的排队等待时间（秒），以及名额占用时间的指数滑动平均
+        self._waits = collections.deque(maxlen=_WAIT_SAMPLES)
+        self._hold = None
+        self._counters = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timeouts': 0}
+
+    def retry_after(self):
+        """按当前队列深度与平均占用时间估算的重试等待秒数。"""
+        hold = self._hold if self._hold is not None else 1.0
+        return max(1, math.ceil(hold * (len(self._waiters) + 1) / max(self.limit, 1)))
+
+    async def acquire(self):
+        """取得一个名额，返回排队等待的秒数；无法接纳时抛出 ``AdmissionRejected``。"""
+        began = time.perf_counter()
+        if self.limit > 0 and (self.active >= self.limit or self._waiters):
+            if len(self._waiters) >= self.queue_limit:
+                self._counters['rejected'] += 1
+                raise AdmissionRejected('Download queue is full', self.retry_after())
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            self._counters['queued'] += 1
+            try:
+                await asyncio.wait_for(waiter, self.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+                if waiter.done() and not waiter.cancelled():
+                    # 名额已经交给了本请求：转交给下一个等待者
+                    self._release()
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                if isinstance(exc, asyncio.TimeoutError):
+                    self._counters['timeouts'] += 1
+                    raise AdmissionRejected('Timed out waiting for a download slot', self.retry_after())
+                raise
+        else:
+            self.active += 1
+        waited = time.perf_counter() - began
+        self._waits.append(waited)
+        self._counters['admitted'] += 1
+        return waited
+
+    def _release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # 名额直接转交，active 不变
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def release(self, held=None):
+        if held is not None:
+            self._hold = held if self._hold is None else 0.8 * self._hold + 0.2 * held
+        self._release()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - began)
+
+    def stats(self):
+        waits = sorted(self._waits)
+
+        def pct(p):
+            return waits[max(0, math.ceil(len(waits) * p / 100) - 1)] * 1000 if waits else None
+
+        data = dict(self._counters)
+        data.update({
+            'limit': self.limit,
+            'queue_limit': self.queue_limit,
+            'queue_timeout': self.queue_timeout,
+            'active': self.active,
+            'queue_depth': len(self._waiters),
+            'wait_ms_p50': pct(50),
+            'wait_ms_p99': pct(99),
+            'wait_ms_max': waits[-1] * 1000 if waits else None,
+            'hold_ms_avg': self._hold * 1000 if self._hold is not None else None,
+        })
+        return data
+
+
+_scheduler = DownloadScheduler()
+
+
+def get_scheduler():
+    return _scheduler
+
+
+def stats():
+    return _scheduler.stats()
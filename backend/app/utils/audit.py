@@ -2,9 +2,13 @@ from datetime import datetime
 from app import models
 
 
-def record_audit(db, actor_id, action, object_type=None, object_id=None, detail=None):
+def record_audit(db, actor_id, action, object_type=None, object_id=None, detail=None, commit=True):
+    a = models.AuditLog(actor_id=actor_id, action=action, object_type=object_type, object_id=str(object_id) if object_id is not None else None, detail=detail)
+    if not commit:
+        # 只加入调用方的事务（批量操作随业务数据一起提交）：出错时由调用方整体回滚，不在这里吞掉
+        db.add(a)
+        return
     try:
-        a = models.AuditLog(actor_id=actor_id, action=action, object_type=object_type, object_id=str(object_id) if object_id is not None else None, detail=detail)
         db.add(a)
         db.commit()
     except Exception:
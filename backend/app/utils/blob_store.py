@@ -0,0 +1,157 @@
+import contextlib
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+from sqlalchemy.exc import IntegrityError
+
+from app import models
+
+try:
+    import fcntl
+except ImportError:  # Windows：只在进程内加锁
+    fcntl = None
+
+# 上传文件按内容寻址存储：<DOC_DIR>/<sha[:2]>/<sha[2:4]>/<sha>.pdf，相同内容只存一份。
+# 早期上传的 <uuid>.pdf 仍在 DOC_DIR 顶层，重新入库时迁入（见 app.utils.ingest）。
+DOC_DIR = os.getenv('SECUREHUB_DOC_DIR', os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'documents')))
+# 上传与改写中的临时文件，与 blob 同一文件系统，放入时原子 rename
+INCOMING_DIR = os.path.join(DOC_DIR, '.incoming')
+
+CHUNK_SIZE = 1024 * 1024
+
+_lock = threading.Lock()
+
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(DOC_DIR, sha256[:2], sha256[2:4], f'{sha256}.pdf')
+
+
+def is_legacy_upload(path: str) -> bool:
+    """是否为内容寻址存储之前、直接放在 DOC_DIR 顶层的上传文件。"""
+    return os.path.dirname(os.path.abspath(path)) == os.path.abspath(DOC_DIR)
+
+
+def _incoming_path():
+    os.makedirs(INCOMING_DIR, exist_ok=True)
+    return os.path.join(INCOMING_DIR, f'{uuid.uuid4().hex}.tmp')
+
+
+def write_stream(fileobj):
+    """把上传流分块写入临时文件，同时计算 SHA-256。返回 ``(sha256, size, 临时路径)``。"""
+    tmp_path = _incoming_path()
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as out_f:
+            for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+                out_f.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        discard(tmp_path)
+        raise
+    return h.hexdigest(), size, tmp_path
+
+
+def checkout(path: str) -> str:
+    """复制一份 blob 供改写（blob 可能被多个文档共用，不能原地修改），返回临时路径。"""
+    tmp_path = _incoming_path()
+    shutil.copyfile(path, tmp_path)
+    return tmp_path
+
+
+def discard(tmp_path: str):
+    try:
+        os.unlink(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextlib.contextmanager
+def _store_lock():
+    """放入与删除 blob 文件的互斥（跨进程用 flock），与数据库中的引用计数配合使用。"""
+    with _lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(DOC_DIR, exist_ok=True)
+        fd = os.open(os.path.join(DOC_DIR, '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+def acquire(db, sha256, size):
+    """引用计数加一（不存在时新建），在调用方的事务中执行。"""
+    query = db.query(models.Blob).filter(models.Blob.sha256 == sha256)
+    if query.update({models.Blob.ref_count: models.Blob.ref_count + 1}, synchronize_session=False):
+        return
+    try:
+        with db.begin_nested():
+            db.add(models.Blob(sha256=sha256, size=size, ref_count=1))
+    except IntegrityError:
+        # 另一个请求同时插入了同一内容
+        query.update({models.Blob.ref_count: models.Blob.ref_count + 1}, synchronize_session=False)
+
+
+def adopt(db, doc, tmp_path, sha256=None, size=None):
+    """让文档 ``doc``（可以是尚未加入会话的新文档）引用 ``tmp_path`` 的内容，并提交事务。
+
+    先提交引用计数再放入文件（移动 ``tmp_path``），内容已存在时删除 ``tmp_path``。
+    原先引用的 blob 不在这里释放，见 ``release``。
+    """
+    if sha256 is None:
+        sha256, size = _file_digest(tmp_path), os.path.getsize(tmp_path)
+    acquire(db, sha256, size)
+    doc.blob_sha256 = sha256
+    doc.file_path = blob_path(sha256)
+    db.add(doc)
+    db.commit()
+    place(tmp_path, sha256)
+    return sha256
+
+
+def place(tmp_path, sha256):
+    """把 ``tmp_path`` 放入存储（内容已存在时删除 ``tmp_path``）。须在引用计数提交之后调用。"""
+    path = blob_path(sha256)
+    with _store_lock():
+        if os.path.exists(path):
+            discard(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    return path
+
+
+def release(db, sha256):
+    """引用计数减一并提交事务；没有文档再引用时删除 blob 文件。返回是否已删除。"""
+    if sha256 is None:
+        return False
+    query = db.query(models.Blob).filter(models.Blob.sha256 == sha256)
+    query.update({models.Blob.ref_count: models.Blob.ref_count - 1}, synchronize_session=False)
+    query.filter(models.Blob.ref_count <= 0).delete(synchronize_session=False)
+    db.commit()
+    with _store_lock():
+        # 持锁后再确认：其间可能有新的上传引用了同一内容
+        if query.first() is not None:
+            return False
+        try:
+            os.unlink(blob_path(sha256))
+        except FileNotFoundError:
+            pass
+    return True
+
@@ -0,0 +1,87 @@
+import os
+import posixpath
+import tarfile
+import zipfile
+
+from app.utils import blob_store, chunked_upload
+
+# 单个归档最多处理的 PDF 数
+MAX_FILES = int(os.getenv('SECUREHUB_BULK_MAX_FILES', '1000'))
+# 同时校验（及按设置改写）的文件数；任务在水印进程池中执行
+CONCURRENCY = int(os.getenv('SECUREHUB_BULK_CONCURRENCY', '2'))
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def iter_members(fileobj):
+    """逐个产出 ZIP 或 tar（可压缩）归档中的普通文件 ``(名称, 大小, 打开函数)``。
+
+    只在读取时解压当前成员，不会把整个归档解压到磁盘；tar 以流模式读取，
+    打开函数必须在取下一个成员之前调用。
+    """
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size, lambda info=info: zf.open(info)
+        return
+    fileobj.seek(0)
+    try:
+        tar = tarfile.open(fileobj=fileobj, mode='r|*')
+    except tarfile.TarError:
+        raise ArchiveError('Unsupported archive: expected a ZIP or tar file')
+    with tar:
+        for info in tar:
+            if info.isfile():
+                yield info.name, info.size, lambda info=info: tar.extractfile(info)
+
+
+def _skip_reason(name, size):
+    base = posixpath.basename(name)
+    if name.startswith('__MACOSX/') or base.startswith('.'):
+        return 'hidden file'
+    if not base.lower().endswith('.pdf'):
+        return 'not a PDF'
+    if size > chunked_upload.MAX_SIZE:
+        return f'exceeds the upload limit of {chunked_upload.MAX_SIZE} bytes'
+    return None
+
+
+def stage_archive(fileobj, on_staged):
+    """把归档中的 PDF 逐个边读边计算 SHA-256 写入暂存文件，返回按归档顺序的结果列表。
+
+    每写完一个文件调用 ``on_staged(entry, tmp_path)``（用于立即安排并行校验），
+    ``entry`` 为该文件的结果字典，含 ``name``、``filename``、``sha256``、``size``。
+    跳过的成员与读取失败的成员同样记录在结果中。
+    """
+    report = []
+    staged = 0
+    try:
+        for name, size, open_member in iter_members(fileobj):
+            staged += _stage_member(report, name, size, open_member, staged, on_staged)
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+        raise ArchiveError(f'Corrupt archive: {e}')
+    return report
+
+
+def _stage_member(report, name, size, open_member, staged, on_staged):
+    entry = {'name': name, 'filename': posixpath.basename(name)}
+    report.append(entry)
+    reason = _skip_reason(name, size)
+    if reason is None and staged >= MAX_FILES:
+        reason = f'archive exceeds {MAX_FILES} files'
+    if reason is not None:
+        entry.update(status='skipped', error=reason)
+        return 0
+    try:
+        with open_member() as member:
+            entry['sha256'], entry['size'], tmp_path = blob_store.write_stream(member)
+    except (zipfile.BadZipFile, RuntimeError, NotImplementedError, OSError) as e:
+        # 单个成员损坏、加密或使用不支持的压缩方式
+        entry.update(status='failed', error=f'Could not read archive member: {e}')
+        return 0
+    on_staged(entry, tmp_path)
+    return 1
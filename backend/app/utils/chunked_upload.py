@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+from starlette.concurrency import run_in_threadpool
+
+from app.utils import blob_store
+
+# 分块上传的暂存区：<DOC_DIR>/.incoming/uploads/<upload_id>/{meta.json, data, parts/<块序号>, completing/}
+# 与 blob 存储在同一文件系统，完成时整个文件直接 rename 进存储
+UPLOAD_DIR = os.path.join(blob_store.INCOMING_DIR, 'uploads')
+# 块大小（最后一块可以更小），客户端按 offset = 序号 × 块大小 上传
+CHUNK_SIZE = int(float(os.getenv('SECUREHUB_UPLOAD_CHUNK_MB', '8')) * 1024 * 1024)
+# 单个文件的大小上限
+MAX_SIZE = int(float(os.getenv('SECUREHUB_UPLOAD_MAX_MB', '2048')) * 1024 * 1024)
+# 未完成的上传在最后一次写入后保留的秒数，超时后由清理任务删除
+UPLOAD_TTL = int(os.getenv('SECUREHUB_UPLOAD_TTL', str(24 * 3600)))
+
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+_SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+
+class UploadError(Exception):
+    """分块上传请求无效，``status_code`` 为对应的 HTTP 状态码。"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _upload_path(upload_id, *parts):
+    if not _UPLOAD_ID.match(upload_id or ''):
+        raise UploadError('Upload not found', 404)
+    return os.path.join(UPLOAD_DIR, upload_id, *parts)
+
+
+def _write_json(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def create(user_id, filename, size, sha256=None, options=None):
+    """登记一次上传并预分配数据文件，返回上传信息（含 ``upload_id`` 与 ``chunk_size``）。"""
+    if not isinstance(size, int) or size <= 0:
+        raise UploadError('size must be a positive integer')
+    if size > MAX_SIZE:
+        raise UploadError(f'File exceeds the upload limit of {MAX_SIZE} bytes', 413)
+    if sha256 is not None and not _SHA256.match(sha256):
+        raise UploadError('sha256 must be a lowercase hex digest')
+    upload_id = uuid.uuid4().hex
+    meta = {
+        'upload_id': upload_id,
+        'user_id': user_id,
+        'filename': filename,
+        'size': size,
+        'sha256': sha256,
+        'chunk_size': CHUNK_SIZE,
+        'chunks': (size + CHUNK_SIZE - 1) // CHUNK_SIZE,
+        'options': options or {},
+        'created': time.time(),
+    }
+    os.makedirs(_upload_path(upload_id, 'parts'))
+    with open(_upload_path(upload_id, 'data'), 'wb') as f:
+        f.truncate(size)
+    _write_json(_upload_path(upload_id, 'meta.json'), meta)
+    return meta
+
+
+def load(upload_id, user_id):
+    """读取上传信息；只有发起上传的用户可以继续。"""
+    try:
+        with open(_upload_path(upload_id, 'meta.json')) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        raise UploadError('Upload not found', 404)
+    if meta['user_id'] != user_id:
+        raise UploadError('Upload not found', 404)
+    return meta
+
+
+def received(meta):
+    """已收到并校验通过的块：``{序号: sha256}``。"""
+    parts = {}
+    parts_dir = _upload_path(meta['upload_id'], 'parts')
+    for name in os.listdir(parts_dir):
+        if name.isdigit():
+            with open(os.path.join(parts_dir, name)) as f:
+                parts[int(name)] = f.read().strip()
+    return parts
+
+
+def status(meta):
+    parts = received(meta)
+    done = sum(_chunk_length(meta, index) for index in parts)
+    return {
+        'upload_id': meta['upload_id'],
+        'filename': meta['filename'],
+        'size': meta['size'],
+        'chunk_size': meta['chunk_size'],
+        'chunks': meta['chunks'],
+        'received': [{'index': index, 'offset': index * meta['chunk_size'], 'sha256': parts[index]} for index in sorted(parts)],
+        'received_bytes': done,
+        'expires_at': os.path.getmtime(_upload_path(meta['upload_id'], 'data')) + UPLOAD_TTL,
+    }
+
+
+def _chunk_length(meta, index):
+    return min(meta['chunk_size'], meta['size'] - index * meta['chunk_size'])
+
+
+def claim(meta):
+    """完成上传前取得独占：建立 ``completing`` 目录（跨进程原子），已被取得时抛出 409。
+
+    取得之后不再接受新的块；建档失败时用 ``release`` 释放。
+    """
+    try:
+        os.mkdir(_upload_path(meta['upload_id'], 'completing'))
+    except FileExistsError:
+        raise UploadError('Upload is already being completed', 409)
+    except FileNotFoundError:
+        raise UploadError('Upload not found', 404)
+
+
+def release(meta):
+    try:
+        os.rmdir(_upload_path(meta['upload_id'], 'completing'))
+    except FileNotFoundError:
+        pass
+
+
+def _prepare_part(meta, part_path, checksum):
+    """同一块已以相同校验和收到时返回 True；以不同内容重传时先作废原记录。"""
+    if os.path.isdir(_upload_path(meta['upload_id'], 'completing')):
+        raise UploadError('Upload is being completed', 409)
+    if os.path.exists(part_path):
+        with open(part_path) as f:
+            if f.read().strip() == checksum:
+                return True
+        os.unlink(part_path)
+    return False
+
+
+def _write_piece(f, h, data):
+    h.update(data)
+    f.write(data)
+
+
+def _record_part(part_path, checksum):
+    with open(f'{part_path}.tmp', 'w') as f:
+        f.write(checksum)
+    os.replace(f'{part_path}.tmp', part_path)
+
+
+async def write_chunk(meta, offset, body, checksum):
+    """把一块写入数据文件的对应位置，边写边校验 SHA-256。
+
+    ``body`` 为字节块的异步迭代器（请求体流）；文件 I/O 与哈希计算逐段在线程池中执行，
+    不阻塞事件循环。同一块已以相同校验和收到时不再写入，重试只需重新发送失败的块。
+    校验失败时不记录该块，可以直接重发。返回该块的序号。
+    """
+    checksum = (checksum or '').lower()
+    if not _SHA256.match(checksum):
+        raise UploadError('X-Chunk-SHA256 header with the chunk digest is required')
+    if offset < 0 or offset % meta['chunk_size'] or offset >= meta['size']:
+        raise UploadError(f"offset must be a multiple of {meta['chunk_size']} within the file")
+    index = offset // meta['chunk_size']
+    expected = _chunk_length(meta, index)
+    part_path = _upload_path(meta['upload_id'], 'parts', str(index))
+    if await run_in_threadpool(_prepare_part, meta, part_path, checksum):
+        return index
+
+    h = hashlib.sha256()
+    length = 0
+    f = await run_in_threadpool(open, _upload_path(meta['upload_id'], 'data'), 'r+b')
+    try:
+        await run_in_threadpool(f.seek, offset)
+        async for data in body:
+            length += len(data)
+            if length > expected:
+                raise UploadError(f'Chunk {index} must be {expected} bytes')
+            await run_in_threadpool(_write_piece, f, h, data)
+    finally:
+        await run_in_threadpool(f.close)
+    if length != expected:
+        raise UploadError(f'Chunk {index} must be {expected} bytes')
+    if h.hexdigest() != checksum:
+        raise UploadError(f'Checksum mismatch for chunk {index}', 422)
+    await run_in_threadpool(_record_part, part_path, checksum)
+    return index
+
+
+def assemble(meta):
+    """确认所有块都已收到，计算整个文件的 SHA-256（与声明的值核对）。
+
+    返回 ``(sha256, size, 数据文件路径)``，数据文件可以直接交给 ``blob_store.adopt``。
+    """
+    missing = sorted(set(range(meta['chunks'])) - set(received(meta)))
+    if missing:
+        raise UploadError(f"Upload is incomplete: {len(missing)} chunk(s) missing, first at offset {missing[0] * meta['chunk_size']}", 409)
+    data_path = _upload_path(meta['upload_id'], 'data')
+    h = hashlib.sha256()
+    try:
+        with open(data_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(blob_store.CHUNK_SIZE), b''):
+                h.update(chunk)
+    except FileNotFoundError:
+        # 另一个 complete 请求已经取走
+        raise UploadError('Upload not found', 404)
+    sha256 = h.hexdigest()
+    if meta['sha256'] and sha256 != meta['sha256']:
+        raise UploadError('Assembled file does not match the declared sha256', 422)
+    return sha256, meta['size'], data_path
+
+
+def remove(upload_id):
+    shutil.rmtree(_upload_path(upload_id), ignore_errors=True)
+
+
+def cleanup_expired(older_than_seconds=None):
+    """删除超过保留时间没有新数据写入的未完成上传，返回删除的 upload_id 列表。"""
+    if not os.path.isdir(UPLOAD_DIR):
+        return []
+    limit = UPLOAD_TTL if older_than_seconds is None else older_than_seconds
+    now = time.time()
+    removed = []
+    for upload_id in os.listdir(UPLOAD_DIR):
+        try:
+            if now - os.path.getmtime(_upload_path(upload_id, 'data')) > limit:
+                remove(upload_id)
+                removed.append(upload_id)
+        except Exception:
+            continue
+    return removed
@@ -0,0 +1,32 @@
+import ipaddress
+import os
+
+# 可信反向代理（逗号分隔的 IP 或网段）：只有直接对端在其中时才采信 X-Forwarded-For。
+# 默认只信任本机（nginx 与 uvicorn 同机部署）；容器部署时设为代理所在网段
+TRUSTED_PROXIES = [ipaddress.ip_network(item.strip(), strict=False)
+                   for item in os.getenv('SECUREHUB_TRUSTED_PROXIES', '127.0.0.1,::1').split(',') if item.strip()]
+
+
+def _trusted(host):
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+def client_ip(request):
+    """请求的真实客户端 IP。
+
+    对端是可信代理时，从 X-Forwarded-For 由右向左跳过可信代理，取第一个不可信的地址
+    （更左边的值由客户端自行填写，不可信）。uvicorn 已按 ``--forwarded-allow-ips`` 改写过
+    对端地址时，对端不再是代理，直接返回。
+    """
+    peer = request.client.host if request.client else None
+    if peer is None or not _trusted(peer):
+        return peer
+    forwarded = [item.strip() for item in request.headers.get('x-forwarded-for', '').split(',') if item.strip()]
+    for host in reversed(forwarded):
+        if not _trusted(host):
+            return host
+    return forwarded[0] if forwarded else peer
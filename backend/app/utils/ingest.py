@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+from app import models
+from app.database import SessionLocal
+from app.utils import blob_store, render_cache
+
+# 入库时是否重写原文件（修复可恢复的结构问题并压缩）；上传参数 resave 可单独指定
+RESAVE = os.getenv('SECUREHUB_INGEST_RESAVE', '0').lower() in ('1', 'true', 'yes')
+
+# 下载时发现尚未线性化、已排队重新入库的文档 ID（本进程内去重）
+_queued = set()
+_queued_lock = threading.Lock()
+
+
+def _watermark_wrapper():
+    from app.routes.download import _resolve_deploy_module
+    return _resolve_deploy_module('watermark_wrapper')
+
+
+def record_info(doc, info, sha256, size):
+    """把入库分析结果（``analyze_source`` / ``prepare_source``）写入文档，状态置为 ready。"""
+    doc.page_count = info['page_count']
+    doc.file_size = size
+    doc.sha256 = sha256
+    doc.geometry = json.dumps(info['geometry'], separators=(',', ':'))
+    doc.status, doc.ingest_error = 'ready', None
+    doc.ingested_at = datetime.utcnow()
+
+
+def ingest_document(document_id: int, resave=None):
+    """上传后的后台入库任务：校验 PDF、统计页数、记录页面几何表、大小与哈希。
+
+    按设置重写（修复/压缩）或线性化原文件后再记录，保证记录的内容与存储的文件一致。
+    成功后文档状态为 ready，失败为 failed（``ingest_error`` 为原因）。使用独立的数据库
+    会话，可以在响应发送之后执行。返回最终状态。
+    """
+    db = SessionLocal()
+    try:
+        doc = db.query(models.Document).filter(models.Document.id == document_id).first()
+        if doc is None:
+            return None
+        wrapper = _watermark_wrapper()
+        linearize = wrapper.linearize_enabled(doc.linearize)
+        source = work = doc.file_path
+        try:
+            info = wrapper.analyze_source(source)
+            if info['page_count'] == 0:
+                raise ValueError('PDF has no pages')
+            rewrite = RESAVE if resave is None else resave
+            linearize_now = not rewrite and linearize and not info['linearized']
+            # blob 可能被其他文档共用：改写副本，作为新内容存入；早期上传的独占文件迁入 blob 存储
+            legacy = doc.blob_sha256 is None and blob_store.is_legacy_upload(source)
+            if doc.blob_sha256 is not None and (rewrite or linearize_now):
+                work = blob_store.checkout(source)
+            if rewrite:
+                wrapper.resave_source(work, linearize=linearize)
+                info = wrapper.analyze_source(work)
+            elif linearize_now:
+                wrapper.linearize_source(work)
+            if work != source or legacy:
+                previous = doc.blob_sha256
+                blob_store.adopt(db, doc, work)
+                blob_store.release(db, previous)
+            if info['problems']:
+                logging.getLogger("uvicorn").warning(f"Document {doc.id} has {len(info['problems'])} PDF syntax problem(s): {info['problems'][0]}")
+            # blob 路径即内容哈希，不必重新读取
+            record_info(doc, info, doc.blob_sha256 or render_cache.source_hash(doc.file_path), os.path.getsize(doc.file_path))
+        except Exception as e:
+            logging.getLogger("uvicorn").warning(f"Ingest of document {doc.id} failed: {e}")
+            doc.status, doc.ingest_error = 'failed', str(e) or type(e).__name__
+        finally:
+            if work != source:
+                blob_store.discard(work)
+        doc.ingested_at = datetime.utcnow()
+        db.commit()
+        return doc.status
+    finally:
+        db.close()
+
+
+def queue_reingest(background_tasks, document_id: int):
+    """在响应发送之后重新入库（读取路径不改写存储）。同一文档已排队或正在入库时不重复排队，返回是否排队。"""
+    with _queued_lock:
+        if document_id in _queued:
+            return False
+        _queued.add(document_id)
+    background_tasks.add_task(_reingest_queued, document_id)
+    return True
+
+
+def _reingest_queued(document_id: int):
+    try:
+        return ingest_document(document_id)
+    finally:
+        with _queued_lock:
+            _queued.discard(document_id)
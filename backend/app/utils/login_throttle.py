@@ -0,0 +1,112 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows：令牌桶只在本进程内共享
+    fcntl = None
+
+from app.database import DATABASE_URL
+
+# 每个用户名的登录尝试令牌桶：容量与每秒补充数。登录成功时退还本次消耗的令牌，
+# 因此只限制连续失败（猜测密码）；容量为 0 表示不限制
+USER_BURST = float(os.getenv('SECUREHUB_LOGIN_USER_BURST', '10'))
+USER_RATE = float(os.getenv('SECUREHUB_LOGIN_USER_RATE', '0.1'))
+# 每个客户端 IP 的令牌桶，每次尝试都消耗
+IP_BURST = float(os.getenv('SECUREHUB_LOGIN_IP_BURST', '60'))
+IP_RATE = float(os.getenv('SECUREHUB_LOGIN_IP_RATE', '5'))
+# 同一主机上各 worker 进程共享的令牌桶文件（内存映射），默认放在 /dev/shm
+STATE_FILE = os.getenv('SECUREHUB_LOGIN_THROTTLE_FILE', os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+    f"securehub-login-{hashlib.sha256(DATABASE_URL.encode('utf-8')).hexdigest()[:12]}"))
+# 桶的个数：键按哈希取模，冲突的键共用一个桶（只会更严格）
+SLOTS = 16384
+
+# (剩余令牌, 上次更新的时间戳)
+_SLOT = struct.Struct('<dd')
+
+
+class LoginThrottled(Exception):
+    def __init__(self, retry_after):
+        super().__init__('Too many login attempts')
+        self.retry_after = retry_after
+
+
+class TokenBuckets:
+    """按键的令牌桶，状态放在内存映射的共享文件中，更新时用 flock 串行化。"""
+
+    def __init__(self, path=STATE_FILE, slots=SLOTS):
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._fd = None
+        size = slots * _SLOT.size
+        try:
+            if fcntl is None:
+                raise OSError('flock unavailable')
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._buf = mmap.mmap(self._fd, size)
+        except OSError:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._buf = bytearray(size)
+
+    def _offset(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') % self.slots * _SLOT.size
+
+    def _update(self, key, burst, rate, cost):
+        """补充令牌后扣除 ``cost``（为负时退还）；令牌不足时不扣除，返回需要等待的秒数。"""
+        offset = self._offset(key)
+        with self._lock:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                tokens, updated = _SLOT.unpack_from(self._buf, offset)
+                now = time.time()
+                if updated <= 0:
+                    tokens = burst
+                else:
+                    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+                if tokens < cost:
+                    _SLOT.pack_into(self._buf, offset, tokens, now)
+                    return (cost - tokens) / rate if rate > 0 else float('inf')
+                _SLOT.pack_into(self._buf, offset, min(burst, tokens - cost), now)
+                return 0.0
+            finally:
+                if self._fd is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def take(self, key, burst, rate):
+        if burst <= 0:
+            return 0.0
+        return self._update(key, burst, rate, 1.0)
+
+    def refund(self, key, burst, rate):
+        if burst > 0:
+            self._update(key, burst, rate, -1.0)
+
+
+_buckets = TokenBuckets()
+
+
+def check(username, client_ip):
+    """登录尝试前调用：任一令牌桶为空时抛出 ``LoginThrottled``。"""
+    wait = _buckets.take(f'ip:{client_ip}', IP_BURST, IP_RATE) if client_ip else 0.0
+    if not wait:
+        wait = _buckets.take(f'user:{(username or "").lower()}', USER_BURST, USER_RATE)
+    if wait:
+        raise LoginThrottled(max(1, math.ceil(min(wait, 3600))))
+
+
+def succeeded(username):
+    """登录成功：退还用户名令牌桶中本次消耗的令牌。"""
+    _buckets.refund(f'user:{(username or "").lower()}', USER_BURST, USER_RATE)
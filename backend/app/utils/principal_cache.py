@@ -0,0 +1,166 @@
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows：失效只在本进程内生效，其他进程等 TTL 过期
+    fcntl = None
+
+from app.database import DATABASE_URL
+
+# 已认证用户（principal）缓存的有效秒数，0 表示禁用（每个请求都查询 users 表）
+TTL = float(os.getenv('SECUREHUB_PRINCIPAL_CACHE_TTL', '60'))
+MAX_ENTRIES = int(os.getenv('SECUREHUB_PRINCIPAL_CACHE_SIZE', '4096'))
+# 同一主机上各 worker 进程共享的失效计数器文件（内存映射），默认放在 /dev/shm
+EPOCH_FILE = os.getenv('SECUREHUB_PRINCIPAL_EPOCH_FILE', os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+    f"securehub-principals-{hashlib.sha256(DATABASE_URL.encode('utf-8')).hexdigest()[:12]}"))
+# 计数器个数：0 号为全局计数，其余按 user_id 取模
+EPOCH_SLOTS = 4096
+
+_SLOT = struct.Struct('<Q')
+
+
+class Principal:
+    """已认证用户：只含鉴权所需的字段，不绑定数据库会话。
+
+    需要完整用户记录的接口使用 ``app.auth.get_current_user_record``。
+    """
+    __slots__ = ('id', 'username', 'is_active', 'is_admin', 'token_version')
+
+    def __init__(self, id, username, is_active, is_admin, token_version=0):
+        self.id = id
+        self.username = username
+        self.is_active = is_active
+        self.is_admin = is_admin
+        self.token_version = token_version
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, bool(user.is_active), bool(user.is_admin), user.token_version or 0)
+
+
+class _Epochs:
+    """失效计数器：内存映射的共享文件，读取不加锁，递增时用 flock 串行化。"""
+
+    def __init__(self, path=EPOCH_FILE, slots=EPOCH_SLOTS):
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._fd = None
+        size = slots * _SLOT.size
+        try:
+            if fcntl is None:
+                raise OSError('flock unavailable')
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._buf = mmap.mmap(self._fd, size)
+        except OSError:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._buf = bytearray(size)
+
+    def _slot(self, user_id):
+        return 1 + user_id % (self.slots - 1)
+
+    def get(self, user_id=None):
+        """用户对应的计数（``None`` 为全局计数）。"""
+        return _SLOT.unpack_from(self._buf, (0 if user_id is None else self._slot(user_id)) * _SLOT.size)[0]
+
+    def bump(self, user_id):
+        with self._lock:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                for slot in (0, self._slot(user_id)):
+                    offset = slot * _SLOT.size
+                    _SLOT.pack_into(self._buf, offset, _SLOT.unpack_from(self._buf, offset)[0] + 1)
+            finally:
+                if self._fd is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class PrincipalCache:
+    """按用户 ID（或旧令牌的用户名）缓存 ``Principal`` 的有界 TTL/LRU 缓存。
+
+    条目记录加载时该用户的失效计数，计数变化（任一进程调用 ``invalidate``）后
+    下一次查找即重新加载。
+    """
+
+    def __init__(self, ttl=TTL, max_entries=MAX_ENTRIES, epochs=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._epochs = epochs or _Epochs()
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'stale': 0, 'invalidations': 0}
+
+    def get(self, subject, load):
+        """返回 ``subject`` 对应的 principal；未命中时调用 ``load()``（返回 Principal 或 None）。"""
+        if self.ttl <= 0:
+            return load()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(subject)
+            if entry is not None:
+                principal, epoch, expires = entry
+                if expires > now and self._epochs.get(principal.id) == epoch:
+                    self._entries.move_to_end(subject)
+                    self._counters['hits'] += 1
+                    return principal
+                del self._entries[subject]
+                self._counters['stale'] += 1
+            self._counters['misses'] += 1
+        generation = self._epochs.get()
+        principal = load()
+        if principal is None:
+            return None
+        epoch = self._epochs.get(principal.id)
+        # 加载期间有失效发生时不缓存，避免把失效前读到的旧值当作新值
+        if self._epochs.get() == generation:
+            with self._lock:
+                self._entries[subject] = (principal, epoch, now + self.ttl)
+                self._entries.move_to_end(subject)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return principal
+
+    def invalidate(self, user_id):
+        """用户记录变化（token_version、状态、权限、2FA）后调用；同一主机上的所有 worker 进程立即生效。"""
+        self._epochs.bump(user_id)
+        with self._lock:
+            self._counters['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._counters)
+            data['entries'] = len(self._entries)
+        lookups = data['hits'] + data['misses']
+        data.update({'hit_ratio': data['hits'] / lookups if lookups else None, 'ttl': self.ttl, 'max_entries': self.max_entries})
+        return data
+
+
+_cache = PrincipalCache()
+
+
+def get_cache():
+    return _cache
+
+
+def invalidate(user_id):
+    _cache.invalidate(user_id)
+
+
+def stats():
+    return _cache.stats()
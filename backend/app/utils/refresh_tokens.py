@@ -0,0 +1,80 @@
+import os
+from datetime import datetime
+
+from app import models
+from app.auth import create_refresh_token
+from app.database import SessionLocal
+
+# 清理过期记录时每批删除的行数
+SWEEP_BATCH = int(os.getenv('SECUREHUB_REFRESH_SWEEP_BATCH', '1000'))
+
+
+def issue(db, user):
+    """签发刷新令牌并登记（不提交），返回 ``(令牌, 过期时间)``。"""
+    token, jti, expiry = create_refresh_token({'sub': user.username, 'uid': user.id})
+    db.add(models.RefreshToken(jti=jti, user_id=user.id, expires_at=expiry))
+    return token, expiry
+
+
+def _revoke_query(db, jti, user_id=None):
+    query = db.query(models.RefreshToken).filter(models.RefreshToken.jti == jti, models.RefreshToken.revoked.isnot(True))
+    if user_id is not None:
+        query = query.filter(models.RefreshToken.user_id == user_id)
+    return query.update({models.RefreshToken.revoked: True}, synchronize_session=False)
+
+
+def rotate(db, jti, user):
+    """刷新时轮换：吊销旧 jti 并签发新的刷新令牌，在同一事务中提交。
+
+    吊销是带条件的 UPDATE（只更新未吊销的记录），同时完成检查：旧 jti 没有记录、已被吊销
+    或已被并发的刷新请求轮换时更新 0 行，返回 ``None``，不需要事先查询。
+    """
+    if not _revoke_query(db, jti, user.id):
+        db.rollback()
+        return None
+    token, expiry = issue(db, user)
+    db.commit()
+    return token, expiry
+
+
+def revoke(db, jti):
+    """登出：吊销单个 jti 并提交，返回是否确实吊销了一个有效记录。"""
+    revoked = bool(_revoke_query(db, jti))
+    db.commit()
+    return revoked
+
+
+def revoke_all(db, user_id):
+    """吊销用户的全部刷新令牌：一条 UPDATE 语句，由调用方提交。返回吊销的记录数。
+
+    不需要逐个处理 jti：刷新时 ``rotate`` 以带条件的 UPDATE 吊销旧 jti，已吊销的记录更新
+    0 行即被拒绝，提交后立即对所有 worker 生效。
+    """
+    return db.query(models.RefreshToken).filter(
+        models.RefreshToken.user_id == user_id, models.RefreshToken.revoked.isnot(True),
+    ).update({models.RefreshToken.revoked: True}, synchronize_session=False)
+
+
+def sweep_expired(db, batch_size=None, now=None):
+    """分批删除已过期的记录（每批单独提交，不长时间持有写锁），返回删除的行数。"""
+    batch_size = batch_size or SWEEP_BATCH
+    now = now or datetime.utcnow()
+    removed = 0
+    while True:
+        ids = [row.id for row in db.query(models.RefreshToken.id).filter(models.RefreshToken.expires_at < now).limit(batch_size)]
+        if not ids:
+            return removed
+        db.query(models.RefreshToken).filter(models.RefreshToken.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        removed += len(ids)
+        if len(ids) < batch_size:
+            return removed
+
+
+def maintain():
+    """后台清理任务调用：删除过期记录，返回删除的行数。"""
+    db = SessionLocal()
+    try:
+        return sweep_expired(db)
+    finally:
+        db.close()
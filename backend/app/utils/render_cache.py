@@ -0,0 +1,174 @@
+import hashlib
+import os
+import shutil
+import threading
+from typing import Optional
+
+from sqlalchemy import event
+
+from app import models
+
+# 已渲染水印输出的磁盘缓存：<CACHE_DIR>/<document_id>/<render key>.pdf
+CACHE_DIR = os.getenv('SECUREHUB_RENDER_CACHE_DIR', os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'render_cache')))
+# 磁盘预算（MB），超出后按最近使用时间（文件 mtime）淘汰；0 表示禁用缓存
+CACHE_BUDGET = int(float(os.getenv('SECUREHUB_RENDER_CACHE_MB', '1024')) * 1024 * 1024)
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'invalidations': 0}
+# 源文件哈希缓存：path -> ((size, mtime_ns), sha256)
+_source_hashes = {}
+
+
+def enabled() -> bool:
+    return CACHE_BUDGET > 0
+
+
+def _count(name, n=1):
+    with _lock:
+        _stats[name] += n
+
+
+def source_hash(path: str) -> str:
+    """源文件的 SHA-256，按 (size, mtime) 记忆，文件不变时不会重复读取。"""
+    st = os.stat(path)
+    stamp = (st.st_size, st.st_mtime_ns)
+    cached = _source_hashes.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _source_hashes[path] = (stamp, digest)
+    return digest
+
+
+def render_key(document_id: int, source_sha256: str, watermark_text: str, font_size, opacity, engine_version: str, layout_text: str = None) -> str:
+    parts = [str(document_id), source_sha256, watermark_text, str(float(font_size)), str(float(opacity)), engine_version]
+    if layout_text is not None:
+        # 分层渲染的静态层：排版还取决于完整模板
+        parts.append(layout_text)
+    raw = '\x00'.join(parts)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def entry_path(document_id: int, key: str) -> str:
+    return os.path.join(CACHE_DIR, str(document_id), f'{key}.pdf')
+
+
+def lock_path(document_id: int, key: str) -> str:
+    """渲染该条目时持有的跨进程锁文件（见 app.utils.single_flight）。"""
+    path = entry_path(document_id, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return f'{path}.lock'
+
+
+def open_file(path: str) -> Optional[int]:
+    """以只读方式打开缓存文件，返回文件描述符；文件已被删除时返回 None。
+
+    持有描述符即可读完整个文件，之后的淘汰或失效删除不影响正在发送的响应。
+    """
+    try:
+        return os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+
+
+def open_entry(document_id: int, key: str) -> Optional[int]:
+    """命中时打开缓存文件（见 ``open_file``）并刷新其 LRU 时间戳，否则返回 None。"""
+    path = entry_path(document_id, key)
+    fd = open_file(path)
+    if fd is None:
+        _count('misses')
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    _count('hits')
+    return fd
+
+
+def reserve(document_id: int, key: str) -> str:
+    """返回渲染进程应写入的目标路径（确保目录存在）。"""
+    path = entry_path(document_id, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def stored(document_id: int, key: str) -> str:
+    """渲染进程写完 ``reserve`` 返回的路径后调用，统计并按预算淘汰。"""
+    path = entry_path(document_id, key)
+    _count('stores')
+    evict(keep=path)
+    return path
+
+
+def _entries():
+    out = []
+    if not os.path.isdir(CACHE_DIR):
+        return out
+    for doc_dir in os.scandir(CACHE_DIR):
+        if not doc_dir.is_dir():
+            continue
+        for entry in os.scandir(doc_dir.path):
+            if entry.name.endswith('.pdf'):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                out.append((st.st_mtime, st.st_size, entry.path))
+    return out
+
+
+def evict(budget: int = None, keep: str = None) -> int:
+    """删除最久未使用的条目直到总大小不超过预算（``keep`` 除外），返回删除的条目数。"""
+    budget = CACHE_BUDGET if budget is None else budget
+    entries = _entries()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    if removed:
+        _count('evictions', removed)
+    return removed
+
+
+def invalidate(document_id: int):
+    """删除某文档的所有缓存条目。"""
+    path = os.path.join(CACHE_DIR, str(document_id))
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        _count('invalidations')
+
+
+def stats() -> dict:
+    with _lock:
+        data = dict(_stats)
+    lookups = data['hits'] + data['misses']
+    entries = _entries()
+    data.update({
+        'hit_ratio': data['hits'] / lookups if lookups else None,
+        'entries': len(entries),
+        'bytes': sum(size for _, size, _ in entries),
+        'budget_bytes': CACHE_BUDGET,
+    })
+    return data
+
+
+# 文档元数据被修改或文档被删除时自动失效（set_metadata / delete_document 等任何写入路径）
+@event.listens_for(models.Document, 'after_update')
+@event.listens_for(models.Document, 'after_delete')
+def _invalidate_on_write(mapper, connection, target):
+    if target.id is not None:
+        invalidate(target.id)
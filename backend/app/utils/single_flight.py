@@ -0,0 +1,88 @@
+import asyncio
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows：只在进程内合并
+    fcntl = None
+
+# 等待其他进程持有的渲染锁的最长秒数，超时后不再等待、自行渲染
+LOCK_TIMEOUT = float(os.getenv('SECUREHUB_SINGLE_FLIGHT_LOCK_TIMEOUT', os.getenv('SECUREHUB_WATERMARK_TIMEOUT', '120')))
+
+_inflight = {}
+_lock = threading.Lock()
+_stats = {'leaders': 0, 'coalesced': 0, 'lock_waits': 0, 'lock_timeouts': 0}
+
+
+def _count(name, n=1):
+    with _lock:
+        _stats[name] += n
+
+
+async def _acquire_file_lock(path, timeout):
+    """非阻塞地轮询 flock，等待期间不占用线程。返回文件描述符，超时返回 None。"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    waited = False
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            if not waited:
+                _count('lock_waits')
+                waited = True
+            if time.monotonic() >= deadline:
+                os.close(fd)
+                _count('lock_timeouts')
+                return None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        except BaseException:
+            os.close(fd)
+            raise
+
+
+async def run(key, factory, lock_path=None, lock_timeout=None):
+    """同一 ``key`` 的并发调用只执行一次 ``factory()``（协程函数），返回 ``(结果, 是否为跟随者)``。
+
+    进程内的并发调用等待同一个任务；给出 ``lock_path`` 时，领头的调用先取得该文件的
+    排他锁，使多个 uvicorn 进程对同一 key 同样只执行一次（``factory`` 应在持锁后
+    先检查结果是否已由其他进程生成）。异常同样传给所有等待者。
+    """
+    pending = _inflight.get(key)
+    if pending is not None:
+        _count('coalesced')
+        return await asyncio.shield(pending), True
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    _count('leaders')
+    fd = None
+    try:
+        if lock_path is not None and fcntl is not None:
+            fd = await _acquire_file_lock(lock_path, LOCK_TIMEOUT if lock_timeout is None else lock_timeout)
+        result = await factory()
+    except BaseException as exc:
+        future.set_exception(exc)
+        # 没有跟随者时避免 "exception was never retrieved" 警告
+        future.exception()
+        raise
+    else:
+        future.set_result(result)
+        return result, False
+    finally:
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        del _inflight[key]
+
+
+def stats():
+    with _lock:
+        data = dict(_stats)
+    data['inflight'] = len(_inflight)
+    return data
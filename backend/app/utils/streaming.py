@@ -0,0 +1,103 @@
+import os
+import re
+from urllib.parse import quote
+
+import aiofiles
+
+CHUNK_SIZE = 64 * 1024
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def content_disposition(filename: str) -> str:
+    # same rules as starlette's FileResponse
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def parse_range(header, size: int):
+    """Parse a single-range ``Range`` header into an inclusive ``(start, end)``.
+
+    Returns None when the header is absent, malformed or asks for several
+    ranges (the full representation is sent instead, as RFC 9110 allows).
+    Raises ``RangeNotSatisfiable`` when the range lies outside the file.
+    """
+    if not header:
+        return None
+    match = _RANGE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or (last and int(last) < start):
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+async def _iter_file(f, offset, length, chunk_size):
+    await f.seek(offset)
+    while length > 0:
+        chunk = await f.read(min(chunk_size, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+
+async def iter_rendered_output(output, chunk_size: int = CHUNK_SIZE, start: int = 0, end: int = None):
+    """Yield bytes ``start..end`` (inclusive) of a ``RenderedOutput`` and release its spool file.
+
+    Spooled files are unlinked as soon as they are opened, so nothing is left
+    behind even if the client disconnects half way through. Outputs that carry
+    an open ``fd`` (render cache hits) are read from it, so a concurrent
+    eviction cannot pull the file away mid-response. Incremental-update
+    outputs stream the untouched source file (``prefix_path``) first.
+    """
+    end = output.size - 1 if end is None else end
+    body = None
+    try:
+        if output.fd is not None:
+            fd, output.fd = output.fd, None
+            body = await aiofiles.open(fd, 'rb')
+            body_size = os.fstat(body.fileno()).st_size
+        elif output.path is not None:
+            body = await aiofiles.open(output.path, 'rb')
+            output.discard()
+            body_size = os.fstat(body.fileno()).st_size
+        else:
+            body_size = len(output.data)
+        prefix_size = output.size - body_size
+        if output.prefix_path is not None and start < prefix_size:
+            async with aiofiles.open(output.prefix_path, 'rb') as f:
+                async for chunk in _iter_file(f, start, min(end + 1, prefix_size) - start, chunk_size):
+                    yield chunk
+        offset = max(start - prefix_size, 0)
+        length = end + 1 - prefix_size - offset
+        if length <= 0:
+            return
+        if body is None:
+            data = memoryview(output.data)
+            for pos in range(offset, offset + length, chunk_size):
+                yield bytes(data[pos:min(pos + chunk_size, offset + length)])
+        else:
+            async for chunk in _iter_file(body, offset, length, chunk_size):
+                yield chunk
+    finally:
+        if body is not None:
+            await body.close()
+        output.discard()
@@ -0,0 +1,45 @@
+import re
+
+# 水印文本中可用的模板变量，例如 "CONFIDENTIAL\n{username} {timestamp}"
+FIELDS = ('username', 'user_id', 'client_ip', 'timestamp', 'download_id')
+# 文档未设置水印文本时的默认模板（原先直接使用用户名）
+DEFAULT_TEMPLATE = '{username}'
+
+_PLACEHOLDER = re.compile(r'\{(' + '|'.join(FIELDS) + r')\}')
+
+
+def _split_lines(text):
+    # 与 modules/add.py 中 split_watermark_lines 的规则一致：真实换行或字面量 \n
+    if '\n' in text:
+        return text.split('\n')
+    return text.split('\\n')
+
+
+def has_placeholders(text) -> bool:
+    return bool(text) and _PLACEHOLDER.search(text) is not None
+
+
+def fill(template: str, values: dict) -> str:
+    """替换已知的模板变量；未知的 {xxx} 原样保留，变量值中的换行替换为空格。"""
+    def _sub(match):
+        value = values.get(match.group(1))
+        return '' if value is None else str(value).replace('\r', ' ').replace('\n', ' ')
+    return _PLACEHOLDER.sub(_sub, template)
+
+
+def split_layers(template: str):
+    """把水印模板拆成 (静态层, 动态层)。
+
+    不含变量的行属于静态层，含变量的行属于动态层；两层都保留原有行数（另一层的行
+    留空），按同一个完整模板排版后叠加。横向页的字号按模板（而不是替换后的文本）
+    计算，因此各用户的水印位置一致，且与直接渲染完整文本的效果相同（变量值不比
+    占位符长时）。
+    """
+    lines = _split_lines(template)
+    static = [line if not has_placeholders(line) else '' for line in lines]
+    dynamic = [line if has_placeholders(line) else '' for line in lines]
+    return '\n'.join(static), '\n'.join(dynamic)
+
+
+def is_blank(text) -> bool:
+    return not any(line.strip() for line in _split_lines(text or ''))
@@ -0,0 +1,281 @@
+"""预热的水印工作进程池。
+
+每个工作进程启动时就导入 pikepdf / reportlab，之后循环执行任务，避免每次下载
+都在请求线程里同步渲染或重新启动 Python 解释器。每个进程由一个专用的调度线程
+管理（不占用 FastAPI/anyio 的线程池），调度线程负责：
+
+- 单任务超时：超时后杀掉工作进程（连同它的整个进程组，包括并行模式的页段进程）
+  并立即重新拉起，下一个任务不必等待解释器启动与导入；
+- 回收：执行 N 个任务后或 RSS 超过上限时优雅退出并立即重启。
+
+异步调用方通过 ``await pool.run(fn, *args)`` 等待结果，不会阻塞事件循环。
+"""
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+
+POOL_SIZE = int(os.getenv('SECUREHUB_WATERMARK_WORKERS', '2'))
+JOB_TIMEOUT = float(os.getenv('SECUREHUB_WATERMARK_TIMEOUT', '120'))
+MAX_JOBS_PER_WORKER = int(os.getenv('SECUREHUB_WATERMARK_MAX_JOBS', '200'))
+MAX_WORKER_RSS_MB = int(os.getenv('SECUREHUB_WATERMARK_MAX_RSS_MB', '1024'))
+STARTUP_TIMEOUT = 60
+
+
+class WatermarkTimeout(RuntimeError):
+    pass
+
+
+class WatermarkWorkerError(RuntimeError):
+    pass
+
+
+def current_rss():
+    """当前进程常驻内存（字节）。"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        import resource
+        # 非 Linux 平台退化为峰值 RSS（macOS 单位为字节，Linux 为 KB）
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _warm_up():
+    project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    if project_root not in sys.path:
+        sys.path.insert(0, project_root)
+    # 预先导入重量级依赖，使第一个任务不再付出导入成本
+    import pikepdf  # noqa: F401
+    import reportlab.pdfgen.canvas  # noqa: F401
+    import modules.add  # noqa: F401
+
+
+def _worker_main(conn):
+    if hasattr(os, 'setpgrp'):
+        # 自成一个进程组：被杀时连同并行模式启动的页段进程（modules.add._parallel_pool）一起结束
+        os.setpgrp()
+    _warm_up()
+    conn.send(('ready', os.getpid()))
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            # 父进程已退出
+            break
+        if job is None:
+            break
+        fn, args, kwargs = job
+        try:
+            result = fn(*args, **kwargs)
+            reply = ('ok', result)
+        except Exception as exc:
+            reply = ('error', exc)
+        try:
+            conn.send(reply + (current_rss(),))
+        except Exception as exc:
+            # 结果或异常无法序列化
+            conn.send(('error', WatermarkWorkerError(f'{type(exc).__name__}: {exc}'), current_rss()))
+    conn.close()
+
+
+def _kill_group(proc):
+    """杀掉工作进程所在的进程组（其中的孙进程），进程组已不存在时忽略。"""
+    if not hasattr(os, 'killpg'):
+        return
+    try:
+        if os.getpgid(proc.pid) != proc.pid:
+            return
+    except ProcessLookupError:
+        # 组长已退出：进程组 ID 仍为其 pid，剩余成员照样处理
+        pass
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class _WorkerSlot:
+    """一个工作进程及其专用调度线程。"""
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.proc = None
+        self.conn = None
+        self.jobs_done = 0
+        self.thread = threading.Thread(target=self._run, name=f'watermark-worker-{index}', daemon=True)
+
+    def spawn(self):
+        ctx = self.pool.ctx
+        parent_conn, child_conn = ctx.Pipe()
+        # 非 daemon：工作进程自身可能还要创建子进程；父进程退出时管道关闭，工作进程随之退出
+        proc = ctx.Process(target=_worker_main, args=(child_conn,), name=f'securehub-watermark-{self.index}', daemon=False)
+        proc.start()
+        child_conn.close()
+        if not parent_conn.poll(STARTUP_TIMEOUT):
+            proc.kill()
+            proc.join()
+            raise WatermarkWorkerError('watermark worker failed to start')
+        parent_conn.recv()
+        self.proc, self.conn, self.jobs_done = proc, parent_conn, 0
+
+    def kill(self):
+        if self.proc is not None:
+            _kill_group(self.proc)
+            self.proc.kill()
+            self.proc.join()
+        self._close()
+
+    def retire(self):
+        # 优雅退出：发送哨兵并等待，超时则强杀
+        if self.proc is not None:
+            try:
+                self.conn.send(None)
+            except Exception:
+                pass
+            self.proc.join(5)
+            if self.proc.is_alive():
+                self.proc.kill()
+                self.proc.join()
+            # 页段进程池不随工作进程退出而结束
+            _kill_group(self.proc)
+        self._close()
+
+    def respawn(self):
+        # 杀掉或回收后立即重启，失败时由下一个任务再尝试
+        try:
+            self.spawn()
+        except Exception:
+            pass
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.proc, self.conn = None, None
+
+    def _run(self):
+        # 失败时第一个任务到来时再尝试启动
+        self.respawn()
+        while True:
+            item = self.pool._jobs.get()
+            if item is None:
+                self.retire()
+                return
+            fut, fn, args, kwargs, timeout = item
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                if self.proc is None:
+                    self.spawn()
+                self.conn.send((fn, args, kwargs))
+                if not self.conn.poll(timeout):
+                    self.kill()
+                    self.pool._count('timeouts')
+                    fut.set_exception(WatermarkTimeout(f'watermark job exceeded {timeout:.0f}s'))
+                    self.respawn()
+                    continue
+                status, payload, rss = self.conn.recv()
+            except Exception as exc:
+                # 工作进程崩溃（管道 EOF）或无法启动
+                self.kill()
+                self.pool._count('crashes')
+                fut.set_exception(WatermarkWorkerError(f'watermark worker died: {exc!r}'))
+                self.respawn()
+                continue
+
+            self.jobs_done += 1
+            self.pool._count('jobs')
+            if status == 'ok':
+                fut.set_result(payload)
+            else:
+                fut.set_exception(payload)
+
+            if self.jobs_done >= self.pool.max_jobs or rss > self.pool.max_rss:
+                self.pool._count('recycles')
+                self.retire()
+                self.respawn()
+
+
+class WatermarkPool:
+    def __init__(self, size=POOL_SIZE, job_timeout=JOB_TIMEOUT, max_jobs=MAX_JOBS_PER_WORKER, max_rss_mb=MAX_WORKER_RSS_MB):
+        self.size = size
+        self.job_timeout = job_timeout
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss_mb * 1024 * 1024
+        # spawn：不要 fork 已经启动了线程的服务进程
+        self.ctx = multiprocessing.get_context('spawn')
+        self._jobs = queue.Queue()
+        self._slots = [_WorkerSlot(self, i) for i in range(size)]
+        self._lock = threading.Lock()
+        self._counters = {'jobs': 0, 'timeouts': 0, 'crashes': 0, 'recycles': 0}
+        self._started = False
+
+    def start(self):
+        # 各调度线程并行拉起自己的工作进程，不阻塞调用方
+        for slot in self._slots:
+            slot.thread.start()
+        self._started = True
+        return self
+
+    def stop(self):
+        if not self._started:
+            return
+        self._started = False
+        for _ in self._slots:
+            self._jobs.put(None)
+        for slot in self._slots:
+            slot.thread.join(10)
+
+    def submit(self, fn, *args, timeout=None, **kwargs):
+        """提交任务，返回 ``concurrent.futures.Future``。``fn`` 必须可被 pickle（模块级函数）。"""
+        if not self._started:
+            raise RuntimeError('watermark pool is not running')
+        fut = concurrent.futures.Future()
+        self._jobs.put((fut, fn, args, kwargs, timeout or self.job_timeout))
+        return fut
+
+    async def run(self, fn, *args, timeout=None, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, timeout=timeout, **kwargs))
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._counters)
+        data.update({
+            'size': self.size,
+            'queued': self._jobs.qsize(),
+            'alive': sum(1 for s in self._slots if s.proc is not None and s.proc.is_alive()),
+        })
+        return data
+
+
+_pool = None
+
+
+def start_pool(size=None):
+    """启动全局进程池（size 为 0 时不启动，下载路由退化为线程池内同步调用）。"""
+    global _pool
+    size = POOL_SIZE if size is None else size
+    if _pool is None and size > 0:
+        _pool = WatermarkPool(size=size).start()
+    return _pool
+
+
+def stop_pool():
+    global _pool
+    if _pool is not None:
+        _pool.stop()
+        _pool = None
+
+
+def get_pool():
+    return _pool
@@ -1,18 +1,180 @@
+import io
 import os
 import sys
 import subprocess
 import tempfile
 
-def _subprocess_add(input_pdf_path, watermark_text, font_size, opacity):
+# 水印渲染后端（reportlab / native），见 modules/add.py 中的 ENGINES
+WATERMARK_ENGINE = os.getenv('SECUREHUB_WATERMARK_ENGINE', 'reportlab')
+# 输出模式（full / incremental / linearized），见 modules/add.py 中的 OUTPUT_MODES。
+# incremental 的输出可以被截掉水印，只用于固定文本的水印；按用户的模板水印总是整份重写
+WATERMARK_OUTPUT_MODE = os.getenv('SECUREHUB_WATERMARK_OUTPUT_MODE', 'full')
+# 未单独设置的文档是否线性化（快速 Web 查看）原文件与水印输出
+LINEARIZE = os.getenv('SECUREHUB_LINEARIZE', '0').lower() in ('1', 'true', 'yes')
+
+# 下载输出先写内存，超过阈值后落到私有 spool 目录（而不是系统 /tmp）
+SPOOL_DIR = os.getenv('SECUREHUB_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'securehub-spool'))
+SPOOL_THRESHOLD = int(float(os.getenv('SECUREHUB_SPOOL_THRESHOLD_MB', '8')) * 1024 * 1024)
+
+
+def ensure_spool_dir():
+    os.makedirs(SPOOL_DIR, mode=0o700, exist_ok=True)
+    return SPOOL_DIR
+
+
+class RenderedOutput:
+    """一次渲染的结果：小文件直接持有 ``data``，大文件持有 spool 目录中的 ``path``。
+
+    增量更新模式下 ``prefix_path`` 指向未改动的源文件，输出内容为源文件字节后接
+    ``data``/``path``，源文件无需复制（因此截断即可去掉水印，不能用于追溯）。``size`` 为总字节数。
+    可被 pickle，从水印进程池返回给 Web 进程；读取方负责在读完后删除 ``path``。
+    ``fd`` 为已打开的 ``path``（渲染缓存命中时），读取方从它读取，``discard`` 时关闭。
+    """
+
+    def __init__(self, data=None, path=None, size=0, temporary=True, prefix_path=None, stats=None, fd=None):
+        self.data = data
+        self.path = path
+        self.fd = fd
+        self.size = size
+        self.prefix_path = prefix_path
+        # 渲染计量（WatermarkStats.as_dict()），子进程回退或缓存命中时为 None
+        self.stats = stats
+        # 强校验 ETag，由下载路由按渲染输入计算（相同 ETag 保证字节相同，用于 Range 续传）
+        self.etag = None
+        # False 表示 path 归别处所有（例如渲染缓存中的条目），读取方不应删除
+        self.temporary = temporary
+
+    def discard(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.path and self.temporary:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class SpoolWriter(io.RawIOBase):
+    """只写流：先缓存在内存中，超过 ``threshold`` 字节后溢出到 spool 目录。"""
+
+    def __init__(self, threshold=None, spool_dir=None):
+        super().__init__()
+        self.threshold = SPOOL_THRESHOLD if threshold is None else threshold
+        self.spool_dir = spool_dir
+        self._buffer = io.BytesIO()
+        self._file = None
+        self._size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self._file is None and self._size + len(b) > self.threshold:
+            self._file = tempfile.NamedTemporaryFile(dir=self.spool_dir or ensure_spool_dir(), suffix='.pdf', delete=False)
+            self._file.write(self._buffer.getbuffer())
+            self._buffer = None
+        (self._file or self._buffer).write(b)
+        self._size += len(b)
+        return len(b)
+
+    def result(self):
+        """结束写入并返回 ``RenderedOutput``。"""
+        if self._file is not None:
+            self._file.close()
+            return RenderedOutput(path=self._file.name, size=self._size)
+        return RenderedOutput(data=self._buffer.getvalue(), size=self._size)
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            RenderedOutput(path=self._file.name).discard()
+
+
+def _import_add_module():
+    project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    if project_root not in sys.path:
+        sys.path.insert(0, project_root)
+    import modules.add
+    return modules.add
+
+
+def engine_version(engine=None, output_mode=None):
+    """渲染缓存键中使用的引擎标识：后端名称 + 输出模式 + 输出格式版本。"""
+    return f"{engine or WATERMARK_ENGINE}-{output_mode or WATERMARK_OUTPUT_MODE}-{_import_add_module().ENGINE_VERSION}"
+
+
+def linearize_enabled(setting=None):
+    """文档的线性化设置（None 表示未设置）与全局默认值合并。"""
+    return LINEARIZE if setting is None else bool(setting)
+
+
+def output_mode_for(linearize=False):
+    """线性化的文档总是整份重写（增量更新会使线性化失效），否则使用全局输出模式。"""
+    return 'linearized' if linearize else WATERMARK_OUTPUT_MODE
+
+
+def linearize_source(path):
+    """把已存储的原文件原地改写为线性化 PDF，返回是否改写（已线性化时不改动）。"""
+    return _import_add_module().linearize_file(path)
+
+
+def source_is_linearized(path):
+    """已存储的原文件是否已经线性化（只读，不改动文件）。"""
+    return _import_add_module().is_linearized(path)
+
+
+def analyze_source(path):
+    """入库校验与分析，见 ``modules.add.analyze_pdf``。"""
+    return _import_add_module().analyze_pdf(path)
+
+
+def resave_source(path, linearize=False):
+    """入库时原地修复/压缩（可同时线性化）已存储的原文件，见 ``modules.add.resave_file``。"""
+    _import_add_module().resave_file(path, linearize=linearize)
+
+
+def prepare_source(path, linearize=False, resave=False):
+    """校验尚未存储的新文件并按设置原地改写，返回改写后的分析结果（可在水印进程池中执行）。
+
+    文件被改写时结果中的 ``sha256`` / ``size`` 为新内容的值，否则为 None。
+    """
+    add = _import_add_module()
+    info = add.analyze_pdf(path)
+    if info['page_count'] == 0:
+        raise ValueError('PDF has no pages')
+    changed = False
+    if resave:
+        add.resave_file(path, linearize=linearize)
+        changed = True
+    elif linearize and not info['linearized']:
+        changed = add.linearize_file(path)
+    if changed:
+        info = add.analyze_pdf(path)
+    info['sha256'] = info['size'] = None
+    if changed:
+        import hashlib
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        info['sha256'], info['size'] = h.hexdigest(), os.path.getsize(path)
+    return info
+
+
+def _subprocess_add(input_pdf_path, watermark_text, font_size, opacity, engine=None, out_dir=None, output_mode=None, layout_text=None):
     project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
     add_py = os.path.join(project_root, 'modules', 'add.py')
     if not os.path.exists(add_py):
         raise FileNotFoundError(f"add.py not found at {add_py}")
 
-    tmp_out = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
+    tmp_out = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf', dir=out_dir)
     tmp_out.close()
 
-    cmd = [sys.executable, add_py, input_pdf_path, tmp_out.name, watermark_text, str(font_size), str(opacity)]
+    cmd = [sys.executable, add_py, input_pdf_path, tmp_out.name, watermark_text, str(font_size), str(opacity), f"--engine={engine or WATERMARK_ENGINE}", f"--output-mode={output_mode or WATERMARK_OUTPUT_MODE}"]
+    if layout_text is not None:
+        # 分层渲染：按完整模板排版，与直接调用的输出一致
+        cmd.append(f"--layout-text={layout_text}")
     proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
     if proc.returncode != 0:
         try:
@@ -24,7 +186,7 @@ def _subprocess_add(input_pdf_path, watermark_text, font_size, opacity):
     return tmp_out.name
 
 
-def run_add_watermark(input_pdf_path, watermark_text, font_size=40, opacity=0.3):
+def run_add_watermark(input_pdf_path, watermark_text, font_size=40, opacity=0.3, engine=None, output_mode=None):
     """优先尝试直接导入并调用 `modules.add.add_watermark`，若失败回退到子进程方式。
 
     返回带水印的临时文件路径。调用者负责删除该临时文件或交由后台任务清理。
@@ -32,6 +194,7 @@ def run_add_watermark(input_pdf_path, watermark_text, font_size=40, opacity=0.3)
     project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
     # 尝试直接导入模块以避免启动子进程（性能与可观测性更好）
+    tmp_out = None
     try:
         if project_root not in sys.path:
             sys.path.insert(0, project_root)
@@ -41,17 +204,79 @@ def run_add_watermark(input_pdf_path, watermark_text, font_size=40, opacity=0.3)
         tmp_out.close()
 
         # 调用模块内部函数（同步）
-        add_watermark_func(input_pdf_path, tmp_out.name, watermark_text, font_size=font_size, opacity=opacity)
+        add_watermark_func(input_pdf_path, tmp_out.name, watermark_text, font_size=font_size, opacity=opacity, engine=engine or WATERMARK_ENGINE, output_mode=output_mode or WATERMARK_OUTPUT_MODE)
         return tmp_out.name
+    except MemoryError:
+        # 超出任务内存上限（modules.add.MemoryLimitExceeded）：子进程同样会超出，不再回退
+        if tmp_out is not None and os.path.exists(tmp_out.name):
+            os.unlink(tmp_out.name)
+        raise
     except Exception as exc:
         # 如果直接调用失败，回退到原有的子进程实现
         try:
-            return _subprocess_add(input_pdf_path, watermark_text, font_size, opacity)
+            return _subprocess_add(input_pdf_path, watermark_text, font_size, opacity, engine=engine, output_mode=output_mode)
         except Exception:
             # 把原始异常与回退异常一起抛出，便于调试
             raise RuntimeError(f"Direct call failed: {exc}")
 
 
+def render_watermark_output(input_pdf_path, watermark_text, font_size=40, opacity=0.3, engine=None, spool_threshold=None, output_mode=None, layout_text=None, geometry=None):
+    """渲染水印并返回 ``RenderedOutput``，不经过系统临时目录。
+
+    输出在内存中累积，超过 ``spool_threshold``（默认 SECUREHUB_SPOOL_THRESHOLD_MB）
+    后溢出到 SECUREHUB_SPOOL_DIR。增量更新模式只生成追加段，源文件字节由读取方直接
+    从原文件流出。直接调用失败时回退到子进程，输出同样写入 spool 目录。
+    ``layout_text`` 见 ``modules.add.layout_watermark``（分层渲染时传入完整水印模板）。
+    ``geometry`` 为入库时记录的页面几何表（见 ``modules.add.collect_geometry``）。
+    """
+    output_mode = output_mode or WATERMARK_OUTPUT_MODE
+    project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    writer = SpoolWriter(spool_threshold)
+    try:
+        if project_root not in sys.path:
+            sys.path.insert(0, project_root)
+        from modules.add import add_watermark as add_watermark_func
+
+        incremental = output_mode == 'incremental'
+        stats = add_watermark_func(input_pdf_path, writer, watermark_text, font_size=font_size, opacity=opacity, engine=engine or WATERMARK_ENGINE, output_mode=output_mode, copy_source=not incremental, layout_text=layout_text,
+                                   geometry=geometry)
+        output = writer.result()
+        output.stats = stats.as_dict()
+        # 加密的源文件会回退为整份输出，此时没有前缀
+        if incremental and stats.output_mode == 'incremental':
+            output.prefix_path = input_pdf_path
+            output.size += os.path.getsize(input_pdf_path)
+        return output
+    except MemoryError:
+        writer.abort()
+        raise
+    except Exception as exc:
+        writer.abort()
+        try:
+            path = _subprocess_add(input_pdf_path, watermark_text, font_size, opacity, engine=engine, out_dir=ensure_spool_dir(), output_mode=output_mode,
+                                   layout_text=layout_text)
+        except Exception:
+            raise RuntimeError(f"Direct call failed: {exc}")
+        return RenderedOutput(path=path, size=os.path.getsize(path))
+
+
+def render_watermark_to_file(input_pdf_path, output_path, watermark_text, font_size=40, opacity=0.3, engine=None, output_mode=None, layout_text=None, geometry=None):
+    """渲染到指定路径，用于直接填充渲染缓存。返回渲染计量（``WatermarkStats.as_dict()``）。
+
+    先写入同目录下的临时文件再原子替换，读者不会看到写了一半的文件。
+    """
+    add_watermark_func = _import_add_module().add_watermark
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    try:
+        stats = add_watermark_func(input_pdf_path, tmp_path, watermark_text, font_size=font_size, opacity=opacity, engine=engine or WATERMARK_ENGINE, output_mode=output_mode or WATERMARK_OUTPUT_MODE, layout_text=layout_text,
+                                   geometry=geometry)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return stats.as_dict()
+
+
 if __name__ == '__main__':
     # 简单 CLI 用法，便于本地测试
     if len(sys.argv) < 4:
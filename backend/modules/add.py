@@ -1,77 +1,191 @@
 import sys
 import os
 import io
+import copy
+import math
+import shutil
+import tempfile
+import time
 from reportlab.pdfgen import canvas
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.lib.pagesizes import letter
 import pikepdf
+from pikepdf import Name, Operator
 
-def create_watermark(text, pagesize, font_size=40, opacity=0.3, rotation=45):
+WATERMARK_FONT = "Helvetica"
+# native 后端的共享字体字典在 stamp 缓存中的键（stamp 自身的键见 stamp_cache_key）
+FONT_CACHE_KEY = ('font', WATERMARK_FONT)
+
+# 水印渲染后端：reportlab 先生成 PDF 再由 pikepdf 解析；native 直接写内容流与资源
+ENGINES = ('reportlab', 'native')
+DEFAULT_ENGINE = 'reportlab'
+# 输出格式版本：修改水印外观或输出结构时递增，使已缓存的渲染结果失效
+ENGINE_VERSION = 3
+
+# 输出模式：full 重写整个文档；incremental 原样保留源文件字节，只追加一个增量更新段
+# （截断增量段即可得到无水印的原文件，只适合非对抗的标注）；
+# linearized 与 full 相同但按“快速 Web 查看”线性化保存，浏览器拿到首页相关的字节即可显示第一页
+OUTPUT_MODES = ('full', 'incremental', 'linearized')
+DEFAULT_OUTPUT_MODE = 'full'
+
+# 页数达到该阈值时自动按页段并行加水印（0 表示关闭自动并行）
+PARALLEL_MIN_PAGES = int(os.getenv('SECUREHUB_WATERMARK_PARALLEL_PAGES', '1000'))
+# 并行加水印使用的进程数（0 表示 CPU 核数）
+PARALLEL_WORKERS = int(os.getenv('SECUREHUB_WATERMARK_PARALLEL_WORKERS', '0'))
+
+# 低内存模式：以内存映射方式打开源文件（页面数据按需由内核换入换出，不计入进程私有内存），
+# 并行模式的合并结果经临时文件而不是内存缓冲
+LOW_MEMORY = os.getenv('SECUREHUB_WATERMARK_LOW_MEMORY', '0').lower() in ('1', 'true', 'yes')
+# 单个任务允许的内存增长上限（MB，相对任务开始时的 RSS）；0 表示不限制
+MAX_JOB_MEMORY_MB = float(os.getenv('SECUREHUB_WATERMARK_MAX_JOB_MB', '0'))
+# 逐页处理时每隔多少页检查一次内存；保存阶段每写出这么多字节检查一次
+MEMORY_CHECK_PAGES = 16
+MEMORY_CHECK_BYTES = 4 * 1024 * 1024
+
+
+class MemoryLimitExceeded(MemoryError):
+    """水印任务的内存增长超过上限（SECUREHUB_WATERMARK_MAX_JOB_MB / ``max_memory_mb``）。"""
+
+
+def current_rss():
+    """当前进程常驻内存（字节），非 Linux 平台返回 None。"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def _reset_peak_rss():
+    # 清零本进程的 VmHWM（Linux 4.0+），之后读到的峰值只属于当前任务
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class _MemoryGuard:
+    """跟踪一次任务的内存：记录峰值 RSS，增长超过上限时抛出 ``MemoryLimitExceeded``。
+
+    能清零 VmHWM 时峰值为内核记录的精确值（同一进程内并发的任务会互相计入），
+    否则为各检查点采样值中的最大者。
+    """
+
+    def __init__(self, limit_mb, stats):
+        self.limit = int(limit_mb * 1024 * 1024) if limit_mb else 0
+        self.stats = stats
+        self.exact = _reset_peak_rss()
+        self.start = current_rss()
+        stats.rss_start = stats.rss_peak = self.start
+        stats.memory_limit = self.limit or None
+
+    def attach(self, stats):
+        # 换用新的计量对象（并行模式失败改为逐页处理时）
+        stats.rss_start, stats.rss_peak, stats.memory_limit = self.start, self.stats.rss_peak, self.limit or None
+        self.stats = stats
+
+    def check(self, where):
+        rss = current_rss()
+        if rss is None or self.start is None:
+            return
+        peak = max(rss, (_peak_rss() or 0) if self.exact else 0, self.stats.rss_peak or 0)
+        self.stats.rss_peak = peak
+        if self.limit and peak - self.start > self.limit:
+            raise MemoryLimitExceeded(
+                f"Watermark job exceeded its memory limit while {where}: grew by {(peak - self.start) / 1048576:.1f} MB "
+                f"(limit {self.limit / 1048576:.1f} MB, started at {self.start / 1048576:.0f} MB RSS)")
+
+
+def split_watermark_lines(text):
+    """Split watermark text into lines (real newlines or a literal ``\\n``)"""
+    if '\n' in text:
+        return text.split('\n')
+    return text.split('\\n')
+
+
+def layout_watermark(text, pagesize, font_size=40, layout_text=None):
+    """Compute the effective font size and the unrotated origin of every line.
+
+    Coordinates are relative to the page center; both engines apply the same
+    rotation around that point, so their output is visually identical.
+    ``layout_text`` (default: ``text``) decides the font size and line spacing;
+    layers of one watermark pass the full text so their lines stay aligned.
+    Blank lines keep their slot but are not drawn.
+    """
+    width, height = pagesize
+
+    # Check if page is landscape (width > height)
+    is_landscape = width > height
+
+    # For landscape pages, reduce font size to prevent overflow
+    if is_landscape:
+        font_size = min(font_size, 35)
+
+    lines = split_watermark_lines(text)
+    line_height = font_size + 2
+
+    # Calculate maximum text width to ensure it fits within page
+    max_text_width = 0
+    for line in split_watermark_lines(layout_text or text):
+        max_text_width = max(max_text_width, stringWidth(line, WATERMARK_FONT, font_size))
+
+    # For landscape pages, we need to ensure text fits within the shorter dimension (height)
+    if is_landscape and max_text_width > height * 0.8:
+        scale_factor = (height * 0.8) / max_text_width
+        font_size = font_size * scale_factor
+        line_height = font_size + 2
+
+    # Calculate total text height
+    total_height = (len(lines) - 1) * line_height
+
+    placed = []
+    for i, line in enumerate(lines):
+        if not line:
+            continue
+        y_offset = total_height / 2 - i * line_height
+        text_width = stringWidth(line, WATERMARK_FONT, font_size)
+        placed.append((line, -text_width / 2, y_offset))
+    return font_size, placed
+
+
+def create_watermark(text, pagesize, font_size=40, opacity=0.3, rotation=45, layout_text=None):
     """Create watermark PDF page with proper orientation handling"""
     packet = io.BytesIO()
     
     # Create canvas
     c = canvas.Canvas(packet, pagesize=pagesize)
     
-    # Set font
-    c.setFont("Helvetica", font_size)
-    
     # Use RGBA color to set opacity
     c.setFillColorRGB(0.5, 0.5, 0.5, alpha=opacity)
     
     # Get page dimensions
     width, height = pagesize
-    
-    # Check if page is landscape (width > height)
-    is_landscape = width > height
-    
-    # For landscape pages, we need to adjust the watermark to fit better
-    if is_landscape:
-        # Reduce font size for landscape pages to prevent overflow
-        font_size = min(font_size, 35)
-        c.setFont("Helvetica", font_size)
-    
-    # Calculate center position
-    center_x = width / 2
-    center_y = height / 2
+    font_size, placed = layout_watermark(text, pagesize, font_size, layout_text)
+    c.setFont(WATERMARK_FONT, font_size)
     
     # Save current graphics state
     c.saveState()
     
     # Move to center and rotate
-    c.translate(center_x, center_y)
+    c.translate(width / 2, height / 2)
     c.rotate(rotation)
     
-    # Handle multi-line text
-    if '\n' in text:
-        lines = text.split('\n')
-    else:
-        lines = text.split('\\n')
-    
-    line_height = font_size + 2
-    
-    # Calculate total text height
-    total_height = (len(lines) - 1) * line_height
-    
-    # Calculate maximum text width to ensure it fits within page
-    max_text_width = 0
-    for line in lines:
-        text_width = c.stringWidth(line, "Helvetica", font_size)
-        max_text_width = max(max_text_width, text_width)
-    
-    # For landscape pages, we need to ensure text fits within the shorter dimension (height)
-    if is_landscape and max_text_width > height * 0.8:
-        # If text is too wide for landscape page, reduce font size further
-        scale_factor = (height * 0.8) / max_text_width
-        font_size = font_size * scale_factor
-        c.setFont("Helvetica", font_size)
-        line_height = font_size + 2
-        total_height = (len(lines) - 1) * line_height
-    
     # Draw each line of text
-    for i, line in enumerate(lines):
-        y_offset = total_height / 2 - i * line_height
-        text_width = c.stringWidth(line, "Helvetica", font_size)
-        c.drawString(-text_width / 2, y_offset, line)
+    for line, x, y in placed:
+        c.drawString(x, y, line)
     
     # Restore graphics state
     c.restoreState()
@@ -80,88 +194,1053 @@ def create_watermark(text, pagesize, font_size=40, opacity=0.3, rotation=45):
     packet.seek(0)
     return packet
 
-def add_watermark(input_pdf, output_pdf, watermark_text, font_size=40, opacity=0.3):
+
+def _native_font(pdf, stamp_cache):
+    # 同一文档内所有 native stamp 共用一个 Helvetica 字体字典
+    font = stamp_cache.get(FONT_CACHE_KEY)
+    if font is None:
+        font = pdf.make_indirect(pikepdf.Dictionary(
+            Type=Name.Font,
+            Subtype=Name.Type1,
+            BaseFont=Name('/' + WATERMARK_FONT),
+            Encoding=Name.WinAnsiEncoding,
+        ))
+        stamp_cache[FONT_CACHE_KEY] = font
+    return font
+
+
+def create_watermark_native(pdf, text, pagesize, font_size=40, opacity=0.3, rotation=45, stamp_cache=None, layout_text=None):
+    """Build the watermark Form XObject directly inside ``pdf``.
+
+    Emits the same operators reportlab would (ExtGState alpha, gray fill,
+    center translation + rotation, one BT/Tf/Tm/Tj block per line) without the
+    canvas round trip. Only reportlab's font metrics are used, via
+    ``layout_watermark``.
+    """
+    width, height = pagesize
+    font_size, placed = layout_watermark(text, pagesize, font_size, layout_text)
+
+    angle = math.radians(rotation)
+    cos_a, sin_a = math.cos(angle), math.sin(angle)
+
+    ops = [
+        ([0.5, 0.5, 0.5], Operator('rg')),
+        ([Name.GS0], Operator('gs')),
+        ([], Operator('q')),
+        ([cos_a, sin_a, -sin_a, cos_a, width / 2, height / 2], Operator('cm')),
+    ]
+    for line, x, y in placed:
+        ops.extend([
+            ([], Operator('BT')),
+            ([Name.F1, font_size], Operator('Tf')),
+            ([1, 0, 0, 1, x, y], Operator('Tm')),
+            # 标准 Type1 字体使用 WinAnsiEncoding，无法编码的字符以 ? 代替
+            ([pikepdf.String(line.encode('cp1252', errors='replace'))], Operator('Tj')),
+            ([], Operator('ET')),
+        ])
+    ops.append(([], Operator('Q')))
+
+    font = _native_font(pdf, stamp_cache if stamp_cache is not None else {})
+    resources = pikepdf.Dictionary(
+        Font=pikepdf.Dictionary(F1=font),
+        ExtGState=pikepdf.Dictionary(GS0=pikepdf.Dictionary(Type=Name.ExtGState, ca=opacity)),
+    )
+    stamp = pikepdf.Stream(pdf, pikepdf.unparse_content_stream(ops))
+    stamp.Type = Name.XObject
+    stamp.Subtype = Name.Form
+    stamp.BBox = [0, 0, width, height]
+    stamp.Resources = resources
+    return pdf.make_indirect(stamp)
+
+
+def stamp_cache_key(text, pagesize, font_size, opacity, rotation, layout_text=None):
+    """水印几何缓存键：相同文本、有效页面尺寸、字号、透明度与旋转角的页面共用同一个 stamp"""
+    return (text, (float(pagesize[0]), float(pagesize[1])), float(font_size), float(opacity), rotation, layout_text)
+
+
+def get_or_create_stamp(pdf, stamp_cache, text, pagesize, font_size=40, opacity=0.3, rotation=45, engine=DEFAULT_ENGINE, layout_text=None):
+    """返回属于 ``pdf`` 的水印 Form XObject，同一几何只构建一次。
+
+    第一次遇到某个几何时用所选后端生成 Form XObject 并放入目标文档；之后所有
+    相同几何的页面都引用这一个对象（字体等资源也只保存一份）。
+    """
+    key = stamp_cache_key(text, pagesize, font_size, opacity, rotation, layout_text)
+    stamp = stamp_cache.get(key)
+    if stamp is None and engine == 'native':
+        stamp = create_watermark_native(pdf, text, pagesize, font_size=font_size, opacity=opacity, rotation=rotation, stamp_cache=stamp_cache, layout_text=layout_text)
+        stamp_cache[key] = stamp
+    elif stamp is None:
+        watermark_packet = create_watermark(
+            text,
+            pagesize,
+            font_size=font_size,
+            opacity=opacity,
+            rotation=rotation,
+            layout_text=layout_text
+        )
+        with pikepdf.open(watermark_packet) as watermark_pdf:
+            formx = watermark_pdf.pages[0].as_form_xobject()
+            stamp = pdf.copy_foreign(formx)
+        stamp_cache[key] = stamp
+    return stamp
+
+
+def _inherited_attr(page_obj, key):
+    # 沿 /Parent 链查找可继承的页面属性（如 /Resources）
+    node = page_obj
+    while node is not None:
+        if key in node:
+            return node[key]
+        node = node.get('/Parent')
+    return None
+
+
+def _own_resources(page):
+    """让页面持有自己的直接 /Resources 与 /XObject 字典。
+
+    增量更新只重写页面字典本身；若资源字典是间接对象（可能被多个页面或页面树节点
+    共享）或继承自父节点，先复制一份直接字典挂到页面上，保证改动只落在页面对象里。
+    """
+    obj = page.obj
+    resources = obj.get('/Resources')
+    if resources is None:
+        resources = _inherited_attr(obj, '/Resources')
+    obj.Resources = copy.copy(resources) if resources is not None else pikepdf.Dictionary()
+    xobjects = obj.Resources.get('/XObject')
+    if xobjects is not None:
+        obj.Resources.XObject = copy.copy(xobjects)
+
+
+def place_stamp(pdf, page, stamp, content_cache):
+    """把水印 Form XObject 叠加到页面上，等价于 ``page.add_overlay(stamp)``。
+
+    与 add_overlay 不同，这里不合并（coalesce）页面原有内容流：原内容流保持不变，
+    前后各加一个共享的小内容流（q / Q + 绘制水印），既省去重写内容流的开销，
+    也让增量更新只需写入页面字典和新对象。
+    """
+    name = Name(f'/SHWm{stamp.objgen[0]}')
+    if '/Resources' not in page.obj or name not in page.obj.Resources.get('/XObject', {}):
+        page.add_resource(stamp, Name.XObject, name)
+    placement = page.calc_form_xobject_placement(stamp, name, pikepdf.Rectangle(page.trimbox), allow_shrink=True, allow_expand=True)
+
+    push = content_cache.get('push')
+    if push is None:
+        push = content_cache['push'] = pdf.make_indirect(pikepdf.Stream(pdf, b'q\n'))
+    tail = content_cache.get(placement)
+    if tail is None:
+        tail = content_cache[placement] = pdf.make_indirect(pikepdf.Stream(pdf, b'\nQ\n' + placement + b'\n'))
+
+    contents = page.obj.get('/Contents')
+    if contents is None:
+        items = []
+    elif isinstance(contents, pikepdf.Array):
+        items = list(contents)
+    else:
+        items = [contents]
+    page.obj.Contents = pikepdf.Array([push] + items + [tail])
+
+
+def _read_startxref(path):
+    # 返回 (startxref 偏移, 该处是否为传统 xref 表, 文件大小, 文件是否以换行结尾)
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(max(0, size - 2048))
+        tail = f.read()
+        pos = tail.rfind(b'startxref')
+        if pos < 0:
+            raise ValueError('startxref not found')
+        offset = int(tail[pos + len(b'startxref'):].split()[0])
+        f.seek(offset)
+        is_table = f.read(4) == b'xref'
+    return offset, is_table, size, tail.endswith((b'\n', b'\r'))
+
+
+def _collect_new_objects(roots, first_new_id):
+    """从被修改的页面出发，收集所有新建的间接对象（编号 >= first_new_id）。"""
+    found = {}
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, pikepdf.Stream):
+            children = obj.stream_dict.values()
+        elif isinstance(obj, pikepdf.Dictionary):
+            children = obj.values()
+        elif isinstance(obj, pikepdf.Array):
+            children = list(obj)
+        else:
+            continue
+        for child in children:
+            # 标量会被 pikepdf 转成 Python 类型；新建的间接对象都是容器或流
+            if not isinstance(child, (pikepdf.Dictionary, pikepdf.Array, pikepdf.Stream)):
+                continue
+            if child.is_indirect:
+                if child.objgen[0] < first_new_id or child.objgen in found:
+                    continue
+                found[child.objgen] = child
+            stack.append(child)
+    return found
+
+
+def _serialize_object(obj):
+    num, gen = obj.objgen
+    if isinstance(obj, pikepdf.Stream):
+        raw = obj.read_raw_bytes()
+        stream_dict = copy.copy(obj.stream_dict)
+        stream_dict.Length = len(raw)
+        body = stream_dict.unparse(resolved=True) + b'\nstream\n' + raw + b'\nendstream'
+    else:
+        body = obj.unparse(resolved=True)
+    return f'{num} {gen} obj\n'.encode() + body + b'\nendobj\n'
+
+
+def _xref_rows(offsets):
+    # 把 [(编号, 代号, 偏移)] 分成连续编号的子段
+    rows = sorted(offsets)
+    sections = []
+    for num, gen, offset in rows:
+        if sections and sections[-1][0] + len(sections[-1][1]) == num:
+            sections[-1][1].append((gen, offset))
+        else:
+            sections.append((num, [(gen, offset)]))
+    return sections
+
+
+def write_incremental_update(pdf, source_path, out, touched_pages, first_new_id, copy_source=True):
+    """把对 ``pdf`` 的修改作为 PDF 增量更新追加到源文件之后写入 ``out``。
+
+    只写入被修改的页面字典和从它们可达的新对象（水印、共享内容流、字体等），
+    再加一个以 /Prev 指向原 xref 的交叉引用段；源文件字节原样保留。
+    ``out`` 为路径时用 ``shutil.copyfile``（Linux 上走 sendfile/copy_file_range）复制源文件；
+    ``copy_source=False`` 时只写增量段，由调用方负责先输出源文件字节。
+    返回写入的增量段字节数。
+    """
+    return _write_update_section(pdf, source_path, out, _serialize_update(touched_pages, first_new_id), copy_source=copy_source)
+
+
+def _serialize_update(touched_pages, first_new_id):
+    """被修改的页面字典与从它们可达的新对象，序列化为 {(编号, 代号): 字节}。"""
+    objects = {page.obj.objgen: page.obj for page in touched_pages}
+    objects.update(_collect_new_objects([page.obj for page in touched_pages], first_new_id))
+    return {objgen: _serialize_object(obj) for objgen, obj in objects.items()}
+
+
+def _write_update_section(pdf, source_path, out, serialized, copy_source=True):
+    # 写出增量更新段（对象 + 交叉引用 + trailer），``serialized`` 见 _serialize_update
+    prev_xref, is_table, source_size, ends_with_newline = _read_startxref(source_path)
+
+    update = io.BytesIO()
+    if not ends_with_newline:
+        update.write(b'\n')
+    offsets = []
+    for objgen in sorted(serialized):
+        offsets.append((objgen[0], objgen[1], source_size + update.tell()))
+        update.write(serialized[objgen])
+
+    trailer = pikepdf.Dictionary(
+        Size=max(int(pdf.trailer.Size), max(num for num, _ in serialized) + 1),
+        Root=pdf.trailer.Root,
+        Prev=prev_xref,
+    )
+    if '/Info' in pdf.trailer:
+        trailer.Info = pdf.trailer.Info
+    if '/ID' in pdf.trailer:
+        trailer.ID = pdf.trailer.ID
+
+    xref_offset = source_size + update.tell()
+    if is_table:
+        update.write(b'xref\n')
+        for start, entries in _xref_rows(offsets):
+            update.write(f'{start} {len(entries)}\n'.encode())
+            for gen, offset in entries:
+                update.write(f'{offset:010d} {gen:05d} n\r\n'.encode())
+        update.write(b'trailer\n' + trailer.unparse() + b'\n')
+    else:
+        # 源文件使用交叉引用流（PDF 1.5+）：增量段同样写交叉引用流
+        xref_num = int(trailer.Size)
+        trailer.Size = xref_num + 1
+        offsets.append((xref_num, 0, xref_offset))
+        width = max(4, (xref_offset.bit_length() + 7) // 8)
+        data = b''.join(b'\x01' + offset.to_bytes(width, 'big') + gen.to_bytes(2, 'big')
+                        for _, entries in _xref_rows(offsets) for gen, offset in entries)
+        index = []
+        for start, entries in _xref_rows(offsets):
+            index.extend([start, len(entries)])
+        trailer.Type = Name.XRef
+        trailer.W = [1, width, 2]
+        trailer.Index = index
+        trailer.Length = len(data)
+        update.write(f'{xref_num} 0 obj\n'.encode() + trailer.unparse() + b'\nstream\n' + data + b'\nendstream\nendobj\n')
+    update.write(f'startxref\n{xref_offset}\n%%EOF\n'.encode())
+
+    tail = update.getvalue()
+    if isinstance(out, (str, bytes, os.PathLike)):
+        if copy_source:
+            shutil.copyfile(source_path, out)
+        with open(out, 'ab' if copy_source else 'wb') as f:
+            f.write(tail)
+    else:
+        if copy_source:
+            with open(source_path, 'rb') as f:
+                shutil.copyfileobj(f, out, 1024 * 1024)
+        out.write(tail)
+    return len(tail)
+
+
+class WatermarkStats:
+    """一次 add_watermark 调用的计量结果，用于把尾延迟归因到具体文档。
+
+    ``timings`` 记录各阶段耗时（秒）：open 打开源文件、stamp_build 构建水印
+    Form XObject、overlay 叠加到页面、save 写出结果、total 总耗时。并行模式下
+    stamp_build / overlay 为各页段 CPU 时间之和，``speedup`` 为它们与并行墙钟时间之比。
+    ``cache`` 由调用方填写（例如渲染缓存命中/未命中）。``rss_start`` / ``rss_peak``
+    为任务开始时与峰值的常驻内存（字节，并行模式下峰值取各进程中的最大者），
+    ``access_mode`` 为源文件打开方式（default / mmap），``precomputed_geometry`` 表示是否
+    使用了入库时记录的页面几何表。
+    """
+
+    PHASES = ('open', 'stamp_build', 'overlay', 'save')
+
+    def __init__(self, engine, output_mode):
+        self.engine = engine
+        self.output_mode = output_mode
+        self.parallel = False
+        self.workers = 1
+        self.speedup = None
+        self.cache = None
+        self.page_count = 0
+        self.portrait_pages = 0
+        self.landscape_pages = 0
+        self.stamps = 0
+        self.bytes_in = None
+        self.bytes_out = None
+        self.access_mode = 'default'
+        self.precomputed_geometry = False
+        self.rss_start = None
+        self.rss_peak = None
+        self.memory_limit = None
+        self.timings = dict.fromkeys(self.PHASES + ('total',), 0.0)
+
+    def add_time(self, phase, seconds):
+        self.timings[phase] += seconds
+
+    def as_dict(self):
+        return dict(vars(self), timings=dict(self.timings))
+
+
+class _CountingWriter(io.RawIOBase):
+    # 统计写入调用方给出的流的字节数，并在保存过程中定期检查内存
+    def __init__(self, raw, guard=None):
+        super().__init__()
+        self.raw = raw
+        self.count = 0
+        self.guard = guard
+        self._next_check = MEMORY_CHECK_BYTES
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        n = self.raw.write(b)
+        n = len(b) if n is None else n
+        self.count += n
+        if self.guard is not None and self.count >= self._next_check:
+            self._next_check = self.count + MEMORY_CHECK_BYTES
+            self.guard.check('saving')
+        return n
+
+
+def _quiet(*args, **kwargs):
+    pass
+
+
+def page_geometry(page):
+    """页面的 (宽, 高, /Rotate)，即加水印时用到的几何信息。"""
+    mediabox = page.mediabox
+    width = float(mediabox[2]) - float(mediabox[0])
+    height = float(mediabox[3]) - float(mediabox[1])
+    # Some PDFs store landscape pages as rotated portrait pages
+    rotation = int(page.Rotate) if '/Rotate' in page else 0
+    return width, height, rotation
+
+
+def collect_geometry(pdf):
+    """整个文档的页面几何表（可直接存为 JSON）：
+
+    ``{'sizes': [[宽, 高, 旋转], ...], 'pages': [每页在 sizes 中的下标, ...]}``
+    """
+    sizes = {}
+    pages = []
+    for page in pdf.pages:
+        pages.append(sizes.setdefault(page_geometry(page), len(sizes)))
+    return {'sizes': [list(geometry) for geometry in sizes], 'pages': pages}
+
+
+def expand_geometry(table):
+    """``collect_geometry`` 的逆操作：返回逐页的 (宽, 高, 旋转) 列表。"""
+    sizes = [(float(width), float(height), int(rotation)) for width, height, rotation in table['sizes']]
+    return [sizes[index] for index in table['pages']]
+
+
+def _stamp_page(pdf, page, index, watermark_text, font_size, opacity, engine, layout_text,
+                stamp_cache, content_cache, incremental, stats, log=_quiet, geometry=None):
+    """给单个页面叠加水印，返回页面是否为横向。``geometry`` 为预先计算的 ``page_geometry``。"""
+    # Get page dimensions
+    width, height, rotation = geometry or page_geometry(page)
+
+    # Check page orientation
+    is_landscape = width > height
+    log(f"  Page {index + 1}: {'Landscape' if is_landscape else 'Portrait'} ({width:.1f}x{height:.1f})")
+    if rotation:
+        log(f"  Page has rotation: {rotation} degrees")
+
+    # Create watermark - pass the actual pagesize
+    pagesize = (width, height)
+
+    # For rotated pages, we might need to adjust
+    # If page is rotated 90 or 270 degrees, dimensions are swapped
+    if rotation in [90, 270]:
+        # Swap width and height for rotated pages
+        pagesize = (height, width)
+        log(f"  Adjusted pagesize for rotation: {pagesize}")
+
+    began = time.perf_counter()
+    stamp = get_or_create_stamp(
+        pdf,
+        stamp_cache,
+        watermark_text,
+        pagesize,
+        font_size=font_size,
+        opacity=opacity,
+        rotation=45,  # 水印自身的旋转角度
+        engine=engine,
+        layout_text=layout_text
+    )
+    built = time.perf_counter()
+
+    # 将共享的水印 Form XObject 叠加到页面
+    if incremental:
+        _own_resources(page)
+    place_stamp(pdf, page, stamp, content_cache)
+    stats.add_time('stamp_build', built - began)
+    stats.add_time('overlay', time.perf_counter() - built)
+    return is_landscape
+
+
+def _page_range_stride(pages):
+    # 每个页段预留的对象编号数：每页最多一个 stamp（reportlab stamp 连同其字体、
+    # 图形状态等约 4 个对象）和一个尾部内容流，另加共享的 q 流与字体
+    return 8 * pages + 64
+
+
+def _stamp_page_range(input_pdf, start, stop, id_base, watermark_text, font_size, opacity, engine, layout_text,
+                      low_memory=False, max_memory_mb=0, geometry=None):
+    """并行模式的工作进程任务：给 [start, stop) 页加水印，返回序列化后的增量对象。
+
+    新对象编号限定在 [id_base, id_base + stride) 内：先分配占位对象把编号推到
+    id_base，各页段的编号因此互不重叠，父进程可以直接合并。内存上限对每个进程分别生效。
+    """
+    # 记录 CPU 时间而不是墙钟时间：各段 CPU 时间之和约等于串行处理的耗时
+    stats = WatermarkStats(engine, 'incremental')
+    guard = _MemoryGuard(max_memory_mb, stats)
+    access_mode = pikepdf.AccessMode.mmap if low_memory else pikepdf.AccessMode.default
+    with pikepdf.open(input_pdf, access_mode=access_mode) as pdf:
+        first_new_id = int(pdf.trailer.Size)
+        while pdf.make_indirect(pikepdf.Dictionary()).objgen[0] < id_base - 1:
+            pass
+        id_limit = id_base + _page_range_stride(stop - start)
+        stamp_cache = {}
+        content_cache = {}
+        pages = [pdf.pages[i] for i in range(start, stop)]
+        landscape = 0
+        began = time.process_time()
+        for offset, page in enumerate(pages):
+            landscape += _stamp_page(pdf, page, start + offset, watermark_text, font_size, opacity, engine, layout_text,
+                                     stamp_cache, content_cache, True, stats, geometry=geometry[offset] if geometry else None)
+            if offset % MEMORY_CHECK_PAGES == MEMORY_CHECK_PAGES - 1:
+                guard.check(f'stamping page {start + offset + 1}')
+        serialized = _serialize_update(pages, first_new_id)
+        cpu = time.process_time() - began
+        guard.check(f'serializing pages {start + 1}-{stop}')
+    new_ids = [num for num, _ in serialized if num >= first_new_id]
+    if new_ids and (min(new_ids) < id_base or max(new_ids) >= id_limit):
+        raise RuntimeError(f'object ids for pages {start}-{stop} escaped their reserved range')
+    stamps = len(stamp_cache) - (FONT_CACHE_KEY in stamp_cache)
+    return serialized, landscape, stamps, cpu, stats.timings, stats.rss_peak
+
+
+_parallel_pool = None
+
+
+def _get_parallel_pool(workers):
+    # 进程在多次调用间复用（例如 Web 水印进程池中的工作进程），spawn 避免 fork 带线程的父进程
+    global _parallel_pool
+    if _parallel_pool is None or _parallel_pool._max_workers != workers:
+        import concurrent.futures
+        import multiprocessing
+        if _parallel_pool is not None:
+            _parallel_pool.shutdown()
+        _parallel_pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    return _parallel_pool
+
+
+def _reset_parallel_pool():
+    global _parallel_pool
+    if _parallel_pool is not None:
+        _parallel_pool.shutdown(wait=False, cancel_futures=True)
+        _parallel_pool = None
+
+
+def _parallel_workers(workers=None):
+    return workers or PARALLEL_WORKERS or os.cpu_count() or 1
+
+
+def should_parallelize(page_count, parallel=None, workers=None):
+    """``parallel`` 为 None 时按页数阈值（SECUREHUB_WATERMARK_PARALLEL_PAGES）自动决定。"""
+    if _parallel_workers(workers) < 2 or page_count < 2:
+        return False
+    if parallel is None:
+        return PARALLEL_MIN_PAGES > 0 and page_count >= PARALLEL_MIN_PAGES
+    return bool(parallel)
+
+
+def _add_watermark_parallel(pdf, input_pdf, output_pdf, watermark_text, font_size, opacity, engine, layout_text,
+                            incremental, copy_source, workers, stats, log=_quiet, low_memory=False, max_memory_mb=0, geometry=None):
+    """按页段把文档分给多个进程加水印，再把各段的增量对象合并为一个增量更新段。
+
+    目录、书签、链接与元数据对象都不在增量段中，原样保留。``incremental`` 为 False
+    时把合并结果再整份重写一次。页数、stamp 数与各阶段耗时记入 ``stats``。
+    """
+    page_count = len(pdf.pages)
+    workers = min(_parallel_workers(workers), page_count)
+    bounds = [page_count * k // workers for k in range(workers + 1)]
+    id_base = int(pdf.trailer.Size)
+    jobs = []
+    executor = _get_parallel_pool(workers)
+    began = time.perf_counter()
+    for start, stop in zip(bounds, bounds[1:]):
+        jobs.append(executor.submit(_stamp_page_range, os.fspath(input_pdf), start, stop, id_base,
+                                    watermark_text, font_size, opacity, engine, layout_text, low_memory, max_memory_mb,
+                                    geometry[start:stop] if geometry else None))
+        id_base += _page_range_stride(stop - start)
+
+    serialized = {}
+    cpu = 0.0
+    for job in jobs:
+        objects, slice_landscape, slice_stamps, slice_cpu, slice_timings, slice_peak = job.result()
+        serialized.update(objects)
+        if slice_peak is not None:
+            stats.rss_peak = max(stats.rss_peak or 0, slice_peak)
+        stats.landscape_pages += slice_landscape
+        stats.stamps += slice_stamps
+        stats.add_time('stamp_build', slice_timings['stamp_build'])
+        stats.add_time('overlay', slice_timings['overlay'])
+        cpu += slice_cpu
+    wall = time.perf_counter() - began
+    stats.parallel = True
+    stats.workers = workers
+    stats.speedup = cpu / wall if wall else None
+    stats.portrait_pages = page_count - stats.landscape_pages
+    log(f"Parallel stamping: {page_count} pages in {workers} slices, {wall:.2f}s wall vs {cpu:.2f}s summed "
+        f"slice CPU time ({stats.speedup or 0:.1f}x speedup)")
+
+    began = time.perf_counter()
+    if incremental:
+        _write_update_section(pdf, input_pdf, output_pdf, serialized, copy_source=copy_source)
+    else:
+        # 低内存模式下合并结果写临时文件（与源文件同样大），不在内存中再放一份
+        merged = tempfile.TemporaryFile() if low_memory else io.BytesIO()
+        with merged:
+            _write_update_section(pdf, input_pdf, merged, serialized)
+            merged.seek(0)
+            with pikepdf.open(merged) as merged_pdf:
+                merged_pdf.save(output_pdf, deterministic_id=True, linearize=stats.output_mode == 'linearized')
+    stats.add_time('save', time.perf_counter() - began)
+
+
+def add_watermark(input_pdf, output_pdf, watermark_text, font_size=40, opacity=0.3, engine=DEFAULT_ENGINE, output_mode=DEFAULT_OUTPUT_MODE, copy_source=True, layout_text=None,
+                  parallel=None, workers=None, verbose=False, on_phase=None, on_complete=None, low_memory=None, max_memory_mb=None,
+                  geometry=None):
+    """Stamp every page of ``input_pdf`` and write the result to ``output_pdf`` (path or binary stream).
+
+    ``output_mode='incremental'`` keeps the source bytes untouched and appends an
+    incremental update holding only the new stamp objects and the modified page
+    dictionaries; with ``copy_source=False`` only that update section is written.
+    The untouched source survives in full before the update, so anyone can strip
+    the watermark by truncating at the first ``%%EOF``: use it only for
+    non-adversarial stamping, never for leak tracing.
+    Encrypted sources always fall back to a full save (the whole document is
+    written even with ``copy_source=False``). ``output_mode='linearized'`` is a
+    full save laid out for fast web view; the extra time is in ``timings['save']``.
+
+    ``layout_text`` is the complete watermark when ``watermark_text`` is only one
+    layer of it (see ``layout_watermark``).
+
+    Documents with at least SECUREHUB_WATERMARK_PARALLEL_PAGES pages are split
+    into page ranges stamped by ``workers`` processes (``parallel=True/False``
+    forces the choice). This needs an unencrypted source file path.
+
+    ``low_memory`` (default SECUREHUB_WATERMARK_LOW_MEMORY) opens source paths
+    memory-mapped. ``max_memory_mb`` (default SECUREHUB_WATERMARK_MAX_JOB_MB)
+    caps how far RSS may grow during the job; it is checked every few pages and
+    while writing to stream outputs, and ``MemoryLimitExceeded`` is raised when
+    it is crossed. Start and peak RSS are recorded in the stats.
+
+    ``geometry`` is the page geometry table recorded at ingest (``collect_geometry``);
+    pages then skip the MediaBox and /Rotate lookups. It is ignored if its page
+    count does not match the document.
+
+    Returns a ``WatermarkStats``; ``stats.output_mode`` is the mode actually used.
+    ``on_phase(phase, seconds, stats)`` is called as each phase finishes and
+    ``on_complete(stats)`` once at the end. Progress is only printed with
+    ``verbose=True`` (the CLI).
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown watermark engine: {engine!r} (expected one of {', '.join(ENGINES)})")
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(f"Unknown output mode: {output_mode!r} (expected one of {', '.join(OUTPUT_MODES)})")
+    log = print if verbose else _quiet
+    low_memory = LOW_MEMORY if low_memory is None else low_memory
+    max_memory_mb = MAX_JOB_MEMORY_MB if max_memory_mb is None else max_memory_mb
+    stats = WatermarkStats(engine, output_mode)
+    guard = _MemoryGuard(max_memory_mb, stats)
+
+    def finish(phase, began):
+        elapsed = time.perf_counter() - began
+        if phase != 'total':
+            stats.add_time(phase, elapsed)
+        else:
+            stats.timings['total'] = elapsed
+        if on_phase is not None:
+            on_phase(phase, stats.timings[phase], stats)
+
+    started = time.perf_counter()
+    is_path = isinstance(input_pdf, (str, bytes, os.PathLike))
+    writes_path = isinstance(output_pdf, (str, bytes, os.PathLike))
     try:
         # 使用pikepdf打开PDF，它会自动保留书签和链接
-        print(f"Opening PDF with pikepdf...")
-        pdf = pikepdf.open(input_pdf)
+        log(f"Opening PDF with pikepdf...")
+        if low_memory and is_path:
+            pdf = pikepdf.open(input_pdf, access_mode=pikepdf.AccessMode.mmap)
+            stats.access_mode = 'mmap'
+        else:
+            pdf = pikepdf.open(input_pdf)
+        if is_path:
+            stats.bytes_in = os.path.getsize(input_pdf)
+        stats.page_count = len(pdf.pages)
+        pages_geometry = expand_geometry(geometry) if geometry else None
+        if pages_geometry is not None and len(pages_geometry) != stats.page_count:
+            log("Precomputed page geometry does not match the document; reading it from the pages.")
+            pages_geometry = None
+        stats.precomputed_geometry = pages_geometry is not None
+        finish('open', started)
+        guard.check('opening the source')
         
-        print(f"Processing PDF, {len(pdf.pages)} pages in total.")
-        
-        # 收集页面方向信息
-        portrait_count = 0
-        landscape_count = 0
-        
-        # Process each page
-        for i, page in enumerate(pdf.pages):
-            print(f"Processing page {i + 1} ...")
-            
-            # Get page dimensions
-            mediabox = page.MediaBox
-            width = float(mediabox[2]) - float(mediabox[0])
-            height = float(mediabox[3]) - float(mediabox[1])
-            
-            # Check page orientation
-            is_landscape = width > height
-            if is_landscape:
-                landscape_count += 1
-                print(f"  Page {i+1}: Landscape ({width:.1f}x{height:.1f})")
+        log(f"Processing PDF, {len(pdf.pages)} pages in total.")
+
+        incremental = output_mode == 'incremental'
+        if not incremental and not copy_source:
+            raise ValueError("copy_source=False is only valid for incremental output")
+        # 增量更新与并行模式都需要在未加密的源文件之后追加对象
+        appendable = not pdf.is_encrypted and is_path
+        if incremental and not appendable:
+            log("Incremental output needs an unencrypted source file path; falling back to a full save.")
+            incremental = False
+        stats.output_mode = 'incremental' if incremental else ('linearized' if output_mode == 'linearized' else 'full')
+        # 之后新建的间接对象编号都不小于它
+        first_new_id = int(pdf.trailer.Size)
+        out = output_pdf if writes_path else _CountingWriter(output_pdf, guard)
+
+        done = False
+        if appendable and should_parallelize(len(pdf.pages), parallel, workers):
+            try:
+                _add_watermark_parallel(pdf, input_pdf, out, watermark_text, font_size, opacity, engine,
+                                        layout_text, incremental, copy_source, workers, stats, log,
+                                        low_memory=low_memory, max_memory_mb=max_memory_mb, geometry=pages_geometry)
+                done = True
+            except MemoryLimitExceeded:
+                # 逐页处理同样会超出上限
+                raise
+            except Exception as exc:
+                # 并行模式不修改父进程中的 pdf，可以直接改为逐页处理
+                log(f"Parallel stamping failed ({exc!r}); falling back to serial processing.")
+                _reset_parallel_pool()
+                if not writes_path and out.count:
+                    # 流式输出已写入部分内容，无法重来
+                    raise
+                access_mode = stats.access_mode
+                stats = WatermarkStats(engine, stats.output_mode)
+                stats.access_mode, stats.precomputed_geometry = access_mode, pages_geometry is not None
+                guard.attach(stats)
+                stats.page_count, stats.bytes_in = len(pdf.pages), os.path.getsize(input_pdf)
+                stats.timings['open'] = time.perf_counter() - started
             else:
-                portrait_count += 1
-                print(f"  Page {i+1}: Portrait ({width:.1f}x{height:.1f})")
-            
-            # Adjust rotation for landscape pages if needed
-            # Some PDFs store landscape pages as rotated portrait pages
-            rotation = 0
-            if '/Rotate' in page:
-                rotation = page.Rotate
-                print(f"  Page has rotation: {rotation} degrees")
-            
-            # Create watermark - pass the actual pagesize
-            pagesize = (width, height)
-            
-            # For rotated pages, we might need to adjust
-            # If page is rotated 90 or 270 degrees, dimensions are swapped
-            if rotation in [90, 270]:
-                # Swap width and height for rotated pages
-                pagesize = (height, width)
-                print(f"  Adjusted pagesize for rotation: {pagesize}")
-            
-            watermark_packet = create_watermark(
-                watermark_text, 
-                pagesize, 
-                font_size=font_size, 
-                opacity=opacity,
-                rotation=45  # 水印自身的旋转角度
-            )
-            
-            # 使用pikepdf将水印添加到页面
-            watermark_pdf = pikepdf.open(watermark_packet)
-            watermark_page = watermark_pdf.pages[0]
-            
-            # 将水印作为背景添加到页面
-            page.add_overlay(watermark_page)
+                if on_phase is not None:
+                    for phase in ('stamp_build', 'overlay', 'save'):
+                        on_phase(phase, stats.timings[phase], stats)
+        if not done:
+            # 同一文档内按几何缓存水印 Form XObject，以及各页共用的 q / Q 内容流
+            stamp_cache = {}
+            content_cache = {}
+
+            # Process each page
+            for i, page in enumerate(pdf.pages):
+                log(f"Processing page {i + 1} ...")
+                if _stamp_page(pdf, page, i, watermark_text, font_size, opacity, engine, layout_text,
+                               stamp_cache, content_cache, incremental, stats, log,
+                               geometry=pages_geometry[i] if pages_geometry else None):
+                    stats.landscape_pages += 1
+                else:
+                    stats.portrait_pages += 1
+                if i % MEMORY_CHECK_PAGES == MEMORY_CHECK_PAGES - 1:
+                    guard.check(f'stamping page {i + 1}')
+            stats.stamps = len(stamp_cache) - (FONT_CACHE_KEY in stamp_cache)
+            if on_phase is not None:
+                on_phase('stamp_build', stats.timings['stamp_build'], stats)
+                on_phase('overlay', stats.timings['overlay'], stats)
+
+            # 保存文件 - pikepdf会自动保留所有文档结构
+            began = time.perf_counter()
+            if incremental:
+                log("\nAppending incremental update...")
+                appended = write_incremental_update(pdf, input_pdf, out, pdf.pages, first_new_id, copy_source=copy_source)
+                log(f"  Update section: {appended} bytes")
+            else:
+                log("\nSaving output file...")
+                pdf.save(out, deterministic_id=True, linearize=stats.output_mode == 'linearized')
+            finish('save', began)
+
+        stats.bytes_out = os.path.getsize(output_pdf) if writes_path else out.count
+        guard.check('saving')
+        finish('total', started)
+
+        log(f"\nBuilt {stats.stamps} distinct watermark stamp(s) for {len(pdf.pages)} pages.")
         
         # 打印页面方向统计
-        print(f"\nPage orientation summary:")
-        print(f"  Portrait pages: {portrait_count}")
-        print(f"  Landscape pages: {landscape_count}")
-        
-        # 保存文件 - pikepdf会自动保留所有文档结构
-        print("\nSaving output file...")
-        pdf.save(output_pdf)
+        log(f"\nPage orientation summary:")
+        log(f"  Portrait pages: {stats.portrait_pages}")
+        log(f"  Landscape pages: {stats.landscape_pages}")
+        log("\nTimings: " + ", ".join(f"{phase} {seconds * 1000:.1f} ms" for phase, seconds in stats.timings.items()))
+        if stats.rss_peak is not None:
+            log(f"Memory: peak RSS {stats.rss_peak / 1048576:.1f} MB (started at {stats.rss_start / 1048576:.1f} MB, source opened with {stats.access_mode} access)")
         
-        print(f"\nCompleted. Output: {output_pdf}")
-        print("Note: Document structure (bookmarks, links, metadata) has been preserved.")
+        log(f"\nCompleted. Output: {output_pdf}")
+        log("Note: Document structure (bookmarks, links, metadata) has been preserved.")
+        if on_complete is not None:
+            on_complete(stats)
+        return stats
         
     except Exception as e:
-        print(f"Error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log(f"Error: {str(e)}")
+        if verbose:
+            import traceback
+            traceback.print_exc()
         # 抛出异常而不是退出进程，让调用方决定如何处理（CLI 会退出，库调用可捕获）
         raise
 
+def analyze_pdf(path):
+    """入库时的校验与分析：打开文档并返回页数、页面几何表、是否加密与结构问题列表。
+
+    无法打开（不是 PDF、损坏或需要密码）时抛出 pikepdf 的异常。
+    """
+    with pikepdf.open(path) as pdf:
+        return {
+            'page_count': len(pdf.pages),
+            'geometry': collect_geometry(pdf),
+            'encrypted': pdf.is_encrypted,
+            'linearized': pdf.is_linearized,
+            'problems': [str(problem) for problem in pdf.check_pdf_syntax()],
+        }
+
+
+def resave_file(path, linearize=False):
+    """原地重写 ``path``：修复可恢复的结构问题并压缩（对象流、压缩内容流），可同时线性化。
+
+    先写同目录临时文件再原子替换。
+    """
+    tmp_path = f"{path}.{os.getpid()}.resave.tmp"
+    try:
+        with pikepdf.open(path) as pdf:
+            pdf.save(tmp_path, compress_streams=True, object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                     linearize=linearize, deterministic_id=True)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def is_linearized(path):
+    """``path`` 是否已经是线性化 PDF（只读取文件头与交叉引用表）。"""
+    with pikepdf.open(path) as pdf:
+        return pdf.is_linearized
+
+
+def linearize_file(path):
+    """把 ``path`` 原地改写为线性化 PDF（先写同目录临时文件再原子替换）。
+
+    已经线性化的文件不做任何改动，返回是否改写。
+    """
+    with pikepdf.open(path) as pdf:
+        if pdf.is_linearized:
+            return False
+        tmp_path = f"{path}.{os.getpid()}.linearize.tmp"
+        try:
+            pdf.save(tmp_path, linearize=True, deterministic_id=True)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+    return True
+
+# ---------------------------------------------------------------------------
+# 批量模式：python add.py batch <目录|通配符|清单.csv> ...
+# ---------------------------------------------------------------------------
+
+def _is_glob(pattern):
+    return any(ch in pattern for ch in '*?[')
+
+
+def _is_within(path, directory):
+    path, directory = os.path.realpath(path), os.path.realpath(directory)
+    return os.path.commonpath([path, directory]) == directory
+
+
+def _check_batch_outputs(jobs):
+    # 进程池启动前检查：两个任务写同一个输出，或输出覆盖另一个任务的输入，结果取决于完成顺序
+    inputs = {os.path.realpath(job[0]) for job in jobs}
+    seen = {}
+    for source, output, _text in jobs:
+        key = os.path.realpath(output)
+        if key in seen:
+            raise ValueError(f"{seen[key]} and {source} both write {output}")
+        if key in inputs:
+            raise ValueError(f"{output} is also a batch input")
+        seen[key] = source
+    return jobs
+
+
+def collect_batch_jobs(source, output_dir=None, watermark_text=None):
+    """把批量任务来源展开为 [(输入, 输出, 水印文本)]。
+
+    ``source`` 可以是单个 PDF、目录（递归查找 *.pdf）、通配符（支持 **）或 CSV 清单文件，
+    清单每行为 ``输入,输出[,水印文本]``（可有 input,output,text 表头，相对路径相对
+    清单所在目录）。其余模式下输出写到 ``output_dir``，目录与通配符保留相对目录结构，
+    水印文本统一为 ``watermark_text``。
+
+    输出目录位于来源目录之内（再次运行会把上次的输出当作输入）或多个任务写同一个
+    输出时抛出 ``ValueError``。
+    """
+    import csv
+    import glob
+
+    if os.path.isfile(source) and not source.lower().endswith('.pdf'):
+        base = os.path.dirname(os.path.abspath(source))
+        jobs = []
+        with open(source, newline='', encoding='utf-8') as f:
+            for lineno, row in enumerate(csv.reader(f), 1):
+                if not row or not row[0].strip() or row[0].startswith('#'):
+                    continue
+                if lineno == 1 and row[0].strip().lower() == 'input':
+                    continue
+                if len(row) < 2 or (len(row) < 3 and watermark_text is None):
+                    raise ValueError(f"{source}:{lineno}: expected input,output,text")
+                text = row[2] if len(row) > 2 and row[2] else watermark_text
+                jobs.append((os.path.join(base, row[0].strip()), os.path.join(base, row[1].strip()), text))
+        return _check_batch_outputs(jobs)
+
+    if output_dir is None or watermark_text is None:
+        raise ValueError("PDF, directory and glob sources need an output directory and --text")
+    if os.path.isfile(source):
+        return _check_batch_outputs([(source, os.path.join(output_dir, os.path.basename(source)), watermark_text)])
+    if os.path.isdir(source):
+        if _is_within(output_dir, source):
+            raise ValueError(f"output directory {output_dir} is inside the source directory {source}")
+        root = source
+        inputs = glob.glob(os.path.join(glob.escape(source), '**', '*'), recursive=True)
+        inputs = [p for p in inputs if p.lower().endswith('.pdf') and os.path.isfile(p)]
+    elif _is_glob(source):
+        inputs = [p for p in glob.glob(source, recursive=True) if os.path.isfile(p)]
+        # 通配符之前的目录部分作为相对路径的起点
+        prefix = []
+        for part in source.replace('\\', '/').split('/')[:-1]:
+            if _is_glob(part):
+                break
+            prefix.append(part)
+        root = '/'.join(prefix) or '.'
+        # 递归通配符会匹配到输出目录；其他通配符已经匹配到输出目录中的文件时同样拒绝
+        if ('**' in source and _is_within(output_dir, root)) or any(_is_within(p, output_dir) for p in inputs):
+            raise ValueError(f"output directory {output_dir} is matched by the source glob {source}")
+    else:
+        raise ValueError(f"batch source not found: {source}")
+    return _check_batch_outputs([(path, os.path.join(output_dir, os.path.relpath(path, root)), watermark_text) for path in sorted(inputs)])
+
+
+def _batch_settings(watermark_text, font_size, opacity, engine, output_mode):
+    # 决定输出内容的设置的摘要：设置改变后再次运行不会跳过已完成的任务
+    import hashlib
+    import json
+
+    data = json.dumps([watermark_text, float(font_size), float(opacity), engine, output_mode], ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+
+
+def _load_batch_progress(path):
+    # 进度清单为 JSON Lines，每完成一个任务追加一行；返回已成功完成的 (输入, 输出, 设置摘要)
+    import json
+
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # 进程崩溃时最后一行可能不完整
+                continue
+            if entry.get('status') == 'ok':
+                done.add((entry['input'], entry['output'], entry.get('settings')))
+    return done
+
+
+def _batch_job(input_pdf, output_pdf, watermark_text, font_size, opacity, engine, output_mode):
+    """批量模式的工作进程任务：写入临时文件后原子替换，崩溃不会留下半个输出。"""
+    directory = os.path.dirname(output_pdf)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{output_pdf}.{os.getpid()}.tmp"
+    try:
+        stats = add_watermark(input_pdf, tmp_path, watermark_text, font_size, opacity, engine=engine,
+                              output_mode=output_mode, parallel=False)
+        os.replace(tmp_path, output_pdf)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return stats.as_dict()
+
+
+def run_batch(jobs, progress_path, font_size=40, opacity=0.3, engine=DEFAULT_ENGINE, output_mode=DEFAULT_OUTPUT_MODE,
+              workers=None, log=print):
+    """在进程池中执行批量任务，返回汇总 dict（含失败列表）。
+
+    每个任务结束后立即在 ``progress_path`` 追加一行结果；再次运行时跳过其中已成功、
+    水印文本与选项相同且输出文件仍存在的任务，失败的任务会重试。
+    """
+    import concurrent.futures
+    import json
+    import multiprocessing
+
+    done = _load_batch_progress(progress_path)
+    settings = {text: _batch_settings(text, font_size, opacity, engine, output_mode) for _, _, text in jobs}
+    pending = [job for job in jobs if not ((job[0], job[1], settings[job[2]]) in done and os.path.exists(job[1]))]
+    summary = {'total': len(jobs), 'skipped': len(jobs) - len(pending), 'ok': 0, 'failed': 0,
+               'pages': 0, 'bytes_in': 0, 'bytes_out': 0, 'failures': []}
+    if pending:
+        log(f"Batch: {len(pending)} file(s) to process, {summary['skipped']} already done.")
+    workers = max(1, min(workers or PARALLEL_WORKERS or os.cpu_count() or 1, len(pending) or 1))
+    began = time.perf_counter()
+    with open(progress_path, 'a', encoding='utf-8') as progress, \
+            concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(_batch_job, inp, out, text, font_size, opacity, engine, output_mode): (inp, out, text)
+                   for inp, out, text in pending}
+        for fut in concurrent.futures.as_completed(futures):
+            inp, out, text = futures[fut]
+            entry = {'input': inp, 'output': out, 'settings': settings[text]}
+            try:
+                stats = fut.result()
+            except Exception as exc:
+                entry.update(status='error', error=f"{type(exc).__name__}: {exc}")
+                summary['failed'] += 1
+                summary['failures'].append(entry)
+            else:
+                entry.update(status='ok', pages=stats['page_count'], seconds=round(stats['timings']['total'], 4))
+                summary['ok'] += 1
+                summary['pages'] += stats['page_count']
+                summary['bytes_in'] += stats['bytes_in'] or 0
+                summary['bytes_out'] += stats['bytes_out'] or 0
+            progress.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            progress.flush()
+    summary['seconds'] = time.perf_counter() - began
+    return summary
+
+
+def batch_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='add.py batch', description='Watermark many PDFs with a pool of worker processes.')
+    parser.add_argument('source', help='PDF file, directory, glob pattern (quote it) or CSV manifest of input,output[,text] rows')
+    parser.add_argument('output_dir', nargs='?', help='output directory for PDF, directory and glob sources')
+    parser.add_argument('--text', help='watermark text (use \\n for new lines); default for manifest rows without text')
+    parser.add_argument('--font-size', type=float, default=40)
+    parser.add_argument('--opacity', type=float, default=0.3)
+    parser.add_argument('--engine', choices=ENGINES, default=DEFAULT_ENGINE)
+    parser.add_argument('--output-mode', choices=OUTPUT_MODES, default=DEFAULT_OUTPUT_MODE)
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--progress', help='resumable progress manifest (default: <output_dir or manifest>/.watermark-progress.jsonl)')
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = collect_batch_jobs(args.source, args.output_dir, args.text)
+    except ValueError as exc:
+        parser.error(str(exc))
+    progress_path = args.progress
+    if progress_path is None:
+        anchor = args.output_dir or os.path.dirname(os.path.abspath(args.source))
+        os.makedirs(anchor, exist_ok=True)
+        progress_path = os.path.join(anchor, '.watermark-progress.jsonl')
+
+    summary = run_batch(jobs, progress_path, font_size=args.font_size, opacity=args.opacity, engine=args.engine,
+                        output_mode=args.output_mode, workers=args.jobs)
+
+    seconds = summary['seconds'] or 1e-9
+    print("=" * 50)
+    print(f"Files:       {summary['ok']} ok, {summary['failed']} failed, {summary['skipped']} skipped (of {summary['total']})")
+    print(f"Elapsed:     {summary['seconds']:.2f}s")
+    print(f"Throughput:  {summary['ok'] / seconds:.1f} files/s, {summary['pages'] / seconds:.1f} pages/s, "
+          f"{summary['bytes_in'] / seconds / 1024 / 1024:.1f} MB/s in")
+    print(f"Progress:    {progress_path}")
+    for failure in summary['failures']:
+        print(f"  FAILED {failure['input']}: {failure['error']}")
+    return 1 if summary['failed'] else 0
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        sys.exit(batch_main(sys.argv[2:]))
+
+    # 可选参数 --engine=reportlab|native、--output-mode=full|incremental|linearized、--parallel、--workers=N、
+    # --layout-text=...，可出现在任意位置
+    argv = []
+    engine = DEFAULT_ENGINE
+    output_mode = DEFAULT_OUTPUT_MODE
+    parallel = None
+    workers = None
+    layout_text = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('--engine='):
+            engine = arg.split('=', 1)[1]
+        elif arg.startswith('--layout-text='):
+            layout_text = arg.split('=', 1)[1]
+        elif arg.startswith('--output-mode='):
+            output_mode = arg.split('=', 1)[1]
+        elif arg == '--parallel':
+            parallel = True
+        elif arg.startswith('--workers='):
+            try:
+                workers = int(arg.split('=', 1)[1])
+            except ValueError:
+                print("Error: --workers must be an integer")
+                sys.exit(1)
+        else:
+            argv.append(arg)
+    if engine not in ENGINES:
+        print(f"Error: Unknown engine '{engine}'. Choose one of: {', '.join(ENGINES)}")
+        sys.exit(1)
+    if output_mode not in OUTPUT_MODES:
+        print(f"Error: Unknown output mode '{output_mode}'. Choose one of: {', '.join(OUTPUT_MODES)}")
+        sys.exit(1)
+    sys.argv = sys.argv[:1] + argv
+
     # Check number of arguments
     if len(sys.argv) < 4:
         print("=" * 50)
@@ -172,10 +1251,19 @@ def main():
         print("  Watermark:    Watermark text (use \\n for new lines)")
         print("  Font Size:    Optional - Font size (default: 40)")
         print("  Opacity:      Optional - Opacity 0.0 to 1.0 (default: 0.3)")
+        print(f"  --engine=X    Optional - Rendering backend: {' or '.join(ENGINES)} (default: {DEFAULT_ENGINE})")
+        print(f"  --output-mode=X  Optional - {' or '.join(OUTPUT_MODES)}; incremental appends an update section, linearized enables fast web view (default: {DEFAULT_OUTPUT_MODE})")
+        print(f"  --parallel    Optional - Stamp page ranges in parallel (automatic from {PARALLEL_MIN_PAGES} pages)")
+        print("  --workers=N   Optional - Number of processes for parallel mode (default: CPU count)")
+        print("  --layout-text=X  Optional - Text that decides font size and line spacing (default: the watermark text)")
         print("\nExamples:")
         print("  python add.py input.pdf output.pdf \"CONFIDENTIAL\"")
         print("  python add.py input.pdf output.pdf \"DRAFT\\nDO NOT DISTRIBUTE\" 50 0.2")
         print("  python add.py input.pdf output.pdf \"SAMPLE\" 30 0.5")
+        print("  python add.py --engine=native input.pdf output.pdf \"CONFIDENTIAL\"")
+        print("\nBatch mode (see python add.py batch --help):")
+        print("  python add.py batch archive/ stamped/ --text \"CONFIDENTIAL\" --jobs 8")
+        print("  python add.py batch manifest.csv")
         print("\nNote: This tool preserves bookmarks and internal links in the PDF.")
         sys.exit(1)
     
@@ -225,10 +1313,13 @@ def main():
     print(f"Watermark:    {watermark_text}")
     print(f"Font Size:    {font_size}")
     print(f"Opacity:      {opacity} ({int(opacity*100)}%)")
+    print(f"Engine:       {engine}")
+    print(f"Output mode:  {output_mode}")
     print("=" * 50)
     
     # Add watermark
-    add_watermark(input_pdf, output_pdf, watermark_text, font_size, opacity)
+    add_watermark(input_pdf, output_pdf, watermark_text, font_size, opacity, engine=engine, output_mode=output_mode, parallel=parallel, workers=workers, verbose=True,
+                  layout_text=layout_text)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,133 @@
+"""Benchmark password verification throughput and login-storm interference.
+
+Usage: python scripts/bench_login.py [--seconds N] [--storm N] [--workers N]
+
+Reports pbkdf2_sha256 verifications per second (and per core) at the configured
+SECUREHUB_PBKDF2_ROUNDS, then runs a login storm of N concurrent clients against
+an in-process app (temporary SQLite database) while a probe client lists
+documents, once with hashing in the shared request threadpool (workers=0, the
+previous behaviour) and once on the dedicated executor. Reported per mode:
+logins/s during the storm and p50/p99 latency of the probe before and during it.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+_TMP = tempfile.mkdtemp(prefix='securehub-bench-login-')
+# 必须在导入 app 之前设置：临时数据库与存储目录，关闭登录限流
+os.environ.setdefault('SECUREHUB_DATABASE_URL', f'sqlite:///{os.path.join(_TMP, "bench.db")}')
+os.environ.setdefault('SECUREHUB_DOC_DIR', os.path.join(_TMP, 'documents'))
+os.environ['SECUREHUB_LOGIN_THROTTLE_FILE'] = os.path.join(_TMP, 'throttle')
+os.environ['SECUREHUB_LOGIN_USER_BURST'] = '0'
+os.environ['SECUREHUB_LOGIN_IP_BURST'] = '0'
+
+from fastapi.testclient import TestClient
+
+from app import security
+from app.main import app
+from scripts.init_db import init_db
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+def bench_verify(seconds, workers):
+    """``workers`` 个线程持续校验同一个哈希，返回每秒校验次数。"""
+    hashed = security.hash_password('password')
+    done = [0] * workers
+    deadline = time.perf_counter() + seconds
+
+    def run(i):
+        while time.perf_counter() < deadline:
+            security.verify_password('password', hashed)
+            done[i] += 1
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(workers)]
+    began = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(done) / (time.perf_counter() - began)
+
+
+def _probe(client, headers, seconds):
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        began = time.perf_counter()
+        client.get('/api/documents', headers=headers)
+        latencies.append((time.perf_counter() - began) * 1000)
+    return latencies
+
+
+def bench_storm(client, storm, seconds, workers):
+    security._hasher.shutdown()
+    security._hasher = security.PasswordHasher(workers=workers, queue_limit=max(storm, security.MAX_QUEUE))
+    token = client.post('/api/token', data={'username': 'alice', 'password': 'password'}).json()['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    baseline = _probe(client, headers, min(seconds, 2))
+
+    stop = threading.Event()
+    logins = [0] * storm
+
+    def login(i):
+        while not stop.is_set():
+            if client.post('/api/token', data={'username': 'alice', 'password': 'password'}).status_code == 200:
+                logins[i] += 1
+
+    threads = [threading.Thread(target=login, args=(i,)) for i in range(storm)]
+    for t in threads:
+        t.start()
+    time.sleep(0.5)
+    began = time.perf_counter()
+    start_logins = sum(logins)
+    during = _probe(client, headers, seconds)
+    rate = (sum(logins) - start_logins) / (time.perf_counter() - began)
+    stop.set()
+    for t in threads:
+        t.join()
+    return {
+        'logins_per_s': rate,
+        'probe_p50_idle': percentile(baseline, 50),
+        'probe_p99_idle': percentile(baseline, 99),
+        'probe_p50_storm': percentile(during, 50),
+        'probe_p99_storm': percentile(during, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--storm', type=int, default=100, help='concurrent login clients')
+    parser.add_argument('--workers', type=int, default=security.WORKERS, help='dedicated hashing threads')
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    print(f'pbkdf2_sha256 rounds={security.ROUNDS} cores={cores}')
+    for n in sorted({1, args.workers, cores}):
+        rate = bench_verify(args.seconds, n)
+        print(f'verify threads={n:<3} {rate:8.1f}/s  {rate / min(n, cores):8.1f}/s per core')
+
+    init_db()
+    with TestClient(app) as client:
+        for label, workers in (('shared threadpool', 0), (f'dedicated x{args.workers}', args.workers)):
+            r = bench_storm(client, args.storm, args.seconds, workers)
+            print(f'{label:<20} storm={args.storm} logins {r["logins_per_s"]:7.1f}/s  '
+                  f'probe p50/p99 idle {r["probe_p50_idle"]:.1f}/{r["probe_p99_idle"]:.1f} ms  '
+                  f'storm {r["probe_p50_storm"]:.1f}/{r["probe_p99_storm"]:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
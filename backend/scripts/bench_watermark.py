@@ -0,0 +1,298 @@
+"""Compare watermark engines in pages per second.
+
+Usage: python scripts/bench_watermark.py [--pages N] [--repeat N] [--workers N]
+       python scripts/bench_watermark.py --suite [--json results.json] [--compare baseline.json] [--max-pages N]
+
+--suite builds a fixed synthetic corpus (1 to 5,000 pages; portrait, landscape
+and /Rotate 90/270 pages; short, multi-line and long watermark text) and runs
+add_watermark (each engine, full and linearized output) and run_add_watermark
+against every document. Each case runs in a fresh process so its peak RSS is
+its own. Reported per case: pages/s, p50/p99 latency, p50 save time, peak RSS
+and output size inflation, plus the extra save cost of linearized output.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import pikepdf
+
+from modules.add import ENGINE_VERSION, ENGINES, add_watermark
+
+# 基准语料：(名称, 页数, 版式)。版式 mixed 为纵横交替，rotated 额外包含 /Rotate 90/270 的页面
+CORPUS = [
+    ('single', 1, 'portrait'),
+    ('mixed-100', 100, 'mixed'),
+    ('rotated-500', 500, 'rotated'),
+    ('mixed-2000', 2000, 'mixed'),
+    ('mixed-5000', 5000, 'mixed'),
+]
+TEXTS = {
+    'short': 'CONFIDENTIAL',
+    'multiline': 'CONFIDENTIAL\nDO NOT DISTRIBUTE\nalice (42) 10.0.0.7 2024-01-01 12:00:00 UTC',
+    'long': 'INTERNAL USE ONLY - NOT FOR EXTERNAL DISTRIBUTION - ' * 3,
+}
+
+
+def make_pdf(path, pages, distinct_sizes=False):
+    # 交替纵向/横向页，覆盖两种水印几何；distinct_sizes 时每页尺寸都不同，每页都要新建 stamp
+    pdf = pikepdf.new()
+    for i in range(pages):
+        width, height = (612, 792) if i % 2 == 0 else (792, 612)
+        if distinct_sizes:
+            width += i
+        pdf.add_blank_page(page_size=(width, height))
+    pdf.save(path)
+
+
+def make_corpus_pdf(path, pages, layout):
+    """生成确定性的语料 PDF：每页带一小段正文（共享字体），版式见 CORPUS。"""
+    pdf = pikepdf.new()
+    font = pdf.make_indirect(pikepdf.Dictionary(Type=pikepdf.Name.Font, Subtype=pikepdf.Name.Type1, BaseFont=pikepdf.Name.Helvetica))
+    for i in range(pages):
+        rotate = 0
+        if layout == 'portrait' or (layout != 'portrait' and i % 2 == 0):
+            size = (612, 792)
+        else:
+            size = (792, 612)
+        if layout == 'rotated' and i % 3 == 1:
+            size, rotate = (612, 792), 90 if i % 2 else 270
+        page = pdf.add_blank_page(page_size=size)
+        if rotate:
+            page.Rotate = rotate
+        lines = b''.join(b'0 -14 Td (Page %d, line %d: lorem ipsum dolor sit amet) Tj\n' % (i + 1, n) for n in range(40))
+        page.Contents = pdf.make_stream(b'BT /F1 10 Tf 50 750 Td\n' + lines + b'ET\n')
+        page.Resources = pikepdf.Dictionary(Font=pikepdf.Dictionary(F1=font))
+    pdf.save(path)
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return (peak if sys.platform == 'darwin' else peak * 1024) / 1024 / 1024
+
+
+def percentile(samples, pct):
+    """最近秩（nearest-rank）百分位数。"""
+    ordered = sorted(samples)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def _run_case(target, engine, input_pdf, text, repeat, tmp, output_mode='full'):
+    # 在独立进程中执行一个用例，返回每次耗时、保存阶段耗时、输出大小与峰值 RSS
+    from deploy.watermark_wrapper import run_add_watermark
+
+    baseline = _peak_rss_mb()
+    latencies = []
+    saves = []
+    out_size = 0
+    for n in range(repeat):
+        start = time.perf_counter()
+        if target == 'add_watermark':
+            output = os.path.join(tmp, f'{engine}-{os.getpid()}-{n}.pdf')
+            stats = add_watermark(input_pdf, output, text, engine=engine, output_mode=output_mode)
+            saves.append(stats.timings['save'])
+        else:
+            output = run_add_watermark(input_pdf, text, engine=engine, output_mode=output_mode)
+        latencies.append(time.perf_counter() - start)
+        out_size = os.path.getsize(output)
+        os.unlink(output)
+    return {'latencies': latencies, 'saves': saves, 'out_size': out_size, 'peak_rss_mb': _peak_rss_mb(), 'baseline_rss_mb': baseline}
+
+
+def run_suite(max_pages=5000, repeat=5, log=print):
+    """执行完整基准矩阵，返回可写入 JSON 的结果。"""
+    import pikepdf as _pikepdf
+    import reportlab
+
+    results = []
+    corpus_meta = {}
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, pages, layout in CORPUS:
+            if pages > max_pages:
+                continue
+            input_pdf = os.path.join(tmp, f'{name}.pdf')
+            make_corpus_pdf(input_pdf, pages, layout)
+            in_size = os.path.getsize(input_pdf)
+            corpus_meta[name] = {'pages': pages, 'layout': layout, 'bytes': in_size, 'sha256': _file_sha256(input_pdf)}
+            for text_name, text in TEXTS.items():
+                targets = [('add_watermark', engine, mode) for mode in ('full', 'linearized') for engine in ENGINES]
+                targets.append(('run_add_watermark', 'reportlab', 'full'))
+                for target, engine, mode in targets:
+                    with concurrent.futures.ProcessPoolExecutor(1, mp_context=ctx, max_tasks_per_child=1) as executor:
+                        run = executor.submit(_run_case, target, engine, input_pdf, text, repeat, tmp, mode).result()
+                    latencies = run['latencies']
+                    p50 = percentile(latencies, 50)
+                    row = {
+                        'corpus': name, 'text': text_name, 'target': target, 'engine': engine, 'output_mode': mode,
+                        'pages': pages,
+                        'repeat': repeat,
+                        'pages_per_s': pages / p50,
+                        'p50_ms': p50 * 1000,
+                        'p99_ms': percentile(latencies, 99) * 1000,
+                        'save_p50_ms': percentile(run['saves'], 50) * 1000 if run['saves'] else None,
+                        'peak_rss_mb': run['peak_rss_mb'],
+                        'baseline_rss_mb': run['baseline_rss_mb'],
+                        'inflation': run['out_size'] / in_size,
+                    }
+                    results.append(row)
+                    log(f"  {name:<12} {text_name:<9} {target:<17} {engine:<9} {mode:<10} {row['pages_per_s']:9.1f} pages/s  "
+                        f"p50 {row['p50_ms']:8.1f} ms  p99 {row['p99_ms']:8.1f} ms  peak {row['peak_rss_mb']:6.1f} MB  "
+                        f"x{row['inflation']:.3f}")
+    overhead = linearize_overhead(results)
+    for row in overhead:
+        log(f"  linearized {row['corpus']:<12} {row['text']:<9} {row['engine']:<9} save {row['save_ms']:+8.1f} ms "
+            f"({row['save_ratio'] or 0:.2f}x)  total {row['p50_ms']:+8.1f} ms")
+    return {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'pikepdf': _pikepdf.__version__,
+            'reportlab': reportlab.Version,
+            'engine_version': ENGINE_VERSION,
+            'repeat': repeat,
+            'corpus': corpus_meta,
+        },
+        'results': results,
+        'linearize_overhead': overhead,
+    }
+
+
+def linearize_overhead(results):
+    """线性化输出相对普通整份输出的额外耗时（保存阶段与端到端 p50，毫秒）。"""
+    full = {(r['corpus'], r['text'], r['engine']): r for r in results
+            if r['target'] == 'add_watermark' and r.get('output_mode', 'full') == 'full'}
+    overhead = []
+    for row in results:
+        base = full.get((row['corpus'], row['text'], row['engine']))
+        if row.get('output_mode') != 'linearized' or base is None:
+            continue
+        overhead.append({
+            'corpus': row['corpus'], 'text': row['text'], 'engine': row['engine'],
+            'save_ms': row['save_p50_ms'] - base['save_p50_ms'],
+            'save_ratio': row['save_p50_ms'] / base['save_p50_ms'] if base['save_p50_ms'] else None,
+            'p50_ms': row['p50_ms'] - base['p50_ms'],
+        })
+    return overhead
+
+
+def _case_key(row):
+    # 早期结果没有 output_mode 字段，均为整份输出
+    return (row['corpus'], row['text'], row['target'], row['engine'], row.get('output_mode', 'full'))
+
+
+# 低于这些绝对变化量的差异视为噪声（毫秒 / MB / 倍数）
+COMPARE_FLOOR = {'p50_ms': 2.0, 'peak_rss_mb': 4.0, 'inflation': 0.01}
+
+
+def compare_results(current, baseline, tolerance=0.15):
+    """对比两次结果，返回回归列表：p50 延迟、峰值 RSS 或输出膨胀率增长超过 ``tolerance``。"""
+    previous = {_case_key(row): row for row in baseline['results']}
+    regressions = []
+    for row in current['results']:
+        old = previous.get(_case_key(row))
+        if old is None:
+            continue
+        for metric in ('p50_ms', 'peak_rss_mb', 'inflation'):
+            if old[metric] and row[metric] > old[metric] * (1 + tolerance) and row[metric] - old[metric] > COMPARE_FLOOR[metric]:
+                regressions.append({'case': '/'.join(map(str, _case_key(row))), 'metric': metric,
+                                    'baseline': old[metric], 'current': row[metric]})
+    return regressions
+
+
+def bench_engine(engine, input_pdf, output_pdf, pages, repeat, workers=None, output_mode='full'):
+    """返回 (pages/s, 最快一次的秒数, 最快一次的 WatermarkStats)。"""
+    best = best_stats = None
+    parallel = workers is not None
+    if parallel:
+        # 预热：第一次调用会拉起并行进程
+        add_watermark(input_pdf, output_pdf, 'X', engine=engine, parallel=True, workers=workers)
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stats = add_watermark(input_pdf, output_pdf, 'CONFIDENTIAL\nDO NOT DISTRIBUTE', engine=engine, parallel=parallel, workers=workers,
+                              output_mode=output_mode)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best, best_stats = elapsed, stats
+    return pages / best, best, best_stats
+
+
+def format_phases(stats):
+    phases = ' '.join(f"{phase}={stats.timings[phase] * 1000:.0f}ms" for phase in stats.PHASES)
+    if stats.rss_peak is None:
+        return phases
+    return f"{phases} peak_rss={stats.rss_peak / 1048576:.0f}MB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--distinct-sizes', action='store_true', help='give every page its own size (one stamp per page)')
+    parser.add_argument('--workers', type=int, default=0, help='also run the parallel page-range mode with N processes')
+    parser.add_argument('--suite', action='store_true', help='run the synthetic corpus benchmark suite')
+    parser.add_argument('--max-pages', type=int, default=5000, help='suite: skip corpus documents larger than this')
+    parser.add_argument('--json', help='suite: write results to this JSON file')
+    parser.add_argument('--compare', help='suite: baseline JSON file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='suite: allowed relative slowdown (default 0.15)')
+    args = parser.parse_args()
+
+    if args.suite:
+        print(f"Watermark benchmark suite (up to {args.max_pages} pages, {args.repeat} runs per case)")
+        results = run_suite(args.max_pages, args.repeat)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"Results written to {args.json}")
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+            regressions = compare_results(results, baseline, args.tolerance)
+            for reg in regressions:
+                print(f"  REGRESSION {reg['case']} {reg['metric']}: {reg['baseline']:.2f} -> {reg['current']:.2f}")
+            print(f"{len(regressions)} regression(s) against {args.compare}")
+            sys.exit(1 if regressions else 0)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        input_pdf = os.path.join(tmp, 'input.pdf')
+        make_pdf(input_pdf, args.pages, args.distinct_sizes)
+        print(f"{args.pages} pages{' (distinct sizes)' if args.distinct_sizes else ''}, best of {args.repeat}")
+        for engine in ENGINES:
+            output_pdf = os.path.join(tmp, f'{engine}.pdf')
+            pps, best, stats = bench_engine(engine, input_pdf, output_pdf, args.pages, args.repeat)
+            print(f"  {engine:<10} {pps:10.1f} pages/s  ({best * 1000:.1f} ms, {stats.bytes_out} bytes)  {format_phases(stats)}")
+            lin_pps, lin_best, lin_stats = bench_engine(engine, input_pdf, output_pdf, args.pages, args.repeat, output_mode='linearized')
+            extra = (lin_stats.timings['save'] - stats.timings['save']) * 1000
+            print(f"  {engine + '/lin':<10} {lin_pps:10.1f} pages/s  ({lin_best * 1000:.1f} ms, save +{extra:.1f} ms)  {format_phases(lin_stats)}")
+            if args.workers > 1:
+                par_pps, par_best, par_stats = bench_engine(engine, input_pdf, output_pdf, args.pages, args.repeat, workers=args.workers)
+                label = f'{engine}/{args.workers}p'
+                print(f"  {label:<10} {par_pps:10.1f} pages/s  ({par_best * 1000:.1f} ms, {best / par_best:.2f}x speedup)  {format_phases(par_stats)}")
+
+
+if __name__ == '__main__':
+    main()
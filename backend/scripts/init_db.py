@@ -8,7 +8,7 @@ from app.database import Base
 from app import models
 from app.database import DATABASE_URL
 
-from app.auth import create_access_token
+from app.auth import create_user_access_token
 
 
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
@@ -64,7 +64,7 @@ def init_db():
         print('Created sample document and granted access to alice')
 
     # print JWT for alice
-    token = create_access_token({'sub': user.username})
+    token = create_user_access_token(user)
     print('\nSample JWT for alice:')
     print(token)
 
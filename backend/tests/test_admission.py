@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from app.utils.admission import AdmissionRejected, DownloadScheduler
+
+
+def test_bounded_concurrency_and_fifo_queue():
+    scheduler = DownloadScheduler(limit=2, queue_limit=2, queue_timeout=5)
+    order = []
+
+    async def download(name, release):
+        async with scheduler.slot():
+            order.append(name)
+            await release.wait()
+
+    async def main():
+        gates = [asyncio.Event() for _ in range(4)]
+        tasks = [asyncio.create_task(download(i, gates[i])) for i in range(4)]
+        await asyncio.sleep(0.01)
+        assert (scheduler.active, scheduler.stats()['queue_depth']) == (2, 2)
+        # 队列已满：第五个请求立即被拒绝
+        with pytest.raises(AdmissionRejected) as rejected:
+            await scheduler.acquire()
+        assert rejected.value.retry_after >= 1
+        for gate in gates:
+            gate.set()
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert order == [0, 1, 2, 3]
+    stats = scheduler.stats()
+    assert (stats['active'], stats['queue_depth'], stats['admitted'], stats['queued'], stats['rejected']) == (0, 0, 4, 2, 1)
+    assert stats['wait_ms_max'] >= stats['wait_ms_p50'] >= 0
+
+
+def test_queue_timeout_releases_waiter():
+    scheduler = DownloadScheduler(limit=1, queue_limit=4, queue_timeout=0.05)
+
+    async def main():
+        await scheduler.acquire()
+        with pytest.raises(AdmissionRejected, match='Timed out'):
+            await scheduler.acquire()
+        assert scheduler.stats()['queue_depth'] == 0
+        scheduler.release()
+        # 名额归还后可以再次取得
+        await scheduler.acquire()
+
+    asyncio.run(main())
+    assert scheduler.stats()['timeouts'] == 1
+    assert scheduler.active == 1
@@ -66,3 +66,681 @@ def test_download_requires_access(client):
     r2 = client.get(f'/api/documents/{doc_id}/download', headers=headers)
     # should be 200 or 500 if watermarking fails due to missing binary deps; treat >=400 as failure
     assert r2.status_code in (200, 500)
+
+
+def _alice_real_document(client, tmp_path):
+    # alice 可访问的示例文档，换成可渲染的真实 PDF
+    pikepdf = pytest.importorskip('pikepdf')
+    from app import models
+    from app.database import SessionLocal
+
+    resp = client.post('/api/token', data={'username': 'alice', 'password': 'password'})
+    headers = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    doc_id = client.get('/api/documents', headers=headers).json()['items'][0]['id']
+
+    source = tmp_path / 'real.pdf'
+    pdf = pikepdf.new()
+    pdf.add_blank_page(page_size=(595, 842))
+    pdf.save(source)
+    with SessionLocal() as db:
+        db.query(models.Document).filter(models.Document.id == doc_id).first().file_path = str(source)
+        db.commit()
+    return doc_id, headers
+
+
+def test_download_range_resumes_same_download(client, tmp_path):
+    from app import models
+    from app.database import SessionLocal
+
+    doc_id, headers = _alice_real_document(client, tmp_path)
+    with SessionLocal() as db:
+        doc = db.query(models.Document).filter(models.Document.id == doc_id).one()
+        # 默认模板 {username}：ETag 带下载 ID
+        doc.watermark_enabled, doc.watermark_text = True, None
+        db.commit()
+    full = client.get(f'/api/documents/{doc_id}/download', headers=headers)
+    assert full.status_code == 200
+    assert full.headers['accept-ranges'] == 'bytes'
+    etag = full.headers['etag']
+    size = len(full.content)
+
+    with SessionLocal() as db:
+        logs_before = db.query(models.DownloadLog).count()
+    part = client.get(f'/api/documents/{doc_id}/download', headers={**headers, 'Range': 'bytes=10-', 'If-Range': etag})
+    assert part.status_code == 206
+    assert part.headers['content-range'] == f'bytes 10-{size - 1}/{size}'
+    assert part.headers['etag'] == etag
+    assert part.content == full.content[10:]
+    with SessionLocal() as db:
+        # 续传不记新的下载日志
+        assert db.query(models.DownloadLog).count() == logs_before
+
+    stale = client.get(f'/api/documents/{doc_id}/download', headers={**headers, 'Range': 'bytes=10-', 'If-Range': '"stale"'})
+    assert stale.status_code == 200
+    assert len(stale.content) == int(stale.headers['content-length'])
+
+    # 没有 If-Range 的 Range 请求是新的下载：单独记录日志，不沿用上一次下载的水印变量
+    with SessionLocal() as db:
+        logs_before = db.query(models.DownloadLog).count()
+    fresh = client.get(f'/api/documents/{doc_id}/download', headers={**headers, 'Range': 'bytes=10-'})
+    assert fresh.status_code == 206 and fresh.headers['etag'] != etag
+    with SessionLocal() as db:
+        assert db.query(models.DownloadLog).count() == logs_before + 1
+
+    bad = client.get(f'/api/documents/{doc_id}/download', headers={**headers, 'Range': f'bytes={size + 10}-'})
+    assert bad.status_code == 416
+    assert bad.headers['content-range'].endswith(f'/{size}')
+
+
+def test_linearized_document(client, tmp_path):
+    import pikepdf
+
+    doc_id, headers = _alice_real_document(client, tmp_path)
+    resp = client.post('/api/token', data={'username': 'admin', 'password': 'adminpass'})
+    admin = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    assert client.put(f'/api/documents/{doc_id}/metadata', headers=admin, json={'linearize': True}).status_code == 200
+    assert client.get(f'/api/documents/{doc_id}', headers=admin).json()['linearize'] is True
+    # 存储的原文件已改写
+    with pikepdf.open(tmp_path / 'real.pdf') as pdf:
+        assert pdf.is_linearized
+
+    r = client.get(f'/api/documents/{doc_id}/download', headers=headers)
+    assert r.status_code == 200
+    with pikepdf.open(io.BytesIO(r.content)) as pdf:
+        assert pdf.is_linearized
+
+
+def test_download_queues_reingest_instead_of_linearizing_in_place(client, tmp_path, monkeypatch):
+    import hashlib
+    import pikepdf
+    from app import models
+    from app.database import SessionLocal
+    from app.routes.download import _resolve_deploy_module
+
+    doc_id, headers = _alice_real_document(client, tmp_path)
+    original = (tmp_path / 'real.pdf').read_bytes()
+    monkeypatch.setattr(_resolve_deploy_module('watermark_wrapper'), 'LINEARIZE', True)
+    with SessionLocal() as db:
+        doc = db.query(models.Document).filter(models.Document.id == doc_id).one()
+        doc.watermark_enabled, doc.linearize = False, None
+        db.commit()
+
+    # 本次下载返回未改动的原文件；响应之后的重新入库线性化并更新记录
+    r = client.get(f'/api/documents/{doc_id}/download', headers=headers)
+    assert r.status_code == 200 and r.content == original
+    with SessionLocal() as db:
+        doc = db.query(models.Document).filter(models.Document.id == doc_id).one()
+        assert doc.status == 'ready'
+        with pikepdf.open(doc.file_path) as pdf:
+            assert pdf.is_linearized
+        assert doc.sha256 == hashlib.sha256(open(doc.file_path, 'rb').read()).hexdigest()
+        assert doc.file_size == os.path.getsize(doc.file_path)
+    r = client.get(f'/api/documents/{doc_id}/download', headers=headers)
+    assert r.status_code == 200 and r.content != original
+    with pikepdf.open(io.BytesIO(r.content)) as pdf:
+        assert pdf.is_linearized
+
+
+def test_upload_ingest_gates_download(client):
+    pikepdf = pytest.importorskip('pikepdf')
+    from app import models
+    from app.database import SessionLocal
+
+    resp = client.post('/api/token', data={'username': 'admin', 'password': 'adminpass'})
+    admin = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    pdf = pikepdf.new()
+    pdf.add_blank_page(page_size=(595, 842))
+    pdf.add_blank_page(page_size=(842, 595))
+    buf = io.BytesIO()
+    pdf.save(buf)
+    r = client.post('/api/documents/upload', headers=admin, files={'file': ('ingest.pdf', io.BytesIO(buf.getvalue()), 'application/pdf')})
+    assert r.status_code == 200 and r.json()['status'] == 'pending'
+    doc_id = r.json()['id']
+
+    # 后台入库在响应之后执行
+    d = client.get(f'/api/documents/{doc_id}', headers=admin).json()
+    assert (d['status'], d['page_count'], d['file_size']) == ('ready', 2, len(buf.getvalue()))
+    with SessionLocal() as db:
+        doc = db.query(models.Document).filter(models.Document.id == doc_id).first()
+        assert doc.geometry == '{"sizes":[[595.0,842.0,0],[842.0,595.0,0]],"pages":[0,1]}'
+        alice = db.query(models.User).filter(models.User.username == 'alice').first().id
+    assert client.post(f'/api/documents/{doc_id}/grant', headers=admin, json={'user_id': alice}).status_code == 200
+    resp = client.post('/api/token', data={'username': 'alice', 'password': 'password'})
+    headers = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    assert client.get(f'/api/documents/{doc_id}/download', headers=headers).status_code == 200
+
+    with SessionLocal() as db:
+        db.query(models.Document).filter(models.Document.id == doc_id).first().status = 'pending'
+        db.commit()
+    r = client.get(f'/api/documents/{doc_id}/download', headers=headers)
+    assert r.status_code == 409 and r.headers['retry-after']
+
+    # 不是有效 PDF：入库失败，不可下载
+    r = client.post('/api/documents/upload', headers=admin, files={'file': ('broken.pdf', io.BytesIO(b'%PDF-1.4 not really'), 'application/pdf')})
+    d = client.get(f'/api/documents/{r.json()["id"]}', headers=admin).json()
+    assert d['status'] == 'failed' and d['ingest_error']
+
+
+def test_duplicate_uploads_share_one_blob(client):
+    pikepdf = pytest.importorskip('pikepdf')
+    from app import models
+    from app.database import SessionLocal
+    from app.utils import blob_store
+
+    resp = client.post('/api/token', data={'username': 'admin', 'password': 'adminpass'})
+    admin = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    pdf = pikepdf.new()
+    pdf.add_blank_page(page_size=(300, 300))
+    buf = io.BytesIO()
+    pdf.save(buf)
+    ids = [client.post('/api/documents/upload', headers=admin, files={'file': (name, io.BytesIO(buf.getvalue()), 'application/pdf')}).json()['id']
+           for name in ('manual.pdf', 'manual-copy.pdf')]
+
+    with SessionLocal() as db:
+        docs = db.query(models.Document).filter(models.Document.id.in_(ids)).all()
+        path = docs[0].file_path
+        assert docs[0].blob_sha256 == docs[1].blob_sha256 == docs[0].sha256
+        assert path == docs[1].file_path == blob_store.blob_path(docs[0].blob_sha256)
+        assert db.query(models.Blob).filter(models.Blob.sha256 == docs[0].blob_sha256).one().ref_count == 2
+    assert open(path, 'rb').read() == buf.getvalue()
+
+    # 改写共用的 blob（线性化）时复制一份作为新内容，另一个文档不受影响
+    assert client.put(f'/api/documents/{ids[1]}/metadata', headers=admin, json={'linearize': True}).status_code == 200
+    with SessionLocal() as db:
+        linearized = db.query(models.Document).filter(models.Document.id == ids[1]).one()
+        assert linearized.file_path != path and linearized.sha256 == linearized.blob_sha256
+        assert db.query(models.Blob).filter(models.Blob.sha256 == os.path.basename(path)[:-4]).one().ref_count == 1
+    with pikepdf.open(linearized.file_path) as pdf:
+        assert pdf.is_linearized
+    assert open(path, 'rb').read() == buf.getvalue()
+    assert client.delete(f'/api/documents/{ids[1]}', headers=admin).status_code == 200
+    assert not os.path.exists(linearized.file_path)
+
+    # 还有其他文档引用时保留文件，最后一个引用释放后删除
+    ids.append(client.post('/api/documents/upload', headers=admin, files={'file': ('again.pdf', io.BytesIO(buf.getvalue()), 'application/pdf')}).json()['id'])
+    assert client.delete(f'/api/documents/{ids[0]}', headers=admin).status_code == 200
+    assert os.path.exists(path)
+    assert client.delete(f'/api/documents/{ids[2]}', headers=admin).status_code == 200
+    assert not os.path.exists(path)
+    with SessionLocal() as db:
+        assert db.query(models.Blob).filter(models.Blob.sha256 == os.path.basename(path)[:-4]).first() is None
+
+
+def test_chunked_upload_resumes_and_creates_document(client, monkeypatch):
+    import hashlib
+    pikepdf = pytest.importorskip('pikepdf')
+    from app import models
+    from app.database import SessionLocal
+    from app.utils import chunked_upload
+
+    monkeypatch.setattr(chunked_upload, 'CHUNK_SIZE', 256)
+    resp = client.post('/api/token', data={'username': 'admin', 'password': 'adminpass'})
+    admin = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    pdf = pikepdf.new()
+    for _ in range(3):
+        pdf.add_blank_page(page_size=(400, 500))
+    buf = io.BytesIO()
+    pdf.save(buf)
+    data = buf.getvalue()
+    sha = hashlib.sha256(data).hexdigest()
+
+    for bad in ({'font_size': 'huge'}, {'opacity': 2}, {'watermark_enabled': 'yes'}, {'watermark_text': ['a']}):
+        r = client.post('/api/uploads', headers=admin, json=dict({'filename': 'big.pdf', 'size': len(data)}, **bad))
+        assert r.status_code == 400, bad
+    r = client.post('/api/uploads', headers=admin, json={'filename': 'big.pdf', 'size': len(data), 'sha256': sha, 'watermark_text': 'CHUNKED'})
+    assert r.status_code == 200
+    upload_id, chunks = r.json()['upload_id'], r.json()['chunks']
+    assert chunks == (len(data) + 255) // 256 > 2
+    pieces = [data[i * 256:(i + 1) * 256] for i in range(chunks)]
+
+    def put(index, body, digest=None):
+        headers = dict(admin, **{'X-Chunk-SHA256': digest or hashlib.sha256(body).hexdigest()})
+        return client.put(f'/api/uploads/{upload_id}?offset={index * 256}', headers=headers, content=body)
+
+    # 倒序上传，第一块传输损坏
+    for index in reversed(range(1, chunks)):
+        assert put(index, pieces[index]).status_code == 200
+    assert put(0, b'x' * 256, hashlib.sha256(pieces[0]).hexdigest()).status_code == 422
+    assert client.post(f'/api/uploads/{upload_id}/complete', headers=admin).status_code == 409
+    status = client.get(f'/api/uploads/{upload_id}', headers=admin).json()
+    assert [part['index'] for part in status['received']] == list(range(1, chunks))
+    # 只重传缺少的块；重复发送已收到的块不会再写入
+    assert put(0, pieces[0]).json()['received_bytes'] == len(data)
+    assert put(1, pieces[1]).status_code == 200
+
+    # 另一个 complete 请求正在建档：不再接受块，并发的 complete 返回 409
+    with SessionLocal() as db:
+        admin_id = db.query(models.User.id).filter(models.User.username == 'admin').scalar()
+    meta = chunked_upload.load(upload_id, admin_id)
+    chunked_upload.claim(meta)
+    assert client.post(f'/api/uploads/{upload_id}/complete', headers=admin).status_code == 409
+    assert put(1, pieces[1]).status_code == 409
+    chunked_upload.release(meta)
+
+    r = client.post(f'/api/uploads/{upload_id}/complete', headers=admin)
+    assert r.status_code == 200
+    d = client.get(f'/api/documents/{r.json()["id"]}', headers=admin).json()
+    assert (d['filename'], d['status'], d['page_count'], d['sha256'], d['watermark_text']) == ('big.pdf', 'ready', 3, sha, 'CHUNKED')
+    assert client.get(f'/api/uploads/{upload_id}', headers=admin).status_code == 404
+
+
+@pytest.mark.parametrize('archive', ['zip', 'tar.gz'])
+def test_bulk_upload_archive(client, archive):
+    import tarfile
+    import zipfile
+    pikepdf = pytest.importorskip('pikepdf')
+    from app import models
+    from app.database import SessionLocal
+
+    resp = client.post('/api/token', data={'username': 'admin', 'password': 'adminpass'})
+    admin = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    pdfs = []
+    for pages in (1, 2):
+        pdf = pikepdf.new()
+        for _ in range(pages):
+            pdf.add_blank_page(page_size=(500, 700))
+        buf = io.BytesIO()
+        pdf.save(buf)
+        pdfs.append(buf.getvalue())
+    members = [('line/a.pdf', pdfs[0]), ('line/b.pdf', pdfs[1]), ('line/a-copy.pdf', pdfs[0]),
+               ('line/broken.pdf', b'%PDF-1.4 truncated'), ('line/readme.txt', b'hello')]
+    data = io.BytesIO()
+    if archive == 'zip':
+        with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name, content in members:
+                zf.writestr(name, content)
+    else:
+        with tarfile.open(fileobj=data, mode='w:gz') as tf:
+            for name, content in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tf.addfile(info, io.BytesIO(content))
+
+    with SessionLocal() as db:
+        last_audit = db.query(models.AuditLog.id).order_by(models.AuditLog.id.desc()).first()[0]
+    r = client.post('/api/documents/bulk', headers=admin, params={'watermark_text': 'BULK', 'opacity': 0.5},
+                    files={'file': (f'line.{archive}', io.BytesIO(data.getvalue()), 'application/octet-stream')})
+    assert r.status_code == 200
+    report = r.json()
+    assert (report['total'], report['created'], report['failed'], report['skipped']) == (5, 3, 1, 1)
+    assert [f['status'] for f in report['files']] == ['created', 'created', 'created', 'failed', 'skipped']
+    ids = [f['id'] for f in report['files'][:3]]
+    assert [f['page_count'] for f in report['files'][:3]] == [1, 2, 1]
+
+    with SessionLocal() as db:
+        docs = {d.id: d for d in db.query(models.Document).filter(models.Document.id.in_(ids))}
+        assert [(docs[i].filename, docs[i].status, docs[i].watermark_text, docs[i].opacity) for i in ids] == [
+            ('a.pdf', 'ready', 'BULK', '0.5'), ('b.pdf', 'ready', 'BULK', '0.5'), ('a-copy.pdf', 'ready', 'BULK', '0.5')]
+        assert docs[ids[0]].file_path == docs[ids[2]].file_path
+        assert open(docs[ids[1]].file_path, 'rb').read() == pdfs[1]
+        audited = db.query(models.AuditLog).filter(models.AuditLog.id > last_audit, models.AuditLog.action == 'upload_document').all()
+        assert sorted(int(a.object_id) for a in audited) == sorted(ids)
+    for doc_id in ids:
+        client.delete(f'/api/documents/{doc_id}', headers=admin)
+
+    r = client.post('/api/documents/bulk', headers=admin, files={'file': ('x.zip', io.BytesIO(b'not an archive'), 'application/zip')})
+    assert r.status_code == 400
+
+
+def test_bulk_upload_rolls_back_when_audit_fails(client, monkeypatch):
+    import zipfile
+    pikepdf = pytest.importorskip('pikepdf')
+    from app import models
+    from app.database import SessionLocal
+    from app.utils import audit
+
+    resp = client.post('/api/token', data={'username': 'admin', 'password': 'adminpass'})
+    admin = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as zf:
+        for i in range(2):
+            pdf = pikepdf.new()
+            pdf.add_blank_page(page_size=(500 + i, 700))
+            buf = io.BytesIO()
+            pdf.save(buf)
+            zf.writestr(f'rollback-{i}.pdf', buf.getvalue())
+    calls = []
+
+    AuditLog = models.AuditLog
+
+    def failing_audit_log(**kwargs):
+        # 第二条审计记录插入失败
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError('audit insert failed')
+        return AuditLog(**kwargs)
+
+    monkeypatch.setattr(audit.models, 'AuditLog', failing_audit_log)
+    with SessionLocal() as db:
+        before = db.query(models.Document).count()
+    r = client.post('/api/documents/bulk', headers=admin, files={'file': ('r.zip', io.BytesIO(data.getvalue()), 'application/zip')})
+    assert r.status_code == 500
+    with SessionLocal() as db:
+        assert db.query(models.Document).count() == before
+        assert db.query(models.Document).filter(models.Document.filename.like('rollback-%')).count() == 0
+
+
+def test_principal_cache_skips_user_query_and_sees_deactivation(client):
+    from sqlalchemy import event
+    from app import models
+    from app.database import SessionLocal, engine
+
+    resp = client.post('/api/token', data={'username': 'admin', 'password': 'adminpass'})
+    admin = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    resp = client.post('/api/token', data={'username': 'alice', 'password': 'password'})
+    alice = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    with SessionLocal() as db:
+        alice_id = db.query(models.User).filter(models.User.username == 'alice').one().id
+
+    user_queries = []
+
+    def count(conn, cursor, statement, *args):
+        if 'FROM users' in statement:
+            user_queries.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        for _ in range(3):
+            assert client.get('/api/documents', headers=alice).status_code == 200
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    assert user_queries == []
+    assert client.get('/api/metrics', headers=admin).json()['principal_cache']['hits'] >= 3
+
+    # 停用立即生效，不必等缓存过期；已签发的令牌随之吊销，重新启用后须重新登录
+    assert client.put(f'/api/users/{alice_id}/active', headers=admin, json={'active': False}).status_code == 200
+    assert client.get('/api/documents', headers=alice).status_code == 401
+    assert client.put(f'/api/users/{alice_id}/active', headers=admin, json={'active': True}).status_code == 200
+    assert client.get('/api/documents', headers=alice).status_code == 401
+    resp = client.post('/api/token', data={'username': 'alice', 'password': 'password'})
+    alice = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    assert client.get('/api/documents', headers=alice).status_code == 200
+
+
+def test_token_version_claims_revoke_on_privilege_change_and_password_reset(client):
+    from jose import jwt
+    from app import models
+    from app.auth import SECRET_KEY, ALGORITHM
+    from app.database import SessionLocal
+
+    resp = client.post('/api/token', data={'username': 'admin', 'password': 'adminpass'})
+    admin = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    with SessionLocal() as db:
+        alice_id = db.query(models.User).filter(models.User.username == 'alice').one().id
+
+    def login(password='password'):
+        resp = client.post('/api/token', data={'username': 'alice', 'password': password})
+        token = resp.json().get('access_token')
+        return token, {'Authorization': f'Bearer {token}'}
+
+    token, alice = login()
+    claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    assert claims['uid'] == alice_id and claims['adm'] is False and isinstance(claims['ver'], int)
+    assert client.get('/api/users', headers=alice).status_code == 403
+
+    # 授予管理员权限后旧令牌失效，新令牌带 adm 声明
+    assert client.put(f'/api/users/{alice_id}/admin', headers=admin, json={'is_admin': True}).status_code == 200
+    assert client.get('/api/documents', headers=alice).status_code == 401
+    token, alice = login()
+    assert client.get('/api/users', headers=alice).status_code == 200
+    assert client.put(f'/api/users/{alice_id}/admin', headers=admin, json={'is_admin': False}).status_code == 200
+    assert client.get('/api/users', headers=alice).status_code == 401
+
+    token, alice = login()
+    assert client.put(f'/api/users/{alice_id}/password', headers=admin, json={'password': 'changed'}).status_code == 200
+    assert client.get('/api/documents', headers=alice).status_code == 401
+    assert client.post('/api/token', data={'username': 'alice', 'password': 'password'}).status_code == 401
+    token, alice = login('changed')
+    assert client.get('/api/documents', headers=alice).status_code == 200
+    assert client.put(f'/api/users/{alice_id}/password', headers=admin, json={'password': 'password'}).status_code == 200
+
+
+def test_login_rehashes_weak_password_hash_and_throttles_guessing(client, monkeypatch, tmp_path):
+    from passlib.hash import pbkdf2_sha256
+    from app import models, security
+    from app.database import SessionLocal
+    from app.utils import login_throttle
+
+    with SessionLocal() as db:
+        db.add(models.User(username='weakhash', hashed_password=pbkdf2_sha256.using(rounds=1000).hash('pw'), is_active=True))
+        db.commit()
+    assert client.post('/api/token', data={'username': 'weakhash', 'password': 'pw'}).status_code == 200
+    with SessionLocal() as db:
+        stored = db.query(models.User).filter(models.User.username == 'weakhash').one().hashed_password
+    assert stored.split('$')[2] == str(security.ROUNDS)
+    assert pbkdf2_sha256.verify('pw', stored)
+
+    monkeypatch.setattr(login_throttle, '_buckets', login_throttle.TokenBuckets(str(tmp_path / 'buckets'), slots=64))
+    monkeypatch.setattr(login_throttle, 'USER_BURST', 2)
+    monkeypatch.setattr(login_throttle, 'USER_RATE', 0.01)
+    # 成功的登录不消耗用户名令牌
+    for _ in range(3):
+        assert client.post('/api/token', data={'username': 'weakhash', 'password': 'pw'}).status_code == 200
+    for _ in range(2):
+        assert client.post('/api/token', data={'username': 'weakhash', 'password': 'wrong'}).status_code == 401
+    r = client.post('/api/token', data={'username': 'weakhash', 'password': 'pw'})
+    assert r.status_code == 429 and int(r.headers['retry-after']) >= 1
+    assert client.post('/api/token', data={'username': 'alice', 'password': 'password'}).status_code == 200
+
+
+def test_create_user_and_reset_password_hash_on_dedicated_executor(client):
+    from app import security
+
+    resp = client.post('/api/token', data={'username': 'admin', 'password': 'adminpass'})
+    admin = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    hashed = security.get_hasher().stats()['hashed']
+    r = client.post('/api/users', headers=admin, json={'username': 'hashed-on-executor', 'password': 'pw1'})
+    assert r.status_code == 201
+    assert client.put(f'/api/users/{r.json()["id"]}/password', headers=admin, json={'password': 'pw2'}).status_code == 200
+    assert security.get_hasher().stats()['hashed'] == hashed + 2
+    assert client.post('/api/token', data={'username': 'hashed-on-executor', 'password': 'pw2'}).status_code == 200
+
+
+def test_refresh_rotation_logout_and_revoke_all_sessions(client):
+    from datetime import datetime, timedelta
+    from sqlalchemy import event
+    from app import models
+    from app.database import SessionLocal, engine
+    from app.utils import refresh_tokens
+
+    resp = client.post('/api/token', data={'username': 'admin', 'password': 'adminpass'})
+    admin = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    with SessionLocal() as db:
+        alice_id = db.query(models.User).filter(models.User.username == 'alice').one().id
+
+    def login():
+        client.cookies.clear()
+        resp = client.post('/api/token', data={'username': 'alice', 'password': 'password'})
+        return resp.cookies['refresh_token']
+
+    def refresh(token):
+        client.cookies.clear()
+        client.cookies.set('refresh_token', token)
+        return client.post('/api/token/refresh')
+
+    first = login()
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        r = refresh(first)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert r.status_code == 200 and r.json()['access_token']
+    second = r.cookies['refresh_token']
+    assert second != first
+    # 吊销检查就是轮换时带条件的 UPDATE：不另行查询 refresh_tokens
+    assert not [s for s in statements if s.lstrip().upper().startswith('SELECT') and 'FROM refresh_tokens' in s]
+    assert len([s for s in statements if s.lstrip().upper().startswith('UPDATE REFRESH_TOKENS')]) == 1
+    # 轮换后的旧令牌不能再用
+    assert refresh(first).status_code == 401
+    r = refresh(second)
+    assert r.status_code == 200
+    third = r.cookies['refresh_token']
+
+    client.cookies.set('refresh_token', third)
+    assert client.post('/api/logout').status_code == 200
+    assert refresh(third).status_code == 401
+
+    sessions = [login() for _ in range(3)]
+    r = client.post('/api/token', data={'username': 'alice', 'password': 'password'})
+    alice = {'Authorization': f'Bearer {r.json()["access_token"]}'}
+    statements.clear()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        r = client.delete(f'/api/users/{alice_id}/sessions', headers=admin)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert r.status_code == 200 and r.json()['revoked'] >= 4
+    assert len([s for s in statements if s.lstrip().upper().startswith('UPDATE REFRESH_TOKENS')]) == 1
+    assert all(refresh(token).status_code == 401 for token in sessions)
+    assert client.get('/api/documents', headers=alice).status_code == 401
+
+    # 过期记录分批删除
+    with SessionLocal() as db:
+        past = datetime.utcnow() - timedelta(days=1)
+        db.add_all([models.RefreshToken(jti=f'expired-{i}', user_id=alice_id, expires_at=past) for i in range(5)])
+        db.commit()
+        assert refresh_tokens.sweep_expired(db, batch_size=2) >= 5
+        assert db.query(models.RefreshToken).filter(models.RefreshToken.expires_at < datetime.utcnow()).count() == 0
+    client.cookies.clear()
+
+
+def test_deactivation_revokes_refresh_tokens(client):
+    from app import models
+    from app.database import SessionLocal
+
+    resp = client.post('/api/token', data={'username': 'admin', 'password': 'adminpass'})
+    admin = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    with SessionLocal() as db:
+        alice_id = db.query(models.User).filter(models.User.username == 'alice').one().id
+    client.cookies.clear()
+    token = client.post('/api/token', data={'username': 'alice', 'password': 'password'}).cookies['refresh_token']
+    try:
+        assert client.put(f'/api/users/{alice_id}/active', json={'active': False}, headers=admin).status_code == 200
+    finally:
+        assert client.put(f'/api/users/{alice_id}/active', json={'active': True}, headers=admin).status_code == 200
+    client.cookies.clear()
+    client.cookies.set('refresh_token', token)
+    assert client.post('/api/token/refresh').status_code == 401
+    client.cookies.clear()
+
+
+@pytest.mark.parametrize('template', [None, 'CONFIDENTIAL\n{username} #{download_id}'])
+def test_template_watermark_is_not_appended_to_source(client, tmp_path, template):
+    import pikepdf
+    from app import models
+    from app.database import SessionLocal
+
+    doc_id, headers = _alice_real_document(client, tmp_path)
+    original = (tmp_path / 'real.pdf').read_bytes()
+    with SessionLocal() as db:
+        doc = db.query(models.Document).filter(models.Document.id == doc_id).one()
+        doc.watermark_enabled, doc.watermark_text, doc.linearize = True, template, False
+        db.commit()
+
+    r = client.get(f'/api/documents/{doc_id}/download', headers=headers)
+    assert r.status_code == 200
+    # 按用户的水印与源文件（或静态层）一起整份重写：截断到第一个 %%EOF 不能得到无水印的文件
+    assert not r.content.startswith(original)
+    head = r.content[:r.content.index(b'%%EOF') + 5]
+    with pikepdf.open(io.BytesIO(head)) as pdf:
+        stamps = list(pdf.pages[0].Resources.XObject.values())
+        assert any(b'alice' in stamp.read_bytes() for stamp in stamps)
+
+
+@pytest.mark.parametrize('cache_budget', [0, 1024 * 1024 * 1024])
+def test_template_watermark_ignores_incremental_output_mode(client, tmp_path, monkeypatch, cache_budget):
+    from app import models
+    from app.database import SessionLocal
+    from app.routes.download import _resolve_deploy_module
+    from app.utils import render_cache
+
+    # 在本进程内渲染，进程池的工作进程看不到这里修改的设置
+    monkeypatch.setattr(_resolve_deploy_module('watermark_pool'), '_pool', None)
+    monkeypatch.setattr(_resolve_deploy_module('watermark_wrapper'), 'WATERMARK_OUTPUT_MODE', 'incremental')
+    monkeypatch.setattr(render_cache, 'CACHE_BUDGET', cache_budget)
+    doc_id, headers = _alice_real_document(client, tmp_path)
+    original = (tmp_path / 'real.pdf').read_bytes()
+    with SessionLocal() as db:
+        doc = db.query(models.Document).filter(models.Document.id == doc_id).one()
+        doc.watermark_enabled, doc.watermark_text, doc.linearize = True, 'CONFIDENTIAL\n{username}', False
+        db.commit()
+    r = client.get(f'/api/documents/{doc_id}/download', headers=headers)
+    assert r.status_code == 200 and not r.content.startswith(original)
+
+
+def test_cache_hit_survives_eviction_before_stream(client, tmp_path, monkeypatch):
+    from app import models
+    from app.database import SessionLocal
+    from app.routes.download import _resolve_deploy_module
+    from app.utils import render_cache
+
+    monkeypatch.setattr(_resolve_deploy_module('watermark_pool'), '_pool', None)
+    monkeypatch.setattr(render_cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(render_cache, 'CACHE_BUDGET', 1024 * 1024 * 1024)
+    doc_id, headers = _alice_real_document(client, tmp_path)
+    with SessionLocal() as db:
+        doc = db.query(models.Document).filter(models.Document.id == doc_id).one()
+        doc.watermark_enabled, doc.watermark_text, doc.linearize = True, 'CONFIDENTIAL', False
+        db.commit()
+    first = client.get(f'/api/documents/{doc_id}/download', headers=headers)
+    assert first.status_code == 200
+
+    # 命中后、发送前缓存文件被淘汰或失效删除
+    opened = []
+    open_entry = render_cache.open_entry
+
+    def open_then_evict(document_id, key):
+        fd = open_entry(document_id, key)
+        opened.append(fd)
+        render_cache.evict(budget=0)
+        return fd
+
+    monkeypatch.setattr(render_cache, 'open_entry', open_then_evict)
+    r = client.get(f'/api/documents/{doc_id}/download', headers=headers)
+    assert opened and opened[0] is not None
+    assert r.status_code == 200
+    assert r.content == first.content
+    assert not [name for name in os.listdir(tmp_path / 'cache' / str(doc_id)) if name.endswith('.pdf')]
+
+
+def test_download_over_job_memory_limit_returns_503(client, tmp_path, monkeypatch):
+    from app import models
+    from app.database import SessionLocal
+    from app.routes import download
+    from modules.add import MemoryLimitExceeded
+
+    doc_id, headers = _alice_real_document(client, tmp_path)
+    with SessionLocal() as db:
+        db.query(models.Document).filter(models.Document.id == doc_id).one().watermark_enabled = True
+        db.commit()
+
+    async def over_limit(*args, **kwargs):
+        raise MemoryLimitExceeded('Watermark job exceeded its memory limit while saving')
+
+    for name in ('render_watermark', 'render_watermark_cached', 'render_watermark_template'):
+        monkeypatch.setattr(download, name, over_limit)
+    r = client.get(f'/api/documents/{doc_id}/download', headers=headers)
+    assert r.status_code == 503
+    assert int(r.headers['retry-after']) >= 1
+    assert 'memory limit' in r.json()['detail']
+
+
+def test_download_rejected_when_queue_full(client, monkeypatch):
+    from app.utils import admission
+
+    scheduler = admission.DownloadScheduler(limit=1, queue_limit=0)
+    scheduler.active = 1
+    monkeypatch.setattr(admission, '_scheduler', scheduler)
+    resp = client.post('/api/token', data={'username': 'alice', 'password': 'password'})
+    headers = {'Authorization': f'Bearer {resp.json().get("access_token")}'}
+    doc_id = client.get('/api/documents', headers=headers).json()['items'][0]['id']
+
+    r = client.get(f'/api/documents/{doc_id}/download', headers=headers)
+    assert r.status_code == 503
+    assert int(r.headers['retry-after']) >= 1
+    assert scheduler.stats()['rejected'] == 1
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.security import HasherBusy, PasswordHasher
+from app.utils.login_throttle import TokenBuckets
+
+
+def test_buckets_shared_across_processes_and_refill(tmp_path, monkeypatch):
+    path = str(tmp_path / 'buckets')
+    buckets = TokenBuckets(path, slots=64)
+    # 另一个 worker 进程：映射同一个状态文件
+    other = TokenBuckets(path, slots=64)
+    now = [1000.0]
+    monkeypatch.setattr('app.utils.login_throttle.time.time', lambda: now[0])
+
+    assert buckets.take('user:alice', 2, 0.5) == 0
+    assert other.take('user:alice', 2, 0.5) == 0
+    assert buckets.take('user:alice', 2, 0.5) == pytest.approx(2.0)
+    # 登录成功退还令牌
+    other.refund('user:alice', 2, 0.5)
+    assert buckets.take('user:alice', 2, 0.5) == 0
+    assert other.take('user:alice', 2, 0.5) > 0
+    now[0] += 2
+    assert buckets.take('user:alice', 2, 0.5) == 0
+    # 容量为 0 表示不限制
+    assert all(buckets.take('ip:10.0.0.1', 0, 0) == 0 for _ in range(5))
+
+
+def test_hasher_rejects_when_queue_full():
+    hasher = PasswordHasher(workers=1, queue_limit=1)
+    gate = threading.Event()
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        blocked = [loop.create_task(hasher._run(gate.wait)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        with pytest.raises(HasherBusy) as busy:
+            await hasher.verify_and_update('x', 'y')
+        assert busy.value.retry_after >= 1
+        gate.set()
+        await asyncio.gather(*blocked)
+
+    try:
+        asyncio.run(main())
+    finally:
+        hasher.shutdown()
+    stats = hasher.stats()
+    assert (stats['rejected'], stats['pending']) == (1, 0)
+
+
+def test_client_ip_trusts_forwarded_for_only_from_proxies(monkeypatch):
+    import ipaddress
+    from types import SimpleNamespace
+    from app.utils import client_ip as client_ip_module
+
+    monkeypatch.setattr(client_ip_module, 'TRUSTED_PROXIES', [ipaddress.ip_network('10.0.0.0/8')])
+
+    def request(peer, forwarded=None):
+        return SimpleNamespace(client=SimpleNamespace(host=peer), headers={'x-forwarded-for': forwarded} if forwarded else {})
+
+    assert client_ip_module.client_ip(request('10.0.0.2', '203.0.113.7')) == '203.0.113.7'
+    # 客户端自行填写的值在最左边，不采信；跳过链上的可信代理
+    assert client_ip_module.client_ip(request('10.0.0.2', '1.2.3.4, 203.0.113.7, 10.0.0.9')) == '203.0.113.7'
+    # 不可信的对端伪造 X-Forwarded-For 无效
+    assert client_ip_module.client_ip(request('198.51.100.1', '203.0.113.7')) == '198.51.100.1'
+    assert client_ip_module.client_ip(request('10.0.0.2')) == '10.0.0.2'
@@ -0,0 +1,68 @@
+import time
+
+from app.utils.principal_cache import Principal, PrincipalCache, _Epochs
+
+
+def _loader(calls, principal):
+    def load():
+        calls.append(1)
+        return principal
+    return load
+
+
+def test_hits_until_invalidated_from_another_process(tmp_path):
+    path = str(tmp_path / 'epochs')
+    cache = PrincipalCache(ttl=60, epochs=_Epochs(path, slots=16))
+    # 另一个 worker 进程：映射同一个计数器文件
+    other = PrincipalCache(ttl=60, epochs=_Epochs(path, slots=16))
+    calls = []
+    alice = Principal(7, 'alice', True, False, 0)
+
+    assert cache.get('alice', _loader(calls, alice)) is alice
+    assert cache.get('alice', _loader(calls, alice)) is alice
+    assert len(calls) == 1
+
+    # 共用计数器的其他用户（7 与 22 取模后同槽）失效只会多一次加载
+    other.invalidate(22)
+    cache.get('alice', _loader(calls, alice))
+    assert len(calls) == 2
+    other.invalidate(7)
+    disabled = Principal(7, 'alice', False, False, 0)
+    assert cache.get('alice', _loader(calls, disabled)) is disabled
+    assert len(calls) == 3
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['stale'], stats['entries']) == (1, 3, 2, 1)
+
+
+def test_ttl_lru_and_unknown_subjects(tmp_path):
+    cache = PrincipalCache(ttl=0.05, max_entries=2, epochs=_Epochs(str(tmp_path / 'epochs'), slots=16))
+    calls = []
+    for i, name in enumerate(['a', 'b', 'c']):
+        cache.get(name, _loader(calls, Principal(i, name, True, False)))
+    # 最久未使用的 'a' 被淘汰
+    assert cache.stats()['entries'] == 2
+    cache.get('a', _loader(calls, Principal(0, 'a', True, False, 0)))
+    assert len(calls) == 4
+    time.sleep(0.06)
+    cache.get('a', _loader(calls, Principal(0, 'a', True, False, 0)))
+    assert len(calls) == 5
+    # 不存在的用户不缓存
+    assert cache.get('ghost', _loader(calls, None)) is None
+    assert cache.get('ghost', _loader(calls, None)) is None
+    assert len(calls) == 7
+
+
+def test_invalidation_during_load_is_not_cached(tmp_path):
+    cache = PrincipalCache(ttl=60, epochs=_Epochs(str(tmp_path / 'epochs'), slots=16))
+    calls = []
+    alice = Principal(3, 'alice', True, True, 0)
+
+    def racing_load():
+        calls.append(1)
+        # 加载期间管理员撤销了权限
+        cache.invalidate(3)
+        return alice
+
+    cache.get('alice', racing_load)
+    cache.get('alice', _loader(calls, alice))
+    assert len(calls) == 2
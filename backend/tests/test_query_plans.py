@@ -0,0 +1,123 @@
+import re
+from datetime import datetime, timedelta
+
+import pytest
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from fastapi import HTTPException
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app import models
+from app.database import Base
+from app.routes.audit import list_audit
+from app.routes.download import _find_resumed_log, _prepare_download
+from app.routes.logs import list_logs
+from app.utils.principal_cache import Principal
+
+ALEMBIC_DIR = __file__.rsplit('/tests/', 1)[0] + '/alembic'
+# 会增长到千万行的表：查询不允许退化为全表扫描
+LARGE_TABLES = ('download_logs', 'audit_logs', 'document_access')
+_LARGE_TABLE_STEP = re.compile(r'^(SCAN|SEARCH) (%s)\b' % '|'.join(LARGE_TABLES))
+# 大表上的每一步都必须是按索引查找；SCAN ... USING INDEX 同样会读遍整个索引
+_INDEX_SEARCH = re.compile(r'^SEARCH (%s) USING ((COVERING )?INDEX|INTEGER PRIMARY KEY)\b' % '|'.join(LARGE_TABLES))
+# 唯一的例外：不带筛选条件的倒序分页按时间索引的顺序读取，由 LIMIT 限定读取的行数
+_ORDERED_SCAN = re.compile(r'^SCAN (%s) USING (COVERING )?INDEX ix_\1_timestamp$' % '|'.join(LARGE_TABLES))
+
+
+@pytest.fixture(scope='module')
+def engine(tmp_path_factory):
+    # 按迁移（而不是 create_all）建库，检查的是生产环境实际的索引
+    url = f"sqlite:///{tmp_path_factory.mktemp('plans') / 'migrated.db'}"
+    cfg = Config()
+    cfg.set_main_option('script_location', ALEMBIC_DIR)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv('SECUREHUB_DATABASE_URL', url)
+        command.upgrade(cfg, 'head')
+    return create_engine(url)
+
+
+@pytest.fixture
+def db(engine):
+    session = sessionmaker(bind=engine, autoflush=False)()
+    yield session
+    session.close()
+
+
+def capture_plans(engine):
+    """记录执行的每条 SELECT 语句及其 EXPLAIN QUERY PLAN。"""
+    plans = []
+
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            rows = conn.connection.dbapi_connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            plans.append((statement, [row[-1] for row in rows]))
+
+    event.listen(engine, 'before_cursor_execute', explain)
+    return plans, lambda: event.remove(engine, 'before_cursor_execute', explain)
+
+
+def assert_indexed(plans, ordered=False, ordered_scan=False):
+    assert plans
+    for statement, details in plans:
+        scans = [d for d in details if _LARGE_TABLE_STEP.match(d) and not _INDEX_SEARCH.match(d)
+                 and not (ordered_scan and _ORDERED_SCAN.match(d))]
+        assert not scans, f'scan {scans} in:\n{statement}\n{details}'
+        # 按时间倒序分页须直接按索引顺序读取；续传查找只在时间窗口内的少量行上排序
+        if ordered and re.search(r'ORDER BY \w+\.timestamp DESC', statement):
+            assert not [d for d in details if 'TEMP B-TREE FOR ORDER BY' in d], f'sort without index in:\n{statement}\n{details}'
+
+
+def test_migrations_match_models(engine):
+    with engine.connect() as conn:
+        assert compare_metadata(MigrationContext.configure(conn), Base.metadata) == []
+
+
+@pytest.mark.parametrize('filters', [
+    {},
+    {'user_id': 1},
+    {'document_id': 1},
+    {'user_id': 1, 'document_id': 1},
+    {'start_ts': '2026-01-01T00:00:00', 'end_ts': '2026-02-01T00:00:00'},
+    {'user_id': 1, 'start_ts': '2026-01-01T00:00:00'},
+    {'document_id': 1, 'end_ts': '2026-02-01T00:00:00'},
+])
+def test_log_queries_use_indexes(engine, db, filters):
+    args = dict(user_id=None, document_id=None, username=None, start_ts=None, end_ts=None, page=2, size=50)
+    args.update(filters)
+    plans, stop = capture_plans(engine)
+    try:
+        list_logs(db=db, _=None, **args)
+    finally:
+        stop()
+    if not filters:
+        # 不带筛选条件的总数必须数遍所有行，只检查分页查询
+        plans = [p for p in plans if 'count(' not in p[0]]
+    assert_indexed(plans, ordered=True, ordered_scan=not filters)
+
+
+def test_audit_and_download_queries_use_indexes(engine, db):
+    db.add(models.Document(id=1, filename='a.pdf', file_path='/nonexistent.pdf'))
+    db.commit()
+    user = Principal(1, 'alice', True, False)
+    plans, stop = capture_plans(engine)
+    try:
+        list_audit(page=2, size=100, db=db, _=None)
+    finally:
+        stop()
+    assert_indexed([p for p in plans if 'count(' not in p[0]], ordered=True, ordered_scan=True)
+
+    plans, stop = capture_plans(engine)
+    try:
+        _find_resumed_log(db, 1, user, 'bytes=100-', None)
+        _find_resumed_log(db, 1, user, 'bytes=100-', '"abc123-7"')
+        with pytest.raises(HTTPException):
+            # 没有授权：权限校验后即返回 403
+            _prepare_download(db, 1, user, None)
+        db.query(models.DocumentAccess).filter(models.DocumentAccess.document_id == 1).all()
+    finally:
+        stop()
+    assert_indexed(plans, ordered=True)
+    assert any('document_access' in statement for statement, _ in plans)
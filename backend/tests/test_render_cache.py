@@ -0,0 +1,75 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app import models
+from app.database import Base
+from app.utils import render_cache
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(render_cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
+
+
+def _store(doc_id, key, size, mtime):
+    path = render_cache.reserve(doc_id, key)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_open_entry_miss_then_hit(cache_dir):
+    key = render_cache.render_key(1, 'abc', 'CONFIDENTIAL', 40, 0.3, 'native-1')
+    before = render_cache.stats()
+    assert render_cache.open_entry(1, key) is None
+    _store(1, key, 10, 1000)
+    fd = render_cache.open_entry(1, key)
+    try:
+        # 命中后被淘汰：已打开的描述符仍可读完整个文件
+        assert render_cache.evict(budget=0) == 1
+        assert not os.path.exists(render_cache.entry_path(1, key))
+        assert os.read(fd, 100) == b'x' * 10
+    finally:
+        os.close(fd)
+    after = render_cache.stats()
+    assert after['misses'] == before['misses'] + 1
+    assert after['hits'] == before['hits'] + 1
+
+
+def test_render_key_covers_settings():
+    base = render_cache.render_key(1, 'abc', 'A', 40, 0.3, 'native-1')
+    assert base != render_cache.render_key(1, 'abd', 'A', 40, 0.3, 'native-1')
+    assert base != render_cache.render_key(1, 'abc', 'A', 41, 0.3, 'native-1')
+    assert base != render_cache.render_key(1, 'abc', 'A', 40, 0.3, 'reportlab-1')
+
+
+def test_evicts_least_recently_used(cache_dir):
+    old = _store(1, 'old', 60, 1000)
+    recent = _store(2, 'recent', 60, 2000)
+    assert render_cache.evict(budget=100) == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(recent)
+
+
+def test_document_writes_invalidate(cache_dir):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(bind=engine)
+    with Session(bind=engine) as db:
+        doc = models.Document(filename='a.pdf', file_path='/nonexistent/a.pdf', watermark_text='A')
+        db.add(doc)
+        db.commit()
+        entry = _store(doc.id, 'k', 10, 1000)
+
+        doc.watermark_text = 'B'
+        db.commit()
+        assert not os.path.exists(entry)
+
+        entry = _store(doc.id, 'k2', 10, 1000)
+        db.delete(doc)
+        db.commit()
+        assert not os.path.exists(entry)
@@ -0,0 +1,67 @@
+import asyncio
+import os
+
+import pytest
+
+from app.utils import single_flight
+
+
+def test_concurrent_calls_share_one_run():
+    calls = []
+
+    async def render():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'out.pdf'
+
+    async def main():
+        return await asyncio.gather(*(single_flight.run('doc/key', render) for _ in range(5)))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert sorted(results) == [('out.pdf', False)] + [('out.pdf', True)] * 4
+    assert single_flight.stats()['inflight'] == 0
+
+
+def test_failure_reaches_every_waiter():
+    async def render():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('render failed')
+
+    async def main():
+        return await asyncio.gather(*(single_flight.run('doc/broken', render) for _ in range(3)), return_exceptions=True)
+
+    assert [str(r) for r in asyncio.run(main())] == ['render failed'] * 3
+
+
+@pytest.mark.skipif(single_flight.fcntl is None, reason='needs fcntl')
+def test_waits_for_lock_held_by_another_process(tmp_path):
+    fcntl = single_flight.fcntl
+    lock = str(tmp_path / 'entry.pdf.lock')
+    # 另一个打开的文件描述即可模拟另一个进程持有的 flock
+    holder = os.open(lock, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(holder, fcntl.LOCK_EX)
+    events = []
+
+    async def render():
+        events.append('render')
+        return 'out.pdf'
+
+    async def main():
+        task = asyncio.create_task(single_flight.run('doc/locked', render, lock_path=lock))
+        await asyncio.sleep(0.1)
+        events.append('unlock')
+        fcntl.flock(holder, fcntl.LOCK_UN)
+        return await task
+
+    waits = single_flight.stats()['lock_waits']
+    assert asyncio.run(main()) == ('out.pdf', False)
+    os.close(holder)
+    assert events == ['unlock', 'render']
+    assert single_flight.stats()['lock_waits'] == waits + 1
+
+    # 锁一直不释放时超时后自行渲染
+    holder = os.open(lock, os.O_RDWR)
+    fcntl.flock(holder, fcntl.LOCK_EX)
+    assert asyncio.run(single_flight.run('doc/locked', render, lock_path=lock, lock_timeout=0.05)) == ('out.pdf', False)
+    os.close(holder)
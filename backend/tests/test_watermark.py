@@ -0,0 +1,423 @@
+import io
+import os
+
+import pikepdf
+import pytest
+
+from app.utils import watermark_template
+from app.utils.streaming import RangeNotSatisfiable, iter_rendered_output, parse_range
+from deploy.watermark_wrapper import RenderedOutput, SpoolWriter, render_watermark_output
+from modules.add import MemoryLimitExceeded, add_watermark, analyze_pdf, collect_batch_jobs, current_rss, linearize_file, run_batch
+
+
+@pytest.fixture
+def mixed_pdf(tmp_path):
+    # 3 个纵向页 + 2 个横向页 + 1 个 /Rotate 90 的纵向页
+    pdf = pikepdf.new()
+    for size in [(612, 792)] * 3 + [(792, 612)] * 2:
+        pdf.add_blank_page(page_size=size)
+    rotated = pdf.add_blank_page(page_size=(612, 792))
+    rotated.Rotate = 90
+    path = tmp_path / 'mixed.pdf'
+    pdf.save(path)
+    return path
+
+
+def _stamp_ids(path):
+    with pikepdf.open(path) as pdf:
+        return [tuple(x.objgen for x in page.Resources.XObject.values()) for page in pdf.pages]
+
+
+def test_stamp_shared_per_geometry(mixed_pdf, tmp_path):
+    out = tmp_path / 'out.pdf'
+    add_watermark(str(mixed_pdf), str(out), 'CONFIDENTIAL')
+
+    ids = _stamp_ids(out)
+    assert len(ids) == 6
+    # 纵向页共用一个 stamp，横向页与旋转后的纵向页（有效尺寸同为横向）共用另一个
+    assert ids[0] == ids[1] == ids[2]
+    assert ids[3] == ids[4] == ids[5]
+    assert ids[0] != ids[3]
+
+
+def _stamp_geometry(path):
+    # 返回横向 stamp 的 BBox、最后一个 cm（中心平移+旋转）和每行的 Tf/Tm 操作数
+    with pikepdf.open(path) as pdf:
+        stamp = next(iter(pdf.pages[3].Resources.XObject.values()))
+        ops = {'cm': [], 'Tf': [], 'Tm': []}
+        for operands, op in pikepdf.parse_content_stream(stamp):
+            if str(op) in ops:
+                ops[str(op)].append([float(x) for x in operands if not isinstance(x, pikepdf.Name)])
+        return [float(x) for x in stamp.BBox], ops['cm'][-1], ops['Tf'][-1], ops['Tm']
+
+
+def test_native_engine_matches_reportlab(mixed_pdf, tmp_path):
+    text = 'CONFIDENTIAL\\nDO NOT DISTRIBUTE'
+    add_watermark(str(mixed_pdf), str(tmp_path / 'rl.pdf'), text, engine='reportlab')
+    add_watermark(str(mixed_pdf), str(tmp_path / 'native.pdf'), text, engine='native')
+
+    rl_bbox, rl_cm, rl_tf, rl_tm = _stamp_geometry(tmp_path / 'rl.pdf')
+    native_bbox, native_cm, native_tf, native_tm = _stamp_geometry(tmp_path / 'native.pdf')
+    assert native_bbox == rl_bbox
+    assert native_cm == pytest.approx(rl_cm, abs=1e-3)
+    assert native_tf == pytest.approx(rl_tf, abs=1e-3)
+    assert len(native_tm) == 2
+    assert native_tm == [pytest.approx(tm, abs=1e-3) for tm in rl_tm]
+
+
+def test_unknown_engine_rejected(mixed_pdf, tmp_path):
+    with pytest.raises(ValueError):
+        add_watermark(str(mixed_pdf), str(tmp_path / 'x.pdf'), 'X', engine='bogus')
+
+
+@pytest.mark.parametrize('threshold', [10 * 1024 * 1024, 1024])
+def test_spool_writer_memory_and_spill(mixed_pdf, tmp_path, threshold):
+    writer = SpoolWriter(threshold, spool_dir=str(tmp_path))
+    add_watermark(str(mixed_pdf), writer, 'CONFIDENTIAL')
+    output = writer.result()
+
+    if output.path is None:
+        data = output.data
+    else:
+        assert output.path.startswith(str(tmp_path))
+        with open(output.path, 'rb') as f:
+            data = f.read()
+        output.discard()
+    assert len(data) == output.size
+    with pikepdf.open(io.BytesIO(data)) as pdf:
+        assert len(pdf.pages) == 6
+
+
+@pytest.mark.parametrize('xref_streams', [False, True])
+def test_incremental_output_keeps_source_prefix(mixed_pdf, tmp_path, xref_streams):
+    source = tmp_path / 'source.pdf'
+    with pikepdf.open(mixed_pdf) as pdf:
+        pdf.save(source, object_stream_mode=pikepdf.ObjectStreamMode.generate if xref_streams else pikepdf.ObjectStreamMode.disable)
+    original = source.read_bytes()
+
+    out = tmp_path / 'incremental.pdf'
+    add_watermark(str(source), str(out), 'CONFIDENTIAL', output_mode='incremental')
+    data = out.read_bytes()
+    assert data.startswith(original)
+    assert data.count(b'%%EOF') > original.count(b'%%EOF')
+
+    with pikepdf.open(out) as pdf:
+        assert not pdf.check_pdf_syntax()
+        assert len(pdf.pages) == 6
+        assert all(len(page.Resources.XObject) == 1 for page in pdf.pages)
+    assert _stamp_ids(out)[0] == _stamp_ids(out)[2]
+
+
+def test_incremental_tail_only(mixed_pdf, tmp_path):
+    writer = SpoolWriter(10 * 1024 * 1024, spool_dir=str(tmp_path))
+    add_watermark(str(mixed_pdf), writer, 'CONFIDENTIAL', output_mode='incremental', copy_source=False)
+    tail = writer.result().data
+
+    with pikepdf.open(io.BytesIO(mixed_pdf.read_bytes() + tail)) as pdf:
+        assert len(pdf.pages) == 6
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_linearized_output(mixed_pdf, tmp_path, parallel):
+    out = tmp_path / 'linearized.pdf'
+    stats = add_watermark(str(mixed_pdf), str(out), 'CONFIDENTIAL', output_mode='linearized', parallel=parallel, workers=2)
+    assert stats.output_mode == 'linearized'
+    with pikepdf.open(out) as pdf:
+        assert pdf.is_linearized
+        assert len(pdf.pages) == 6
+        assert all(len(page.Resources.XObject) == 1 for page in pdf.pages)
+
+    source = tmp_path / 'source.pdf'
+    source.write_bytes(mixed_pdf.read_bytes())
+    assert linearize_file(str(source))
+    assert not linearize_file(str(source))
+    with pikepdf.open(source) as pdf:
+        assert pdf.is_linearized
+
+
+@pytest.mark.skipif(current_rss() is None, reason='needs /proc')
+def test_low_memory_mode_and_memory_ceiling(mixed_pdf, tmp_path, monkeypatch):
+    stats = add_watermark(str(mixed_pdf), str(tmp_path / 'out.pdf'), 'CONFIDENTIAL', low_memory=True)
+    assert stats.access_mode == 'mmap'
+    assert stats.rss_peak >= stats.rss_start > 0
+    assert stats.as_dict()['rss_peak'] == stats.rss_peak
+
+    assert add_watermark(str(mixed_pdf), io.BytesIO(), 'CONFIDENTIAL', max_memory_mb=512).memory_limit == 512 * 1024 * 1024
+
+    # 模拟每次检查增长 1 MB：任务以明确的错误失败，而不是把进程拖垮
+    import modules.add
+    samples = iter(range(100 * 1024 * 1024, 10 ** 12, 1024 * 1024))
+    monkeypatch.setattr(modules.add, 'current_rss', lambda: next(samples))
+    monkeypatch.setattr(modules.add, '_reset_peak_rss', lambda: False)
+    with pytest.raises(MemoryLimitExceeded, match='memory limit while opening the source'):
+        add_watermark(str(mixed_pdf), io.BytesIO(), 'CONFIDENTIAL', max_memory_mb=0.5)
+    # 下载路径不回退到子进程（子进程同样会超出上限）
+    monkeypatch.setattr(modules.add, 'MAX_JOB_MEMORY_MB', 1.5)
+    with pytest.raises(MemoryLimitExceeded, match='saving'):
+        render_watermark_output(str(mixed_pdf), 'CONFIDENTIAL')
+
+    # 临时文件尚未创建时内存不足：原样抛出 MemoryError
+    import deploy.watermark_wrapper
+
+    def no_memory(*args, **kwargs):
+        raise MemoryError('out of memory')
+
+    monkeypatch.setattr(deploy.watermark_wrapper.tempfile, 'NamedTemporaryFile', no_memory)
+    with pytest.raises(MemoryError, match='out of memory'):
+        deploy.watermark_wrapper.run_add_watermark(str(mixed_pdf), 'CONFIDENTIAL')
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range('bytes=0-9', 100) == (0, 9)
+    assert parse_range('bytes=90-', 100) == (90, 99)
+    assert parse_range('bytes=-10', 100) == (90, 99)
+    assert parse_range('bytes=50-500', 100) == (50, 99)
+    # 多段与格式错误的 Range 按完整响应处理
+    assert parse_range('bytes=0-1,5-6', 100) is None
+    assert parse_range('items=0-1', 100) is None
+    for header in ('bytes=100-', 'bytes=9-3', 'bytes=-0'):
+        with pytest.raises(RangeNotSatisfiable):
+            parse_range(header, 100)
+
+
+@pytest.mark.parametrize('spooled', [False, True])
+def test_ranged_iteration_spans_prefix_and_body(tmp_path, spooled):
+    import asyncio
+
+    prefix = tmp_path / 'prefix.pdf'
+    prefix.write_bytes(b'P' * 100)
+    body = b''.join(bytes([i]) for i in range(50))
+
+    async def read(start, end):
+        if spooled:
+            spool = tmp_path / 'spool.bin'
+            spool.write_bytes(body)
+            output = RenderedOutput(path=str(spool), prefix_path=str(prefix), size=150)
+        else:
+            output = RenderedOutput(data=body, prefix_path=str(prefix), size=150)
+        return b''.join([chunk async for chunk in iter_rendered_output(output, chunk_size=7, start=start, end=end)])
+
+    whole = prefix.read_bytes() + body
+    for start, end in ((0, 149), (95, 104), (10, 20), (120, 149), (100, 100)):
+        assert asyncio.run(read(start, end)) == whole[start:end + 1]
+    assert not (tmp_path / 'spool.bin').exists()
+
+
+def test_template_layers():
+    template = 'CONFIDENTIAL\\n{username} ({user_id})\\n{unknown}'
+    static, dynamic = watermark_template.split_layers(template)
+    assert static == 'CONFIDENTIAL\n\n{unknown}'
+    assert dynamic == '\n{username} ({user_id})\n'
+    assert watermark_template.fill(dynamic, {'username': 'al\nice', 'user_id': 7}) == '\nal ice (7)\n'
+    assert not watermark_template.has_placeholders(static)
+
+
+def _text_ops(path):
+    # 每页所有水印层中 (Tm 平移, 文本) 的集合
+    with pikepdf.open(path) as pdf:
+        pages = []
+        for page in pdf.pages:
+            found = set()
+            for stamp in page.Resources.XObject.values():
+                tm = None
+                for operands, op in pikepdf.parse_content_stream(stamp):
+                    if str(op) == 'Tm':
+                        tm = (round(float(operands[4]), 3), round(float(operands[5]), 3))
+                    elif str(op) == 'Tj':
+                        found.add((tm, bytes(operands[0])))
+            pages.append(found)
+        return pages
+
+
+@pytest.mark.parametrize('engine', ['reportlab', 'native'])
+def test_layered_template_matches_full_render(mixed_pdf, tmp_path, engine):
+    template = 'CONFIDENTIAL\n{username}\n#{download_id}'
+    # 横向页按模板宽度缩小字号；模板行不需要缩小时与整份渲染完全一致
+    values = {'username': 'alice', 'download_id': 42}
+    static, dynamic = watermark_template.split_layers(template)
+
+    full = tmp_path / 'full.pdf'
+    add_watermark(str(mixed_pdf), str(full), watermark_template.fill(template, values), engine=engine)
+
+    base = tmp_path / 'static.pdf'
+    add_watermark(str(mixed_pdf), str(base), static, engine=engine, layout_text=template)
+    output = render_watermark_output(str(base), watermark_template.fill(dynamic, values), engine=engine, output_mode='incremental', layout_text=template)
+    assert output.prefix_path == str(base)
+    assert len(output.data) < 16 * 1024
+    layered = tmp_path / 'layered.pdf'
+    layered.write_bytes(base.read_bytes() + output.data)
+
+    assert _text_ops(layered) == _text_ops(full)
+
+
+def test_subprocess_fallback_keeps_template_layout(mixed_pdf, tmp_path, monkeypatch):
+    import modules.add
+
+    # 固定行最宽：字号由它决定，动态层单独排版时字号会不同
+    template = 'CONFIDENTIAL - INTERNAL DISTRIBUTION ONLY\n{username}\n#{download_id}'
+    values = {'username': 'alice', 'download_id': 42}
+    static, dynamic = watermark_template.split_layers(template)
+    full = tmp_path / 'full.pdf'
+    add_watermark(str(mixed_pdf), str(full), watermark_template.fill(template, values))
+    base = tmp_path / 'static.pdf'
+    add_watermark(str(mixed_pdf), str(base), static, layout_text=template)
+
+    def broken(*args, **kwargs):
+        raise RuntimeError('direct call unavailable')
+
+    # 直接调用失败时回退到子进程，动态层仍按完整模板排版
+    monkeypatch.setattr(modules.add, 'add_watermark', broken)
+    output = render_watermark_output(str(base), watermark_template.fill(dynamic, values), output_mode='incremental', layout_text=template)
+    try:
+        # 子进程写出的是追加了增量段的完整文件
+        assert output.path is not None
+        assert _text_ops(output.path) == _text_ops(full)
+    finally:
+        output.discard()
+
+
+@pytest.mark.parametrize('output_mode', ['full', 'incremental'])
+def test_parallel_page_ranges_match_serial(tmp_path, output_mode):
+    source = tmp_path / 'outlined.pdf'
+    pdf = pikepdf.new()
+    for i in range(9):
+        pdf.add_blank_page(page_size=(612, 792) if i % 3 else (792 + i, 612))
+    with pdf.open_outline() as outline:
+        outline.root.append(pikepdf.OutlineItem('Chapter 2', 4))
+    pdf.docinfo.Title = 'Outlined'
+    pdf.save(source)
+
+    serial, parallel = tmp_path / 'serial.pdf', tmp_path / 'parallel.pdf'
+    add_watermark(str(source), str(serial), 'CONFIDENTIAL', output_mode=output_mode, parallel=False)
+    add_watermark(str(source), str(parallel), 'CONFIDENTIAL', output_mode=output_mode, parallel=True, workers=2)
+
+    assert _text_ops(parallel) == _text_ops(serial)
+    with pikepdf.open(parallel) as pdf:
+        assert not pdf.check_pdf_syntax()
+        assert str(pdf.docinfo.Title) == 'Outlined'
+        with pdf.open_outline() as outline:
+            assert [item.title for item in outline.root] == ['Chapter 2']
+
+
+def test_precomputed_geometry_matches_page_reads(mixed_pdf, tmp_path):
+    info = analyze_pdf(str(mixed_pdf))
+    assert (info['page_count'], info['encrypted'], info['problems']) == (6, False, [])
+    # 6 页只记录 3 种几何（旋转页单独一种）
+    assert info['geometry'] == {'sizes': [[612.0, 792.0, 0], [792.0, 612.0, 0], [612.0, 792.0, 90]], 'pages': [0, 0, 0, 1, 1, 2]}
+
+    read, precomputed = tmp_path / 'read.pdf', tmp_path / 'precomputed.pdf'
+    add_watermark(str(mixed_pdf), str(read), 'CONFIDENTIAL')
+    stats = add_watermark(str(mixed_pdf), str(precomputed), 'CONFIDENTIAL', geometry=info['geometry'])
+    assert stats.precomputed_geometry
+    assert precomputed.read_bytes() == read.read_bytes()
+
+    # 页数对不上的几何表被忽略
+    stale = {'sizes': [[612.0, 792.0, 0]], 'pages': [0]}
+    assert not add_watermark(str(mixed_pdf), str(tmp_path / 'stale.pdf'), 'CONFIDENTIAL', geometry=stale).precomputed_geometry
+
+
+def test_stats_hooks_and_quiet_by_default(mixed_pdf, tmp_path, capsys):
+    phases = []
+    completed = []
+    out = tmp_path / 'out.pdf'
+    stats = add_watermark(str(mixed_pdf), str(out), 'CONFIDENTIAL', engine='native',
+                          on_phase=lambda phase, seconds, s: phases.append(phase), on_complete=completed.append)
+
+    assert capsys.readouterr().out == ''
+    assert completed == [stats]
+    assert phases == ['open', 'stamp_build', 'overlay', 'save', 'total']
+    assert (stats.engine, stats.output_mode, stats.parallel) == ('native', 'full', False)
+    assert (stats.page_count, stats.portrait_pages, stats.landscape_pages, stats.stamps) == (6, 4, 2, 2)
+    assert stats.bytes_in == mixed_pdf.stat().st_size
+    assert stats.bytes_out == out.stat().st_size
+    assert all(seconds >= 0 for seconds in stats.timings.values())
+    assert stats.timings['total'] >= stats.timings['save']
+
+    writer = SpoolWriter(10 * 1024 * 1024, spool_dir=str(tmp_path))
+    stats = add_watermark(str(mixed_pdf), writer, 'CONFIDENTIAL', output_mode='incremental', copy_source=False)
+    assert stats.output_mode == 'incremental'
+    assert stats.bytes_out == writer.result().size
+
+
+def test_batch_resumes_from_progress_manifest(mixed_pdf, tmp_path):
+    source = tmp_path / 'in'
+    (source / 'sub').mkdir(parents=True)
+    (source / 'a.pdf').write_bytes(mixed_pdf.read_bytes())
+    (source / 'sub' / 'b.pdf').write_bytes(mixed_pdf.read_bytes())
+    (source / 'broken.pdf').write_bytes(b'not a pdf')
+    progress = tmp_path / 'progress.jsonl'
+
+    jobs = collect_batch_jobs(str(source), str(tmp_path / 'out'), 'CONFIDENTIAL')
+    assert sorted(os.path.relpath(out, tmp_path / 'out') for _, out, _ in jobs) == ['a.pdf', 'broken.pdf', os.path.join('sub', 'b.pdf')]
+
+    summary = run_batch(jobs, str(progress), workers=2, log=lambda *a: None)
+    assert (summary['ok'], summary['failed'], summary['skipped'], summary['pages']) == (2, 1, 0, 12)
+    assert summary['failures'][0]['input'].endswith('broken.pdf')
+    assert (tmp_path / 'out' / 'sub' / 'b.pdf').exists()
+
+    # 再次运行只重试失败的任务
+    summary = run_batch(jobs, str(progress), workers=2, log=lambda *a: None)
+    assert (summary['ok'], summary['failed'], summary['skipped']) == (0, 1, 2)
+    # 水印文本或选项改变后不跳过已完成的任务
+    jobs = collect_batch_jobs(str(source), str(tmp_path / 'out'), 'DRAFT')
+    summary = run_batch(jobs, str(progress), workers=2, log=lambda *a: None)
+    assert (summary['ok'], summary['failed'], summary['skipped']) == (2, 1, 0)
+    summary = run_batch(jobs, str(progress), opacity=0.5, workers=2, log=lambda *a: None)
+    assert (summary['ok'], summary['skipped']) == (2, 0)
+
+    # 单个 PDF 也可以作为来源
+    assert collect_batch_jobs(str(source / 'a.pdf'), str(tmp_path / 'single'), 'DRAFT') == [
+        (str(source / 'a.pdf'), str(tmp_path / 'single' / 'a.pdf'), 'DRAFT')]
+    with pytest.raises(ValueError, match='output directory'):
+        collect_batch_jobs(str(source / 'a.pdf'))
+
+
+def test_batch_rejects_conflicting_outputs(tmp_path):
+    source = tmp_path / 'in'
+    (source / 'sub').mkdir(parents=True)
+    for name in ('a.pdf', os.path.join('sub', 'a.pdf')):
+        (source / name).write_bytes(b'%PDF-1.4')
+
+    # 输出目录在来源目录之内：再次运行会把输出当作输入
+    with pytest.raises(ValueError, match='inside the source directory'):
+        collect_batch_jobs(str(source), str(source / 'out'), 'DRAFT')
+    with pytest.raises(ValueError, match='inside the source directory'):
+        collect_batch_jobs(str(source), str(source), 'DRAFT')
+    with pytest.raises(ValueError, match='matched by the source glob'):
+        collect_batch_jobs(str(source / '**' / '*.pdf'), str(source / 'out'), 'DRAFT')
+    with pytest.raises(ValueError, match='is also a batch input'):
+        collect_batch_jobs(str(source / 'a.pdf'), str(source), 'DRAFT')
+
+    manifest = tmp_path / 'jobs.csv'
+    manifest.write_text('input,output,text\nin/a.pdf,out/a.pdf,A\nin/sub/a.pdf,out/./a.pdf,B\n', encoding='utf-8')
+    with pytest.raises(ValueError, match='both write'):
+        collect_batch_jobs(str(manifest))
+    manifest.write_text('in/a.pdf,in/sub/a.pdf,A\nin/sub/a.pdf,out/a.pdf,B\n', encoding='utf-8')
+    with pytest.raises(ValueError, match='is also a batch input'):
+        collect_batch_jobs(str(manifest))
+    manifest.write_text('in/a.pdf,out/a.pdf,A\nin/sub/a.pdf,out/sub/a.pdf,B\n', encoding='utf-8')
+    assert len(collect_batch_jobs(str(manifest))) == 2
+
+
+def test_bench_corpus_and_regression_check(tmp_path):
+    from scripts.bench_watermark import compare_results, linearize_overhead, make_corpus_pdf, percentile
+
+    path = tmp_path / 'rotated.pdf'
+    make_corpus_pdf(str(path), 6, 'rotated')
+    with pikepdf.open(path) as pdf:
+        assert sorted(int(page.get('/Rotate', 0)) for page in pdf.pages) == [0, 0, 0, 0, 90, 270]
+
+    assert percentile([5, 1, 3, 2, 4], 50) == 3
+    assert percentile(list(range(1, 101)), 99) == 99
+    row = {'corpus': 'c', 'text': 't', 'target': 'add_watermark', 'engine': 'native', 'p50_ms': 100.0, 'peak_rss_mb': 50.0, 'inflation': 1.1}
+    slower = dict(row, p50_ms=130.0)
+    assert [r['metric'] for r in compare_results({'results': [slower]}, {'results': [row]})] == ['p50_ms']
+    assert compare_results({'results': [row]}, {'results': [row]}) == []
+
+    full = dict(row, output_mode='full', save_p50_ms=10.0)
+    linearized = dict(row, output_mode='linearized', save_p50_ms=25.0, p50_ms=115.0)
+    # 旧结果没有 output_mode，视为整份输出
+    assert compare_results({'results': [full, linearized]}, {'results': [row]}) == []
+    overhead = linearize_overhead([full, linearized])
+    assert [(r['save_ms'], r['save_ratio'], r['p50_ms']) for r in overhead] == [(15.0, 2.5, 15.0)]
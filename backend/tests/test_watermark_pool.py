@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from deploy.watermark_pool import WatermarkPool, WatermarkTimeout
+
+
+@pytest.fixture
+def pool():
+    p = WatermarkPool(size=1, job_timeout=30, max_jobs=2).start()
+    yield p
+    p.stop()
+
+
+def test_pool_runs_jobs_in_warm_worker(pool):
+    pids = {pool.submit(os.getpid).result(timeout=60) for _ in range(2)}
+    assert os.getpid() not in pids
+    # max_jobs=2：第二个任务后工作进程被回收并重启
+    assert pool.submit(os.getpid).result(timeout=60) not in pids
+    assert pool.stats()['recycles'] == 1
+
+
+def _start_grandchild_and_hang(pid_file):
+    # 模拟并行模式：工作进程自己启动的子进程
+    child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+    with open(pid_file, 'w') as f:
+        f.write(str(child.pid))
+    time.sleep(30)
+
+
+def _gone(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            # 未被回收的僵尸进程同样视为已结束
+            return any(line.startswith('State:') and 'Z' in line for line in f)
+    except FileNotFoundError:
+        return True
+
+
+def _wait_for(predicate, seconds=60):
+    deadline = time.monotonic() + seconds
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_pool_job_timeout_restarts_worker(pool, tmp_path):
+    pid_file = tmp_path / 'grandchild.pid'
+    with pytest.raises(WatermarkTimeout):
+        pool.submit(_start_grandchild_and_hang, str(pid_file), timeout=2).result(timeout=60)
+    # 超时后立即重新拉起，不等下一个任务；工作进程启动的子进程一并结束
+    assert _wait_for(lambda: pool.stats()['alive'] == 1)
+    if sys.platform.startswith('linux'):
+        assert _wait_for(lambda: _gone(int(pid_file.read_text())), 10)
+    assert pool.submit(os.getpid).result(timeout=60)
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_pool_propagates_job_errors(pool):
+    with pytest.raises(FileNotFoundError):
+        pool.submit(os.stat, '/nonexistent/file.pdf').result(timeout=60)